@@ -0,0 +1,58 @@
+""" Compares the running time of calc_froc with the previous implementation,
+which looped over each distinct score
+
+usage: python benchmark_froc.py [n_samples] [n_parcels]
+"""
+import sys
+import time
+
+import numpy as np
+
+from simulation.metrics import calc_froc, get_true_false
+
+
+def calc_froc_loop(y_true, y_score):
+    # previous implementation of calc_froc, one pass over the thresholds
+    # per distinct score, and only the first sample of each score kept
+    n_samples, n_sources = y_true.shape
+    classes = np.unique(y_true)
+    n_pos = float(np.sum(y_true == classes[1]))
+
+    y_true = np.ravel(y_true)
+    y_score = np.ravel(y_score)
+    thresholds, indicesList = np.unique(y_score, return_index=True)
+    ts = np.zeros(thresholds.size)
+    tfp = np.zeros(thresholds.size)
+
+    sorted_signal = np.c_[y_score, y_true][indicesList, :][::-1]
+    for idx, (score, value) in enumerate(sorted_signal):
+        t_est = sorted_signal[:, 0] >= score
+        tps, _, fps, _ = get_true_false(sorted_signal[:, 1], t_est)
+        ts[idx] = tps
+        tfp[idx] = fps
+    return ts / n_pos, tfp / n_samples, thresholds[::-1]
+
+
+def run(func, y_true, y_score):
+    start = time.time()
+    func(y_true, y_score)
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    n_samples = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    n_parcels = int(sys.argv[2]) if len(sys.argv) > 2 else 450
+    rng = np.random.RandomState(42)
+
+    print('calc_froc on {} x {} scores'.format(n_samples, n_parcels))
+    y_true = (rng.rand(n_samples, n_parcels) < 3. / n_parcels).astype(int)
+    y_score = y_true + rng.randn(n_samples, n_parcels)
+    print('sort and cumsum: {:.3f}s'.format(run(calc_froc, y_true, y_score)))
+
+    # the loop is quadratic in the number of distinct scores, it is timed on
+    # a subset of the samples only
+    n_loop = min(n_samples, max(1, 10000 // n_parcels))
+    print('loop on {} samples: {:.3f}s'.format(
+        n_loop, run(calc_froc_loop, y_true[:n_loop], y_score[:n_loop])))
+    print('sort and cumsum on {} samples: {:.3f}s'.format(
+        n_loop, run(calc_froc, y_true[:n_loop], y_score[:n_loop])))
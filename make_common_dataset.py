@@ -1,4 +1,5 @@
 import glob
+import numpy as np
 import os
 import pandas as pd
 import random
@@ -6,6 +7,8 @@ from scipy import sparse
 from scipy.sparse import save_npz
 import shutil
 
+from simulation.writer import SparseTargetBuilder
+
 
 # read the data from the given subjects
 subjects = 'all'
@@ -121,12 +124,13 @@ def save_the_data(data_dir_all, subdir, data_dirs, subj_id_init,
             # create new .csv file
             subject_data.to_csv(all_X_file, header=True, index=False,
                                 compression='gzip')
-            target_all = target_subject
+            target_all = SparseTargetBuilder(
+                np.arange(target_subject.shape[1]))
         else:
             # append the data
             subject_data.to_csv(all_X_file, mode='a', header=False,
                                 index=False, compression='gzip')
-            target_all = sparse.vstack((target_all, target_subject))
+        target_all.append_rows(target_subject)
         # shutil.copyfile(os.path.join(subject_path, 'labels.pickle'),
         #               os.path.join(data_dir_all,
         #                            subject_name + '_labels.pickle')
@@ -136,6 +140,15 @@ def save_the_data(data_dir_all, subdir, data_dirs, subj_id_init,
                         os.path.join(data_dir_all,
                                      subject_name_id + '_L.npz')
                         )
+        # the float32 lead field which load_data memory maps, next to the
+        # .npz with the same name
+        leadfield_dir = os.path.join(subject_path, 'lead_field')
+        if os.path.isdir(leadfield_dir):
+            leadfield_dir_all = os.path.join(data_dir_all,
+                                             subject_name_id + '_L')
+            if os.path.isdir(leadfield_dir_all):
+                shutil.rmtree(leadfield_dir_all)
+            shutil.copytree(leadfield_dir, leadfield_dir_all)
         # uncomment if you want to also save labels
         # shutil.copyfile(os.path.join(subject_path,
         #                              subject_name + '_labels.npz'),
@@ -145,6 +158,7 @@ def save_the_data(data_dir_all, subdir, data_dirs, subj_id_init,
         sbj_id += 1
     if len(data_dirs):
         # save the target
+        target_all = target_all.tocsr()
         save_npz(os.path.join(data_dir_all_subdir, 'target.npz'), target_all)
         print(f'{target_all.shape[0]} samples from {sbj_id} subjects'
               f' were saved in the {data_dir_all} + {subdir}')
@@ -1,35 +1,28 @@
+import argparse
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-import pandas as pd
-
-from scipy.sparse import csr_matrix
-from scipy.sparse import save_npz
 
 import mne
-from mne.utils import check_random_state
 
-from joblib import cpu_count, Memory, Parallel, delayed
-from tqdm import tqdm
+from joblib import cpu_count, Memory
 
+from simulation.leadfield import get_leadfield
 from simulation.parcels import find_centers_of_mass
-from simulation.raw_signal import generate_signal
 from simulation.parcels import make_random_parcellation
+from simulation.sharding import merge_shards
+from simulation.sharding import shard_dir, shard_indices
+from simulation.work_queue import init_signal  # noqa: F401
+from simulation.work_queue import run_queue
+from simulation.writer import SimulationWriter
+from simulation.writer import targets_to_sparse  # noqa: F401
 
 import config
 
-if os.environ.get('DISPLAY'):
-    # display exists
-    N_JOBS = 1
-    # NOTE: all the directories should be made available from the server
-    # to run the subjects other than sample (path specs: config.py)
-else:
-    # running on the server, no display
-    N_JOBS = cpu_count()
-
-
-# Do not use more than 10 cores
-N_JOBS = min(10, N_JOBS)
+# NOTE: all the directories should be made available from the server
+# to run the subjects other than sample (path specs: config.py)
 
 # IMPORTANT: run it with ipython --gui=qt
 
@@ -134,56 +127,6 @@ def get_ready_parcels(subjects_dir, parcels='aparc_sub'):
     return parcels
 
 
-# @mem.cache
-def init_signal(parcels, raw_fname, fwd_fname, subject,
-                n_sources_max=3, random_state=None, signal_type='eeg'
-                ):
-    '''
-    '''
-    # randomly choose how many parcels will be activated between 1 and
-    # n_sources_max and which index at the parcel
-    rng = check_random_state(random_state)
-
-    n_parcels = rng.randint(n_sources_max, size=1)[0] + 1
-    to_activate = []
-    parcels_selected = []
-
-    # do this so that the same label is not selected twice
-    deck = list(rng.permutation(len(parcels)))
-    # deck_rh = list(rng.permutation(len(parcels_rh)))
-    for idx in range(n_parcels):
-        parcel_selected = deck.pop()
-        parcel_used = parcels[parcel_selected]
-        l1_source = parcels[parcel_selected].copy()
-        l1_source.vertices = [rng.choice(parcel_used.vertices)]
-
-        to_activate.append(l1_source)
-        parcels_selected.append(parcel_used)
-
-    # activate selected parcels
-    events, _, raw = generate_signal(raw_fname, fwd_fname, subject,
-                                     parcels=to_activate,
-                                     signal_type=signal_type,
-                                     random_state=rng)
-
-    evoked = mne.Epochs(raw, events, tmax=0.3).average()
-    data = evoked.data[:, np.argmax((evoked.data ** 2).sum(axis=0))]
-
-    names_parcels_selected = [parcel.name for parcel in parcels_selected]
-    return data, names_parcels_selected, to_activate
-
-
-def targets_to_sparse(target_list, parcel_names):
-    targets = []
-    for idx, tar in enumerate(target_list):
-        row = np.zeros(len(parcel_names))
-        for t in tar:
-            row[np.where(parcel_names == t)[0][0]] = 1
-        targets.append(row)
-    targets_sparse = csr_matrix(targets)
-    return targets_sparse
-
-
 def make_parcels_on_fsaverage(subjects_dir, n_parcels=20, hemi='both',
                               random_state=42):
     # The parcelation is done on the average brain
@@ -196,9 +139,107 @@ def make_parcels_on_fsaverage(subjects_dir, n_parcels=20, hemi='both',
     return parcels_flat
 
 
+def _get_fnames(subject, data_path):
+    if subject == 'sample':
+        raw_fname = os.path.join(data_path, 'MEG', subject,
+                                 subject + '_audvis_raw.fif')
+        fwd_fname = os.path.join(data_path, 'MEG', subject,
+                                 subject + '_audvis-meg-eeg-oct-6-fwd.fif')
+    else:
+        raw_fname = config.get_raw_fname(subject)
+        fwd_fname = config.get_fwd_fname(subject)
+
+    assert os.path.exists(raw_fname)
+    print(fwd_fname)
+    assert os.path.exists(fwd_fname)
+    return raw_fname, fwd_fname
+
+
+def _prepare_subject(subject, data_path, parcels_subject, data_dir_specific,
+                     n_samples, random_state, chunk_size, indices=None,
+                     parcellation=None):
+    """ serial part of the simulation which has to be done before the
+    samples of the subject can be simulated. Returns a dict describing the
+    work left to do for this subject """
+    raw_fname, fwd_fname = _get_fnames(subject, data_path)
+
+    # PREPARE PARCELS
+
+    # the names of the parcellation (e.g. 'superiorfrontal_1-lh') give the
+    # hierarchy of the parcels, see simulation.hierarchy.coarse_parcels
+    original_names = np.array([parcel.name for parcel in parcels_subject])
+    parcel_vertices = {}
+    for idx, parcel in enumerate(parcels_subject, 1):
+        parcel_name = str(idx) + parcel.name[-3:]
+        parcel_vertices[parcel_name] = parcel.vertices
+        parcel.name = parcel_name
+
+    # save label names with their corresponding vertices
+    parcel_names = [parcel.name for parcel in parcels_subject]
+    parcel_names = np.array(parcel_names)
+
+    # save the labels for the subject; the workers read them from there
+    labels_fname = os.path.join(data_dir_specific, subject + '_labels.npz')
+    np.savez(labels_fname, parcels_subject, original_names=original_names)
+
+    if parcellation is None:
+        parcellation = '{}_parcels'.format(len(parcel_names))
+
+    # prepare train and test data
+    writer = SimulationWriter(os.path.join(data_dir_specific, 'chunks'),
+                              n_samples, random_state, chunk_size=chunk_size,
+                              indices=indices)
+    done = writer.done_indices
+    if done:
+        print('{}: resuming, {} of {} samples already simulated'.format(
+              subject, len(done & writer.indices), len(writer.indices)))
+
+    return dict(subject=subject, raw_fname=raw_fname, fwd_fname=fwd_fname,
+                labels_fname=labels_fname, parcel_names=parcel_names,
+                parcel_vertices=parcel_vertices, parcellation=parcellation,
+                random_state=random_state,
+                writer=writer, data_dir=data_dir_specific,
+                todo=sorted(writer.indices - done))
+
+
+def _finalize_subject(job, signal_type, save_data=True, save_lead_field=True):
+    """ serial part of the simulation done once all the samples of the
+    subject were simulated. The shards of a simulation only flush their
+    samples, the data is saved when the shards are merged """
+    writer = job['writer']
+    writer.flush()
+    assert writer.is_complete
+    data_dir_specific = job['data_dir']
+
+    # SAVE THE DATA (simulated data and the target: source parcels)
+    if save_data:
+        n_saved = writer.save(data_dir_specific, job['parcel_names'])
+        print(str(n_saved), ' samples were saved')
+    if not save_lead_field:
+        return data_dir_specific
+
+    # READ LF
+    # the reduced lead field is computed once and kept as a float32 .npy
+    # which load_data and the estimators can memory map
+    leadfield = get_leadfield(
+        os.path.join(data_dir_specific, 'lead_field'), job['fwd_fname'],
+        job['parcel_vertices'], job['subject'], signal_type,
+        job['parcellation'])
+
+    # SAVE LF
+    np.savez(os.path.join(data_dir_specific, 'lead_field.npz'),
+             lead_field=leadfield['lead_field'],
+             parcel_indices=leadfield['parcel_indices'],
+             signal_type=signal_type, src_coords=leadfield['src_coords'])
+    print('New data was saved in {}'.format(data_dir_specific))
+    return data_dir_specific
+
+
 def simulate_for_subject(subject, data_path, parcels_subject,
                          n_samples=2000, n_sources_max=3, signal_type='grad',
-                         random_state=42, data_dir_specific='data'):
+                         random_state=42, data_dir_specific='data',
+                         chunk_size=100, n_jobs=1, blas_threads=1,
+                         parcellation=None, signal_func=None):
     """ simulates the data for a given subject. It generates and saves the
     following:
     X.csv: data of the shape n_samples x n_electrodes
@@ -210,7 +251,13 @@ def simulate_for_subject(subject, data_path, parcels_subject,
         to, shape: [n_verties],
         "signal_type": string indicating for which signal type the data was
         generated for
+    lead_field/: the same lead field saved as float32 .npy files which can be
+        memory mapped (see simulation.leadfield.read_leadfield)
     labels.pickle: vertices belonging to each parcel
+    chunks/: the simulated samples written in chunks of chunk_size samples
+        together with a manifest of the samples already simulated. If the
+        simulation is interrupted, rerunning it with the same random_state
+        simulates only the missing samples.
 
     Parameters
     ----------
@@ -223,131 +270,153 @@ def simulate_for_subject(subject, data_path, parcels_subject,
         simulation. The number of sources will be between 1 and n_sources_max
     signal_type : 'string', type of the signal. It can be 'eeg', 'meg', 'mag'
     or 'grad'
+    chunk_size : int, number of simulated samples kept in memory before they
+        are written to disk
+    n_jobs : int, number of worker processes used to simulate the samples
+    blas_threads : int, number of BLAS threads allowed in each worker
+    parcellation : string | None, name of the parcellation, used to check
+        that a lead field saved before was computed for the same parcels
+    signal_func : callable, optional, simulates each sample, by default
+        init_signal (see simulation.work_queue.run_queue)
 
     Returns
     -------
     data_dir : string, path to the data
         Returns an array of ones.
     """
-    # Here we are creating the directories/files for left and right hemisphere
-    if subject == 'sample':
-        raw_fname = os.path.join(data_path, 'MEG', subject,
-                                 subject + '_audvis_raw.fif')
-        fwd_fname = os.path.join(data_path, 'MEG', subject,
-                                 subject + '_audvis-meg-eeg-oct-6-fwd.fif')
-    else:
-        raw_fname = config.get_raw_fname(subject)
-        fwd_fname = config.get_fwd_fname(subject)
-
-    assert os.path.exists(raw_fname)
-    print(fwd_fname)
-    assert os.path.exists(fwd_fname)
-
-    # PREPARE PARCELS
-
-    parcel_vertices = {}
-    for idx, parcel in enumerate(parcels_subject, 1):
-        parcel_name = str(idx) + parcel.name[-3:]
-        parcel_vertices[parcel_name] = parcel.vertices
-        parcel.name = parcel_name
-
-    # save label names with their corresponding vertices
-    parcel_names = [parcel.name for parcel in parcels_subject]
-    parcel_names = np.array(parcel_names)
-
-    # save the labels for the subject
-    np.savez(os.path.join(data_dir_specific, subject + '_labels.npz'),
-             parcels_subject)
+    job = _prepare_subject(subject, data_path, parcels_subject,
+                           data_dir_specific, n_samples, random_state,
+                           chunk_size, parcellation=parcellation)
 
     # SIMULATE DATA
-    # prepare train and test data
-    signal_list = []
-    target_list = []
-    rng = np.random.RandomState(random_state)
-    seeds = rng.randint(np.iinfo('int32').max, size=n_samples)
+    run_queue([job], n_sources_max, signal_type, n_jobs, blas_threads,
+              on_subject_done=lambda job: None, signal_func=signal_func)
+    return _finalize_subject(job, signal_type)
+
+
+def simulate_subjects(subject_names, data_path, parcels_fsaverage, data_dir,
+                      n_samples=2000, n_sources_max=3, signal_type='grad',
+                      random_state=42, chunk_size=100, make_new=True,
+                      n_jobs=1, blas_threads=1, shard=0, num_shards=1,
+                      parcellation=None, signal_func=None):
+    """ simulates the data for all the given subjects (see
+    simulate_for_subject for the saved files).
+
+    The (subject, sample) pairs of all the subjects are simulated from a
+    single queue of n_jobs workers. The serial parts of the work of each
+    subject (morphing the labels, reading the forward, saving the data) are
+    run in a background thread, so that they overlap with the simulation of
+    the samples of the other subjects.
+
+    The simulation can be split across processes or nodes: each of the
+    num_shards shards simulates a disjoint slice of the (subject, sample)
+    pairs into data_dir/shards/shard_<shard>_of_<num_shards>. Every sample
+    has its own random stream (see simulation.sharding.sample_random_state),
+    so once the shards are assembled with merge_shards the data is the same
+    as the one simulated with a single shard.
 
-    train_data = Parallel(n_jobs=N_JOBS)(
-        delayed(init_signal)(parcels_subject, raw_fname, fwd_fname, subject,
-                             n_sources_max, seed, signal_type)
-        for seed in tqdm(seeds)
-    )
-    signal_list, target_list, activated = zip(*train_data)
+    Parameters
+    ----------
+    subject_names : list of string, names of the subjects
+    parcels_fsaverage : list of parcels on fsaverage, morphed to each subject
+    data_dir : string, directory in which data_<case> dir is made for each
+        subject
+    make_new : bool, if False the subjects which already have a directory
+        are skipped
+    n_jobs : int, number of worker processes (core budget)
+    blas_threads : int, number of BLAS threads allowed in each worker
+    shard : int, index of the shard to simulate, in [0, num_shards)
+    num_shards : int, number of shards the simulation is split into
+    parcellation : string | None, name of the parcellation
+    signal_func : callable, optional, simulates each sample, by default
+        init_signal (see simulation.work_queue.run_queue)
 
-    assert all([len(i) <= n_sources_max for i in target_list])
-    assert all([len(i) >= 1 for i in target_list])
+    Returns
+    -------
+    data_dirs : list of string, paths to the data of each subject
+    """
+    indices = shard_indices(subject_names, n_samples, shard, num_shards)
+    sharded = num_shards > 1
+    if sharded:
+        data_dir = shard_dir(data_dir, shard, num_shards)
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+
+    def prepare(subject):
+        if not len(indices[subject]):
+            return None
+        subjects_dir = config.get_subjects_dir_subj(subject)
 
-    # SAVE THE DATA (simulated data and the target: source parcels)
-    data_labels = ['e%d' % (idx + 1) for idx in range(len(signal_list[0]))]
-    df = pd.DataFrame(signal_list, columns=list(data_labels))
-    target = targets_to_sparse(target_list, parcel_names)
+        # morph fsaverage labels to the subject we are using
+        parcels_subject = mne.morph_labels(parcels_fsaverage, subject,
+                                           'fsaverage', subjects_dir, 'white')
 
-    df.to_csv(os.path.join(data_dir_specific, 'X.csv'), index=False)
-    save_npz(os.path.join(data_dir_specific, 'target.npz'), target)
-    print(str(len(df)), ' samples were saved')
+        # PATHS
+        # make all the paths
+        len_parcels = len(parcels_subject)
+        case_specific = (signal_type + '_' + subject + '_' + str(len_parcels)
+                         + '_' + str(n_sources_max))
+        data_dir_specific = os.path.join(data_dir, 'data_' + case_specific)
 
-    # READ LF
-    # reading forward matrix
-    fwd = mne.read_forward_solution(fwd_fname)
-    fwd = mne.convert_forward_solution(fwd, force_fixed=True)
-    lead_field = fwd['sol']['data']
-
-    if signal_type == 'eeg':
-        picks_eeg = mne.pick_types(fwd['info'], meg=False, eeg=True,
-                                   exclude=[])
-        lead_field = lead_field[picks_eeg, :]
-    elif signal_type == 'meg':
-        picks_meg = mne.pick_types(fwd['info'], meg=True, eeg=False,
-                                   exclude=[])
-        lead_field = lead_field[picks_meg, :]
-    elif signal_type == 'mag' or signal_type == 'grad':
-        picks_meg = mne.pick_types(fwd['info'], meg=signal_type,
-                                   eeg=False, exclude=[])
-        lead_field = lead_field[picks_meg, :]
-
-    # FIND VERTICES FOR lead field
-    # now we make a vector of size n_vertices for each surface of cortex
-    # hemisphere and put a int for each vertex that says it which label
-    # it belongs to.
-    parcel_indices_lh = np.zeros(len(fwd['src'][0]['inuse']), dtype=int)
-    parcel_indices_rh = np.zeros(len(fwd['src'][1]['inuse']), dtype=int)
-    for label_name, label_idx in parcel_vertices.items():
-        label_id = int(label_name[:-3])
-        if '-lh' in label_name:
-            parcel_indices_lh[label_idx] = label_id
-        else:
-            parcel_indices_rh[label_idx] = label_id
-
-    # Make sure label numbers different for each hemisphere
-    parcel_indices = np.concatenate((parcel_indices_lh,
-                                    parcel_indices_rh), axis=0)
-
-    # Now pick vertices that are actually used in the forward
-    inuse = np.concatenate((fwd['src'][0]['inuse'],
-                            fwd['src'][1]['inuse']), axis=0)
-    parcel_indices_l = parcel_indices[np.where(inuse)[0]]
-    assert len(parcel_indices_l) == lead_field.shape[1]
-
-    src = fwd['src']
-    src_coords = np.concatenate([src[0]['rr'][src[0]['inuse'] != 0],
-                                 src[1]['rr'][src[1]['inuse'] != 0]], axis=0)
-
-    # CLEAN UP AND SAVE LF
-    # Remove from parcel_indices and from the leadfield all the indices == 0
-    # (not used by our brain)
-    lead_field = lead_field[:, parcel_indices_l != 0]
-    src_coords = src_coords[parcel_indices_l != 0]
-    parcel_indices_l = parcel_indices_l[parcel_indices_l != 0]
-
-    assert len(parcel_indices_l) == lead_field.shape[1]
-    assert len(np.unique(parcel_indices_l)) == len(parcels_subject)
-    np.savez(os.path.join(data_dir_specific, 'lead_field.npz'),
-             lead_field=lead_field, parcel_indices=parcel_indices_l,
-             signal_type=signal_type, src_coords=src_coords)
-    print('New data was saved in {}'.format(data_dir_specific))
-    return data_dir_specific
+        if os.path.isdir(data_dir_specific) and not make_new:
+            # path exists, skip it
+            print('skipping existing directory: ' + data_dir_specific)
+            return None
+        elif not os.path.isdir(data_dir_specific):
+            os.mkdir(data_dir_specific)
+        assert os.path.exists(data_dir_specific)
+        print('working on ' + data_dir_specific)
+
+        return _prepare_subject(subject, data_path, parcels_subject,
+                                data_dir_specific, n_samples, random_state,
+                                chunk_size, indices=indices[subject],
+                                parcellation=parcellation)
+
+    def finalize(job):
+        # the lead field is exported by the shard with the first sample
+        return _finalize_subject(job, signal_type, save_data=not sharded,
+                                 save_lead_field=0 in job['writer'].indices)
+
+    # a single thread runs the serial parts in order, while the main thread
+    # feeds the workers
+    with ThreadPoolExecutor(max_workers=1) as serial:
+        prepared = [serial.submit(prepare, subject)
+                    for subject in subject_names]
+        finalized = []
+
+        def jobs():
+            for future in prepared:
+                job = future.result()
+                if job is None:
+                    continue
+                if not job['todo']:
+                    # nothing left to simulate, e.g. a resumed subject
+                    finalized.append(serial.submit(finalize, job))
+                    continue
+                yield job
+
+        def on_subject_done(job):
+            finalized.append(serial.submit(finalize, job))
+
+        run_queue(jobs(), n_sources_max, signal_type, n_jobs, blas_threads,
+                  on_subject_done, signal_func=signal_func)
+        return [future.result() for future in finalized]
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Simulate the data.')
+    parser.add_argument('--shard', type=int, default=0,
+                        help='index of the shard to simulate')
+    parser.add_argument('--num-shards', type=int, default=1,
+                        help='number of shards the simulation is split into')
+    parser.add_argument('--merge', action='store_true',
+                        help='assemble the shards once they are all done')
+    parser.add_argument('--n-jobs', type=int, default=cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('--blas-threads', type=int, default=1,
+                        help='number of BLAS threads in each worker')
+    args = parser.parse_args()
+
     # same variables
     # if set to true 'aparc_sub' will be used (450 parcels)
     random_parcels = False
@@ -362,18 +431,6 @@ if __name__ == "__main__":
     is_for_train = False
     make_new = True  # True if rerun all, even already existing dirs
 
-    data_path = config.get_data_path()
-
-    sample_subjects_dir = config.get_subjects_dir_subj("sample")
-    if random_parcels:
-        parcels_fsaverage = make_parcels_on_fsaverage(
-            sample_subjects_dir, n_parcels=n_parcels, random_state=random_state
-            )
-    else:
-        # aparc_sub type of parcesl will be used. All the vertices overlapping
-        # with corpus callosum will be removed
-        parcels_fsaverage = get_ready_parcels(sample_subjects_dir, 'aparc_sub')
-
     if is_for_train:
         data_dir = 'data/train'
         n_samples = 10000
@@ -387,36 +444,27 @@ if __name__ == "__main__":
                          'CC120309', 'CC120313', 'CC120319', 'CC120376',
                          'CC120469', 'CC120550', 'CC120218', 'CC120166']
 
-    for subject in subject_names:
-        subjects_dir = config.get_subjects_dir_subj(subject)
-
-        # morph fsaverage labels to the subject we are using
-        parcels_subject = mne.morph_labels(parcels_fsaverage, subject,
-                                           'fsaverage', subjects_dir, 'white')
-
-        # PATHS
-        # make all the paths
-        len_parcels = len(parcels_subject)
-        case_specific = (signal_type + '_' + subject + '_' + str(len_parcels)
-                         + '_' + str(n_sources_max))
-
-        data_dir_specific = os.path.join(data_dir, 'data_' + case_specific)
+    if args.merge:
+        merge_shards(data_dir, args.num_shards)
+        sys.exit()
 
-        # check if the data directory for the subject already exists
-        if not os.path.isdir(data_dir):
-            os.mkdir(data_dir)
+    data_path = config.get_data_path()
 
-        if os.path.isdir(data_dir_specific) and not make_new:
-            # path exists, skip it
-            print('skipping existing directory: ' + data_dir_specific)
-            continue
-        elif not os.path.isdir(data_dir_specific):
-            os.mkdir(data_dir_specific)
-        assert os.path.exists(data_dir_specific)
-        print('working on ' + data_dir_specific)
+    sample_subjects_dir = config.get_subjects_dir_subj("sample")
+    if random_parcels:
+        parcellation = 'random' + str(n_parcels)
+        parcels_fsaverage = make_parcels_on_fsaverage(
+            sample_subjects_dir, n_parcels=n_parcels, random_state=random_state
+            )
+    else:
+        # aparc_sub type of parcesl will be used. All the vertices overlapping
+        # with corpus callosum will be removed
+        parcellation = 'aparc_sub'
+        parcels_fsaverage = get_ready_parcels(sample_subjects_dir, 'aparc_sub')
 
-        data_dir_specific = simulate_for_subject(
-            subject, data_path,
-            parcels_subject, n_sources_max=n_sources_max, n_samples=n_samples,
-            random_state=random_state,
-            data_dir_specific=data_dir_specific, signal_type=signal_type)
+    simulate_subjects(subject_names, data_path, parcels_fsaverage, data_dir,
+                      n_samples=n_samples, n_sources_max=n_sources_max,
+                      signal_type=signal_type, random_state=random_state,
+                      make_new=make_new, n_jobs=args.n_jobs,
+                      blas_threads=args.blas_threads, shard=args.shard,
+                      num_shards=args.num_shards, parcellation=parcellation)
@@ -0,0 +1,170 @@
+import os
+
+import numpy as np
+from joblib import hash as joblib_hash
+from scipy import linalg, sparse
+
+from simulation.leadfield import read_leadfield
+from simulation.parcel_index import ParcelIndex
+
+
+def _top_mask(scores, n_top):
+    # mask of the n_top largest scores of each row
+    mask = np.zeros(scores.shape, dtype=bool)
+    if n_top >= scores.shape[1]:
+        mask[...] = True
+        return mask
+    top = np.argpartition(-scores, n_top - 1, axis=1)[:, :n_top]
+    mask[np.arange(len(scores))[:, None], top] = True
+    return mask
+
+
+class LeadfieldIndex(object):
+    """ Inverted file (IVF) index of the normalized columns of a lead field,
+    to find the parcels the most correlated with a sample without scoring
+    all the sources.
+
+    The columns are clustered by a spherical k-means on their sign folded
+    directions: l and -l give the same absolute correlation, so each column
+    joins the list of the centroid it has the largest absolute cosine with,
+    with the sign making it positive. A sample is then compared to the
+    centroids, and exactly to the columns of the n_probe closest lists only.
+
+    Parameters
+    ----------
+    lead_field : array, shape (n_electrodes, n_sources)
+    parcel_indices : array of int, shape (n_sources,), parcel of each source
+    n_lists : int, optional, number of lists, by default sqrt(n_sources)
+    n_iter : int, number of iterations of the k-means
+    random_state : int, seed of the initial centroids
+    centroids : array, shape (n_electrodes, n_lists), optional, centroids
+        of a saved index, the k-means is then skipped
+    n_parcels : int, optional, number of parcels of the scores
+    """
+    def __init__(self, lead_field, parcel_indices, n_lists=None, n_iter=10,
+                 random_state=0, centroids=None, n_parcels=None):
+        lead_field = np.asarray(lead_field, dtype=np.float64)
+        lead_field = lead_field / linalg.norm(lead_field, axis=0)
+        parcel_indices = np.asarray(parcel_indices)
+        if n_parcels is None:
+            n_parcels = int(parcel_indices.max())
+        self.n_parcels = n_parcels
+        if centroids is None:
+            if n_lists is None:
+                n_lists = int(np.sqrt(lead_field.shape[1]))
+            centroids = self._kmeans(lead_field, n_lists, n_iter,
+                                     random_state)
+        self.centroids = centroids
+        self.n_iter = n_iter
+        self.random_state = random_state
+
+        lists = np.argmax(np.abs(centroids.T @ lead_field), axis=0)
+        # the columns of each list next to each other
+        self.blocks = []
+        for list_idx in range(centroids.shape[1]):
+            columns = np.flatnonzero(lists == list_idx)
+            self.blocks.append((np.asfortranarray(lead_field[:, columns]),
+                                ParcelIndex(parcel_indices[columns],
+                                            n_parcels)))
+
+    @staticmethod
+    def _kmeans(lead_field, n_lists, n_iter, random_state):
+        rng = np.random.RandomState(random_state)
+        n_sources = lead_field.shape[1]
+        centroids = lead_field[:, rng.choice(n_sources, n_lists,
+                                             replace=False)]
+        for _ in range(n_iter):
+            similarity = centroids.T @ lead_field
+            lists = np.argmax(np.abs(similarity), axis=0)
+            signs = np.sign(similarity[lists, np.arange(n_sources)])
+            members = sparse.csr_matrix(
+                (signs, (lists, np.arange(n_sources))),
+                shape=(n_lists, n_sources))
+            sums = (members @ lead_field.T).T
+            norms = linalg.norm(sums, axis=0)
+            # the empty lists keep their centroid
+            updated = norms > 0
+            centroids[:, updated] = sums[:, updated] / norms[updated]
+        return centroids
+
+    def __deepcopy__(self, memo):
+        # the index is not modified once built, the copies of the estimators
+        # made by sklearn.base.clone share it instead of copying it
+        return self
+
+    @property
+    def n_lists(self):
+        return self.centroids.shape[1]
+
+    def score_parcels(self, data, n_probe):
+        """ max absolute correlation of the samples with the sources of each
+        parcel, among the sources of the n_probe lists closest to each
+        sample
+
+        Parameters
+        ----------
+        data : array, shape (n_samples, n_electrodes), samples of unit norm
+        n_probe : int, number of lists searched per sample
+
+        Returns
+        -------
+        scores : array, shape (n_samples, n_parcels), 0 for the parcels
+            without any source in the lists searched
+        """
+        probed = _top_mask(np.abs(data @ self.centroids), n_probe)
+        scores = np.zeros((len(data), self.n_parcels))
+        for list_idx, (lead_field, parcel_index) in enumerate(self.blocks):
+            rows = np.flatnonzero(probed[:, list_idx])
+            if not len(rows) or not lead_field.shape[1]:
+                continue
+            # exact correlations of the candidate sources
+            scores[rows] = np.maximum(scores[rows], parcel_index.reduce(
+                np.abs(data[rows] @ lead_field)))
+        return scores
+
+    def save(self, fname, lead_field_hash=''):
+        """ saves the centroids and the parameters of the k-means, with
+        lead_field_hash identifying the lead field they were computed on """
+        np.savez(fname, centroids=self.centroids, n_iter=self.n_iter,
+                 random_state=self.random_state,
+                 lead_field_hash=lead_field_hash)
+
+    @classmethod
+    def load(cls, fname, lead_field, parcel_indices, n_parcels=None):
+        """ reads an index saved with save, for the same lead field """
+        saved = np.load(fname)
+        return cls(lead_field, parcel_indices, n_iter=int(saved['n_iter']),
+                   random_state=int(saved['random_state']),
+                   centroids=saved['centroids'], n_parcels=n_parcels)
+
+
+def get_leadfield_index(leadfield_dir, n_lists=None, n_iter=10,
+                        random_state=0, n_parcels=None):
+    """ index of the lead field saved in leadfield_dir (see
+    simulation.leadfield.save_leadfield), read from ivf_index.npz in the
+    same directory, or built and saved there if it does not exist yet for
+    these n_lists, n_iter and random_state, or if the lead field was saved
+    again since """
+    leadfield = read_leadfield(leadfield_dir)
+    lead_field = leadfield['lead_field']
+    parcel_indices = leadfield['parcel_indices']
+    if n_lists is None:
+        n_lists = int(np.sqrt(lead_field.shape[1]))
+    lead_field_hash = joblib_hash((lead_field, parcel_indices))
+
+    fname = os.path.join(leadfield_dir, 'ivf_index.npz')
+    if os.path.exists(fname):
+        with np.load(fname) as saved:
+            up_to_date = ('lead_field_hash' in saved.files and
+                          saved['centroids'].shape[1] == n_lists and
+                          int(saved['n_iter']) == n_iter and
+                          int(saved['random_state']) == random_state and
+                          str(saved['lead_field_hash']) == lead_field_hash)
+        if up_to_date:
+            return LeadfieldIndex.load(fname, lead_field, parcel_indices,
+                                       n_parcels=n_parcels)
+    index = LeadfieldIndex(lead_field, parcel_indices, n_lists=n_lists,
+                           n_iter=n_iter, random_state=random_state,
+                           n_parcels=n_parcels)
+    index.save(fname, lead_field_hash=lead_field_hash)
+    return index
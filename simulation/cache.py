@@ -0,0 +1,180 @@
+import hashlib
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+from joblib import hash as joblib_hash
+
+
+def _same_params(params, other):
+    # the arrays and lists (e.g. the lead fields) are compared by identity,
+    # the other parameters by value. The parameters which do not change the
+    # decision function are left out
+    if other is None or params.keys() != other.keys():
+        return False
+    for name, value in params.items():
+        other_value = other[name]
+        if name in ('cache', 'chunk_size') or value is other_value:
+            continue
+        if (isinstance(value, (np.ndarray, list, tuple)) or
+                isinstance(other_value, (np.ndarray, list, tuple)) or
+                value != other_value):
+            return False
+    return True
+
+
+class DecisionCache(object):
+    """ Least recently used cache of the decision values of each sample,
+    shared by the copies of an estimator across the folds, scorers and
+    learning curve points of an evaluation.
+
+    The values of a sample are keyed by the parameters of the estimator, the
+    subject of the sample and a hash of its data, so it is only meant for
+    the estimators whose decision function does not depend on what they
+    were fitted on (LeadCorrelate, SparseRegressor, ...). The copies made
+    by sklearn.base.clone share the same cache.
+
+    A cache sent to another process (e.g. with the estimators of the tasks
+    of a process pool) arrives there empty, and all the copies of it
+    received by a process are the same cache: the tasks run by a worker
+    share their decision values.
+
+    Parameters
+    ----------
+    max_bytes : int, memory budget of the cached values in each process,
+        the least recently used samples are evicted beyond it
+
+    Attributes
+    ----------
+    hits, misses : int, number of samples found, and not found, in the cache
+    """
+    # parameters which do not change the decision values
+    _ignored_params = ('cache', 'chunk_size', 'n_jobs')
+
+    def __init__(self, max_bytes=int(1e9)):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = self.misses = 0
+        self._store = OrderedDict()
+        # identifies the copies of this cache in the other processes
+        self._token = uuid.uuid4().hex
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        # unpickled as the copy of this cache in the receiving process
+        return _process_cache, (self._token, self.max_bytes)
+
+    def __len__(self):
+        return len(self._store)
+
+    def clear(self):
+        self._store.clear()
+        self.n_bytes = 0
+
+    def wrap(self, estimator, func, sample_axes=(-2,)):
+        """ cached version of func, which computes the decision values of a
+        block of samples (a DataFrame with 'subject_id' as second to last
+        column)
+
+        Parameters
+        ----------
+        estimator : estimator whose parameters identify the values
+        func : callable, DataFrame -> array, or tuple of arrays
+        sample_axes : tuple of int, axis of the samples in each output of
+            func. With a single axis, func returns a single array
+
+        Returns
+        -------
+        cached_func : callable, with the same outputs as func, which calls
+            func only on the samples missing from the cache
+        """
+        def cached_func(X):
+            params = self._params_key(estimator)
+            keys = [(params, subject, digest) for subject, digest in
+                    zip(X['subject_id'].values, _row_digests(X))]
+            values = {}
+            for key in keys:
+                if key in self._store and key not in values:
+                    self._store.move_to_end(key)
+                    values[key] = self._store[key]
+            missing = [idx for idx, key in enumerate(keys)
+                       if key not in values]
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+
+            if missing:
+                outputs = func(X.iloc[missing])
+                if len(sample_axes) == 1:
+                    outputs = (outputs,)
+                for row, idx in enumerate(missing):
+                    value = tuple(np.take(output, row, axis=axis)
+                                  for output, axis in zip(outputs,
+                                                          sample_axes))
+                    values[keys[idx]] = value
+                    self._add(keys[idx], value)
+
+            outputs = tuple(
+                np.stack([values[key][out_idx] for key in keys], axis=axis)
+                for out_idx, axis in enumerate(sample_axes))
+            return outputs[0] if len(sample_axes) == 1 else outputs
+
+        return cached_func
+
+    def _params_key(self, estimator):
+        # hashing the parameters (e.g. the lead fields) is only done again
+        # when they changed since the last call on this estimator, not for
+        # every block of samples
+        all_params = estimator.get_params(deep=True)
+        last = estimator.__dict__.get('_cache_params_key')
+        if last is not None and _same_params(all_params, last[0]):
+            return last[1]
+        # the nested estimators (e.g. the model of SparseRegressor) by their
+        # parameters only, not their fitted attributes
+        params = {}
+        for name, value in all_params.items():
+            if name.split('__')[-1] in self._ignored_params:
+                continue
+            if hasattr(value, 'get_params'):
+                value = type(value).__name__
+            params[name] = value
+        key = type(estimator).__name__, joblib_hash(params)
+        estimator.__dict__['_cache_params_key'] = all_params, key
+        return key
+
+    def _add(self, key, value):
+        if key in self._store:
+            return
+        n_bytes = sum(part.nbytes for part in value) + 200
+        self._store[key] = value
+        self.n_bytes += n_bytes
+        while self.n_bytes > self.max_bytes and self._store:
+            _, evicted = self._store.popitem(last=False)
+            self.n_bytes -= sum(part.nbytes for part in evicted) + 200
+
+
+# the copies of the caches received by this process, by token, at most
+# _MAX_PROCESS_CACHES of them are kept (the most recently received)
+_process_caches = OrderedDict()
+_MAX_PROCESS_CACHES = 4
+
+
+def _process_cache(token, max_bytes):
+    cache = _process_caches.get(token)
+    if cache is None:
+        cache = DecisionCache(max_bytes)
+        cache._token = token
+        _process_caches[token] = cache
+        while len(_process_caches) > _MAX_PROCESS_CACHES:
+            _process_caches.popitem(last=False)
+    _process_caches.move_to_end(token)
+    return cache
+
+
+def _row_digests(X):
+    # hash of the sensor values of each sample, without 'subject' and
+    # 'subject_id'
+    data = np.ascontiguousarray(X.iloc[:, :-2].values, dtype=np.float64)
+    return [hashlib.blake2b(row.tobytes(), digest_size=16).digest()
+            for row in data]
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+
+def iter_row_chunks(X, chunk_size):
+    """ yields the consecutive blocks of at most chunk_size rows of X
+
+    Parameters
+    ----------
+    X : DataFrame, or iterable of DataFrames, e.g. the reader returned by
+        pd.read_csv(..., chunksize=...), whose frames are split again into
+        blocks of at most chunk_size rows
+    chunk_size : int
+    """
+    if isinstance(X, pd.DataFrame):
+        for start in range(0, len(X), chunk_size):
+            yield X.iloc[start:start + chunk_size]
+    else:
+        for frame in X:
+            for block in iter_row_chunks(frame, chunk_size):
+                yield block
+
+
+def stream_rows(func, X, chunk_size, out=None):
+    """ applies func to the row blocks of X and puts the results together
+    along their sample axis, the second to last one
+
+    Only one block of X and its result are in memory at a time, besides the
+    output.
+
+    Parameters
+    ----------
+    func : callable, DataFrame of n rows -> array of shape (..., n, n_out)
+    X : DataFrame or iterable of DataFrames, see iter_row_chunks
+    chunk_size : int, number of rows of the blocks
+    out : array, shape (..., n_samples, n_out), optional
+        where to write the results, e.g. a numpy.memmap to keep them on disk.
+        Without it the output is allocated in memory
+
+    Returns
+    -------
+    out : array, shape (..., n_samples, n_out)
+        if X has no samples, out must be given: the shape of the results of
+        func is not known without them and a ValueError is raised
+    """
+    results = []
+    start = 0
+    for block in iter_row_chunks(X, chunk_size):
+        result = func(block)
+        stop = start + result.shape[-2]
+        if out is None and isinstance(X, pd.DataFrame):
+            # the number of samples is known, no need to keep the blocks
+            out = np.empty(result.shape[:-2] + (len(X), result.shape[-1]),
+                           dtype=result.dtype)
+        if out is not None:
+            out[..., start:stop, :] = result
+        else:
+            results.append(result)
+        start = stop
+    if out is None:
+        if not results:
+            raise ValueError('X has no samples')
+        out = np.concatenate(results, axis=-2)
+    elif start != out.shape[-2]:
+        raise ValueError('out has {} samples, X has {}'.format(
+                         out.shape[-2], start))
+    return out
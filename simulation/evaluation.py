@@ -0,0 +1,152 @@
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed, dump, effective_n_jobs, load
+from joblib import parallel_backend
+
+from sklearn.base import clone
+from sklearn.metrics import hamming_loss
+from sklearn.model_selection import train_test_split
+
+
+class SharedData(object):
+    """ X and y dumped to memory mapped files, which are shared by the
+    processes of an evaluation instead of being copied to each task.
+
+    Parameters
+    ----------
+    X : DataFrame, sensors, 'subject_id' and 'subject' columns
+    y : array, shape (n_samples, n_parcels)
+    folder : string, directory of the memory mapped files
+    """
+    def __init__(self, X, y, folder):
+        self.columns = X.columns
+        dump(np.ascontiguousarray(X.iloc[:, :-2].values, dtype=np.float64),
+             os.path.join(folder, 'X.pkl'))
+        dump(np.asarray(y), os.path.join(folder, 'y.pkl'))
+        self.values = load(os.path.join(folder, 'X.pkl'), mmap_mode='r')
+        self.y = load(os.path.join(folder, 'y.pkl'), mmap_mode='r')
+        self.subject_id = X['subject_id'].values
+        self.subject = X['subject'].values
+
+    def frame(self, rows):
+        """ the samples rows of X, as a DataFrame """
+        X = pd.DataFrame(self.values[rows], columns=self.columns[:-2])
+        X['subject_id'] = self.subject_id[rows]
+        X['subject'] = self.subject[rows]
+        return X
+
+
+def _learning_curve_task(model, model_name, fold, train, test,
+                         n_samples_train, data):
+    # the tasks run by a process share the copy of the DecisionCache of the
+    # model it received
+    start = time.time()
+    cache = getattr(model, 'cache', None)
+    hits = cache.hits if cache is not None else 0
+    train = train[:n_samples_train]
+    # for test use either all test samples or n_samples_train
+    test = test[:min(len(test), n_samples_train)]
+    model = clone(model).fit(data.frame(train), data.y[train])
+    y_pred = model.predict(data.frame(test))
+    return {'n_samples_train': n_samples_train,
+            'score_test': hamming_loss(data.y[test], y_pred),
+            'model_name': model_name, 'model': str(model), 'fold': fold,
+            'wall_time': time.time() - start,
+            'cache_hits': (cache.hits if cache is not None else 0) - hits}
+
+
+def _predict_task(model, train, test, data):
+    model = clone(model).fit(data.frame(train), data.y[train])
+    return model.predict(data.frame(test))
+
+
+def run_tasks(func, task_args, X, y, n_jobs=1, n_threads=None):
+    """ runs func(*args, data) for each args of task_args on a process pool
+
+    X and y are memory mapped, as are the arrays of the arguments above
+    1MB (e.g. the lead fields of the models), so that the tasks share them.
+    The BLAS threads are divided between the processes, n_threads per
+    process, by default the number of CPUs divided by the number of
+    processes.
+    """
+    n_jobs = min(effective_n_jobs(n_jobs), len(task_args))
+    if n_threads is None:
+        n_threads = max(1, os.cpu_count() // n_jobs)
+    folder = tempfile.mkdtemp(prefix='evaluation_')
+    try:
+        data = SharedData(X, y, folder)
+        with parallel_backend('loky', inner_max_num_threads=n_threads):
+            results = Parallel(n_jobs=n_jobs, max_nbytes='1M',
+                               temp_folder=folder)(
+                delayed(func)(*args, data=data) for args in task_args)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+def run_learning_curves(X, y, models, n_samples_grid='auto', folds=None,
+                        n_jobs=1, n_threads=None):
+    """ learning curves of the models, with one task per model, grid point
+    and fold run on a process pool
+
+    The tasks of the models with a DecisionCache (see simulation.cache)
+    which are run by the same process share the copy of the cache of that
+    process, which starts empty.
+
+    Parameters
+    ----------
+    X : DataFrame, sensors, 'subject_id' and 'subject' columns
+    y : array, shape (n_samples, n_parcels)
+    models : dict, name -> estimator
+    n_samples_grid : list of int | 'auto', numbers of training samples
+    folds : list of (train, test) arrays of indices, optional, by default
+        the single split of train_test_split(test_size=0.2,
+        random_state=42). The first n_samples_train samples of train are
+        used for training
+    n_jobs : int, number of processes
+    n_threads : int, optional, number of BLAS threads of each process
+
+    Returns
+    -------
+    scores_all : DataFrame, with the columns n_samples_train, score_test
+        (hamming loss), n_parcels, max_sources, model_name, model, fold,
+        wall_time and cache_hits (number of test and train samples whose
+        decision values were found in the cache) of each point
+    """
+    if folds is None:
+        folds = [train_test_split(np.arange(len(X)), test_size=0.2,
+                                  random_state=42)]
+    if n_samples_grid == 'auto':
+        n_samples_grid = np.logspace(1, np.log10(len(folds[0][0])),
+                                     num=10, base=10, dtype='int')
+    task_args = [(model, name, fold, train, test, n_samples_train)
+                 for name, model in models.items()
+                 for fold, (train, test) in enumerate(folds)
+                 for n_samples_train in n_samples_grid]
+    scores_all = pd.DataFrame(run_tasks(_learning_curve_task, task_args, X,
+                                        y, n_jobs=n_jobs,
+                                        n_threads=n_threads))
+    scores_all['n_parcels'] = int(y.shape[1])
+    scores_all['max_sources'] = int(y[folds[0][0]].sum(axis=1).max())
+    return scores_all[['n_samples_train', 'score_test', 'n_parcels',
+                       'max_sources', 'model_name', 'model', 'fold',
+                       'wall_time', 'cache_hits']]
+
+
+def run_predictions(X, y, models, train, test, n_jobs=1, n_threads=None):
+    """ predictions on the samples test of each model fitted on the samples
+    train, one task per model run on a process pool
+
+    Returns
+    -------
+    y_pred : dict, name -> array of shape (len(test), n_parcels)
+    """
+    task_args = [(model, train, test) for model in models.values()]
+    y_preds = run_tasks(_predict_task, task_args, X, y, n_jobs=n_jobs,
+                        n_threads=n_threads)
+    return dict(zip(models, y_preds))
@@ -0,0 +1,177 @@
+import re
+
+import numpy as np
+from scipy import linalg
+
+from simulation.lead_correlate import LeadCorrelate
+from simulation.leadfield import compress_leadfield
+from simulation.parcel_index import ParcelIndex
+
+
+def coarse_parcels(parcel_names):
+    """ parent of each parcel of a subdivided parcellation, e.g. the aparc
+    parcel 'superiorfrontal-lh' of the aparc_sub parcels
+    'superiorfrontal_1-lh', 'superiorfrontal_2-lh', ...
+
+    Parameters
+    ----------
+    parcel_names : list of string, names of the parcels, the parcels without
+        a '_<n>' suffix are their own parent
+
+    Returns
+    -------
+    parents : array of int, shape (n_parcels,), parent of each parcel, from
+        1 to n_parents
+    parent_names : array of string, shape (n_parents,)
+    """
+    names = [re.sub(r'_\d+(-[lr]h)?$', r'\1', name) for name in parcel_names]
+    parent_names, parents = np.unique(names, return_inverse=True)
+    return parents + 1, parent_names
+
+
+class _Level(object):
+    # scores of the parcels of one level of the hierarchy, computed for each
+    # sample only from the columns of the parents it was refined in
+    def __init__(self, dictionary, column_parcels, column_parents, n_parcels,
+                 subspace):
+        self.dictionary = dictionary
+        self.n_parcels = n_parcels
+        self.subspace = subspace
+        self.blocks = []
+        for parent in np.unique(column_parents):
+            columns = np.flatnonzero((column_parents == parent) &
+                                     (column_parcels > 0))
+            self.blocks.append((parent, columns, ParcelIndex(
+                column_parcels[columns], n_parcels)))
+
+    def score(self, data, candidates=None):
+        scores = np.zeros((len(data), self.n_parcels))
+        for parent, columns, parcel_index in self.blocks:
+            if candidates is None:
+                rows = slice(None)
+            else:
+                rows = np.flatnonzero(candidates[:, parent - 1])
+                if not len(rows):
+                    continue
+            projection = data[rows] @ self.dictionary[:, columns]
+            # the parcels of the different blocks are disjoint
+            if self.subspace:
+                scores[rows] += np.sqrt(parcel_index.reduce(
+                    projection ** 2, how='sum'))
+            else:
+                scores[rows] += parcel_index.reduce(np.abs(projection))
+        return scores
+
+
+class CoarseToFine(LeadCorrelate):
+    """ LeadCorrelate searching the parcels from coarse to fine.
+
+    The parent regions of the coarsest level are scored first, by the norm
+    of the projection of the sample on the subspace of their lead field.
+    Only the children of the n_candidates best parents are scored at the
+    next level, down to the sources of the parcels, scored by their
+    correlation as in LeadCorrelate. The parcels which are not refined have
+    a score of 0.
+
+    Parameters
+    ----------
+    lead_field : list of arrays, shape (n_electrodes, n_sources), lead
+        field of each subject
+    parcel_indices_leadfield : list of arrays of int, shape (n_sources,),
+        parcel of each source of each subject
+    parents : list of arrays of int, parent of each parcel at each level of
+        the hierarchy, from the finest: parents[0] has shape (n_parcels,)
+        and gives the parent (from 1) of each parcel, parents[1] the parent
+        of each of these parents, ... see coarse_parcels
+    n_candidates : int, number of regions refined at each level
+    explained_variance : float, fraction of the variance of the lead field
+        of each region kept in its subspace, see
+        simulation.leadfield.compress_leadfield
+    chunk_size : int, number of samples processed at once by
+        decision_function and predict
+    cache : DecisionCache, optional, see LeadCorrelate
+    """
+    def __init__(self, lead_field, parcel_indices_leadfield, parents,
+                 n_candidates=3, explained_variance=.95, chunk_size=1000,
+                 cache=None):
+        self.lead_field = lead_field
+        self.parcel_indices_leadfield = parcel_indices_leadfield
+        self.parents = parents
+        self.n_candidates = n_candidates
+        self.explained_variance = explained_variance
+        self.chunk_size = chunk_size
+        self.cache = cache
+
+    def _decision_block(self, X):
+        self._prepare()
+        subject_ids = X['subject_id'].values
+        # remove 'subject' and 'subject_id' and normalize each sample to
+        # take correlations
+        data = np.array(X.iloc[:, :-2].values, dtype=np.float64)
+        data /= linalg.norm(data, axis=1)[:, None]
+
+        decision = np.empty((len(X), self.n_parcels_))
+        for subj_idx in np.unique(subject_ids):
+            rows = np.flatnonzero(subject_ids == subj_idx)
+            scores = None
+            for level in self.levels_[subj_idx]:
+                candidates = (None if scores is None else
+                              self._top_candidates(scores))
+                scores = level.score(data[rows], candidates)
+            decision[rows] = scores
+        return decision
+
+    def _top_candidates(self, scores):
+        candidates = np.ones(scores.shape, dtype=bool)
+        if self.n_candidates < scores.shape[1]:
+            top = np.argpartition(-scores, self.n_candidates - 1,
+                                  axis=1)[:, :self.n_candidates]
+            candidates[...] = False
+            candidates[np.arange(len(scores))[:, None], top] = True
+        return candidates
+
+    def _build_state(self):
+        # the subspaces of the regions of each subject, computed at fit or
+        # at the first decision_function
+        self.n_parcels_ = max(max(s) for s in self.parcel_indices_leadfield)
+        self.levels_ = [self._make_levels(lead_field, parcel_indices)
+                        for lead_field, parcel_indices in
+                        zip(self.lead_field, self.parcel_indices_leadfield)]
+
+    def _make_levels(self, lead_field, parcel_indices):
+        # parcel of each source at each level, from the finest
+        lead_field = np.asarray(lead_field, dtype=np.float64)
+        source_parcels = [np.asarray(parcel_indices)]
+        for parents in self.parents:
+            parents = np.concatenate([[0], parents])
+            source_parcels.append(parents[source_parcels[-1]])
+        # the top level has a single parent, all the regions
+        source_parcels.append(np.ones(len(parcel_indices), dtype=int))
+
+        levels = []
+        for depth in range(len(source_parcels) - 2, -1, -1):
+            n_parcels = (self.n_parcels_ if depth == 0 else
+                         max(self.parents[depth - 1]))
+            if depth == 0:
+                # the sources of the parcels, as in LeadCorrelate
+                dictionary = lead_field / linalg.norm(lead_field, axis=0)
+                column_parcels = source_parcels[0]
+                column_parents = source_parcels[1]
+            else:
+                # orthonormal basis of the lead field of each region
+                dictionary, column_parcels = compress_leadfield(
+                    lead_field, source_parcels[depth],
+                    self.explained_variance)
+                dictionary /= linalg.norm(dictionary, axis=0)
+                column_parents = np.concatenate(
+                    [[0], self._parents_at(depth)])[column_parcels]
+            levels.append(_Level(dictionary, column_parcels, column_parents,
+                                 n_parcels, subspace=depth > 0))
+        return levels
+
+    def _parents_at(self, depth):
+        # parent of each region of the level depth, all the regions of the
+        # coarsest level have the same parent
+        if depth < len(self.parents):
+            return np.asarray(self.parents[depth])
+        return np.ones(max(self.parents[depth - 1]), dtype=int)
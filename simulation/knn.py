@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.decomposition import PCA
+from sklearn.neighbors import NearestNeighbors
+from sklearn.utils.validation import check_is_fitted
+
+from simulation.chunking import stream_rows
+
+
+def _features(X):
+    # the columns of X without the name of the subject: the sensors and
+    # subject_id, as given to KNeighborsClassifier before
+    if isinstance(X, pd.DataFrame):
+        X = X.loc[:, X.columns != 'subject']
+    return np.asarray(X, dtype=np.float64)
+
+
+class MultilabelKNN(BaseEstimator, ClassifierMixin):
+    """ k nearest neighbours classifier of all the parcels at once.
+
+    A single neighbour index is built on the training samples and each
+    sample is queried once, the parcels are then voted from the sparse
+    targets of its neighbours: a parcel is predicted when it is active in
+    more than half of them. This is the prediction of
+    MultiOutputClassifier(KNeighborsClassifier(n_neighbors)), without one
+    index and one query per parcel.
+
+    The features are the columns of X but 'subject': the sensors and
+    'subject_id'.
+
+    Parameters
+    ----------
+    n_neighbors : int
+    algorithm : 'auto' | 'ball_tree' | 'kd_tree' | 'brute', see
+        sklearn.neighbors.NearestNeighbors
+    normalize : bool, if True the samples are scaled to unit norm, the
+        neighbours are then the most correlated samples
+    n_components : int, optional, if given the neighbours are searched in
+        the space of the first principal components of the training samples
+    chunk_size : int, number of samples queried at once by predict and
+        decision_function
+    n_jobs : int, number of jobs of the neighbour queries
+    """
+    def __init__(self, n_neighbors=3, algorithm='auto', normalize=False,
+                 n_components=None, chunk_size=1000, n_jobs=None):
+        self.n_neighbors = n_neighbors
+        self.algorithm = algorithm
+        self.normalize = normalize
+        self.n_components = n_components
+        self.chunk_size = chunk_size
+        self.n_jobs = n_jobs
+
+    def fit(self, X, y):
+        data = self._transform(_features(X), fit=True)
+        self.y_ = sparse.csr_matrix(y, dtype=np.int64)
+        self.neighbors_ = NearestNeighbors(
+            n_neighbors=self.n_neighbors, algorithm=self.algorithm,
+            n_jobs=self.n_jobs).fit(data)
+        return self
+
+    def _transform(self, data, fit=False):
+        if self.normalize:
+            data = data / np.linalg.norm(data, axis=1)[:, None]
+        if self.n_components is None:
+            return data
+        if fit:
+            self.pca_ = PCA(n_components=self.n_components).fit(data)
+        return self.pca_.transform(data)
+
+    def _votes(self, X):
+        # number of neighbours of each sample in which each parcel is active
+        check_is_fitted(self, 'neighbors_')
+        neighbors = self.neighbors_.kneighbors(
+            self._transform(_features(X)), return_distance=False)
+        n_samples = len(neighbors)
+        selection = sparse.csr_matrix(
+            (np.ones(neighbors.size, dtype=np.int64), neighbors.ravel(),
+             np.arange(0, neighbors.size + 1, self.n_neighbors)),
+            shape=(n_samples, self.y_.shape[0]))
+        return (selection @ self.y_).toarray()
+
+    def predict(self, X):
+        def predict_block(X_block):
+            return (2 * self._votes(X_block) > self.n_neighbors).astype(int)
+
+        return stream_rows(predict_block, X, self.chunk_size)
+
+    def decision_function(self, X, out=None):
+        """ fraction of the neighbours of each sample in which each parcel is
+        active, array of shape (n_samples, n_parcels) """
+        def decision_block(X_block):
+            return self._votes(X_block) / self.n_neighbors
+
+        return stream_rows(decision_block, X, self.chunk_size, out)
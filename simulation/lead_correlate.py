@@ -1,5 +1,4 @@
 import numpy as np
-import pandas as pd
 from scipy import linalg
 
 from sklearn.base import BaseEstimator, ClassifierMixin, TransformerMixin
@@ -7,20 +6,56 @@ from sklearn.base import BaseEstimator, ClassifierMixin, TransformerMixin
 from sklearn.utils.validation import check_is_fitted
 
 import simulation.metrics as met
+from simulation.ann import LeadfieldIndex
+from simulation.cache import _same_params
+from simulation.chunking import stream_rows
+from simulation.leadfield import compress_leadfield
+from simulation.parcel_index import ParcelIndex
 
 
 class LeadCorrelate(BaseEstimator, ClassifierMixin, TransformerMixin):
     """
     Parameters
     ----------
+    lead_field : list of arrays, shape (n_electrodes, n_sources), lead
+        field of each subject
+    parcel_indices_leadfield : list of arrays of int, shape (n_sources,),
+        parcel of each source of each subject
+    chunk_size : int, number of samples processed at once by
+        decision_function and predict
+    compression : float, optional, if given the correlations are taken
+        with the lead field compressed to a few atoms per parcel explaining
+        this fraction of its variance, see
+        simulation.leadfield.compress_leadfield
+    n_probe : int, optional, if given the correlations are only computed
+        with the sources of the n_probe lists of an approximate nearest
+        neighbour index of each lead field closest to each sample, see
+        simulation.ann.LeadfieldIndex. The parcels without any of these
+        sources get a correlation of 0
+    indexes : list of LeadfieldIndex, optional, index of each subject used
+        with n_probe, e.g. read with simulation.ann.get_leadfield_index. The
+        copies made by sklearn.base.clone share them. By default they are
+        built at fit by each copy. They are built on the lead fields which
+        are not compressed, and cannot be given with compression
+    cache : DecisionCache, optional, where the correlations of each sample
+        are kept, to compute them only once across the copies of the
+        estimator made by an evaluation
     """
-    def __init__(self, lead_field, parcel_indices_leadfield):
+    def __init__(self, lead_field, parcel_indices_leadfield,
+                 chunk_size=1000, compression=None, n_probe=None,
+                 indexes=None, cache=None):
         self.lead_field = lead_field
         self.parcel_indices_leadfield = parcel_indices_leadfield
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.n_probe = n_probe
+        self.indexes = indexes
+        self.cache = cache
 
     def fit(self, X, y):
         """
         """
+        self._prepare()
         df = self.decision_function(X)
         df = np.array(df)
         assert df.shape == y.shape
@@ -56,32 +91,30 @@ class LeadCorrelate(BaseEstimator, ClassifierMixin, TransformerMixin):
 
             TODO: predict(x): return (lasso.fit(L, x).coef_ != 0).astype(int)
         """
-        n_samples, _ = X.shape
-        y_pred = np.zeros((n_samples, self.n_sources_), dtype=int)
-
         check_is_fitted(self, 'n_sources_')
 
-        corr = self.decision_function(X)
-        corr = np.array(corr)
-
-        # take values higher than threshold
-        corr_poss = corr >= self.threshold_  # boolen
-        # leave only max_active_sources_ parcels
-
-        for idx in range(0, len(corr_poss)):
-            # check if more than 0 and less than max_active_sources_
-            if sum(corr_poss[idx, :]) > self.max_active_sources_:
-                # take only self.max_active_sources_ highest possible corr
-                corr[idx, np.logical_not(corr_poss[idx, :])] = 0
-                y_pred[idx, np.argsort(
-                       corr[idx, :])[-self.max_active_sources_:]] = 1
-            elif sum(corr_poss[idx, :]) < 1:
-                # take a single highest possible corr
-                max_corr_idx = np.argsort(corr[idx, :])[-1]
-                y_pred[idx, max_corr_idx] = 1
-            else:
-                # leave corr as selected by corr_poss
-                y_pred[idx, corr_poss[idx, :]] = 1
+        def predict_block(X_block):
+            return self._predict_scores(self._cached_decision_block(X_block))
+
+        return stream_rows(predict_block, X, self.chunk_size)
+
+    def _predict_scores(self, corr):
+        # the parcels with a correlation above the threshold, at least the
+        # highest one and at most the max_active_sources_ highest ones
+        n_max = self.max_active_sources_
+        corr_poss = corr >= self.threshold_
+        n_poss = corr_poss.sum(axis=1)
+        y_pred = corr_poss.astype(int)
+
+        too_many = np.flatnonzero(n_poss > n_max)
+        if len(too_many):
+            masked = np.where(corr_poss[too_many], corr[too_many], -np.inf)
+            top = np.argpartition(-masked, n_max - 1, axis=1)[:, :n_max]
+            y_pred[too_many] = 0
+            y_pred[too_many[:, None], top] = 1
+
+        none = np.flatnonzero(n_poss < 1)
+        y_pred[none, np.argmax(corr[none], axis=1)] = 1
         return y_pred
 
     def score(self, X, y):
@@ -105,35 +138,80 @@ class LeadCorrelate(BaseEstimator, ClassifierMixin, TransformerMixin):
         """
         return met.afroc_score(y, self.decision_function(X))
 
-    def decision_function(self, X):
+    def decision_function(self, X, out=None):
         """ Computes the correlation of the data with the lead field
         Args:
-            X: data
+            X: data, DataFrame or iterable of DataFrames (see
+                simulation.chunking.iter_row_chunks), processed by blocks of
+                chunk_size samples
+            out: optional array, e.g. a numpy.memmap, where to write the
+                correlations
         Returns:
             decision: correlation of the signal from each parcel with the given
-            data for each sample, dtype = DataFrame
+            data for each sample, array of shape (n_samples, n_parcels)
         """
-        n_samples, _ = X.shape
-        L = self.lead_field
-        # normalize each leadfield column wise
-        L = [l / linalg.norm(l, axis=0) for l in L]
+        return stream_rows(self._cached_decision_block, X, self.chunk_size,
+                           out)
+
+    def _cached_decision_block(self, X):
+        if self.cache is None:
+            return self._decision_block(X)
+        return self.cache.wrap(self, self._decision_block)(X)
+
+    def _decision_block(self, X):
+        self._prepare()
+        subject_ids = X['subject_id'].values
+        # remove 'subject' and 'subject_id' and normalize each sample to
+        # take correlations
+        data = np.array(X.iloc[:, :-2].values, dtype=np.float64)
+        data /= linalg.norm(data, axis=1)[:, None]
+
+        correlation = np.empty((len(X), self.n_parcels_))
+        for subj_idx in np.unique(subject_ids):
+            rows = np.flatnonzero(subject_ids == subj_idx)
+            if self.n_probe is not None:
+                correlation[rows] = self.indexes_[subj_idx].score_parcels(
+                    data[rows], self.n_probe)
+                continue
+            # one product for all the samples of the subject
+            corr = np.abs(data[rows] @ self.lead_field_normalized_[subj_idx])
+            correlation[rows] = self.parcel_indexes_[subj_idx].reduce(corr)
+        return correlation
+
+    def _prepare(self):
+        # the state of the subjects (e.g. their normalized lead fields) is
+        # built at the first fit or decision_function, and again only when
+        # the parameters changed since, e.g. with set_params
+        params = self.get_params()
+        if not _same_params(params, getattr(self, '_state_params', None)):
+            self._build_state()
+            self._state_params = params
+
+    def _build_state(self):
+        # the normalized lead field and the parcel index of each subject
+        if self.indexes is not None and self.compression is not None:
+            raise ValueError('the indexes given are of the lead fields which '
+                             'are not compressed, they cannot be used with '
+                             'compression')
+        lead_fields = self.lead_field
         parcel_indices = self.parcel_indices_leadfield
-
-        for idx in range(n_samples):
-            x = X.iloc[idx]
-            subj_idx = int(x['subject_id'])
-            x = x[:-2]  # remove 'subject' and 'subject_id' from x
-            x = x / linalg.norm(x)  # normalize x to take correlations
-
-            corr = (pd.DataFrame(np.abs(L[subj_idx].T.dot(x)))
-                    .groupby(parcel_indices[subj_idx]).max().transpose())
-            if not idx:
-                correlation = corr
-            else:
-                correlation = correlation.append(corr)
-
-        correlation.index = range(n_samples)
-        # in case 0 index is passed (which is of unused parcels, drop them)
-        if 0 in correlation:
-            correlation = correlation.drop(columns=0)
-        return correlation.values
+        if self.compression is not None:
+            lead_fields, parcel_indices = zip(*[
+                compress_leadfield(lead_field, s, self.compression)
+                for lead_field, s in zip(lead_fields, parcel_indices)])
+        # normalize each leadfield column wise
+        self.lead_field_normalized_ = [
+            lead_field / linalg.norm(lead_field, axis=0)
+            for lead_field in lead_fields]
+        # the sources of index 0 are of unused parcels, they are left out
+        self.n_parcels_ = max(max(s) for s in self.parcel_indices_leadfield)
+        self.parcel_indexes_ = [ParcelIndex(s, self.n_parcels_)
+                                for s in parcel_indices]
+        if self.n_probe is None:
+            self.indexes_ = None
+        elif self.indexes is not None:
+            self.indexes_ = self.indexes
+        else:
+            self.indexes_ = [
+                LeadfieldIndex(lead_field, s, n_parcels=self.n_parcels_)
+                for lead_field, s in zip(lead_fields, parcel_indices)]
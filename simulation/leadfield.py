@@ -0,0 +1,219 @@
+import json
+import os
+
+import numpy as np
+from scipy import linalg
+import mne
+
+
+def compute_leadfield(fwd_fname, parcel_vertices, signal_type='grad'):
+    """ reads the forward solution and reduces it to the lead field of the
+    sources which belong to one of the parcels
+
+    Parameters
+    ----------
+    fwd_fname : string, path to the forward solution
+    parcel_vertices : dict, parcel name ('<idx>-lh' or '<idx>-rh') -> array
+        of the vertices of the parcel
+    signal_type : string, 'eeg', 'meg', 'mag' or 'grad'
+
+    Returns
+    -------
+    lead_field : array, shape (n_electrodes, n_sources)
+    parcel_indices : array of int, shape (n_sources,), parcel of each source
+    src_coords : array, shape (n_sources, 3), position of each source
+    """
+    # reading forward matrix
+    fwd = mne.read_forward_solution(fwd_fname)
+    fwd = mne.convert_forward_solution(fwd, force_fixed=True)
+    lead_field = fwd['sol']['data']
+
+    if signal_type == 'eeg':
+        picks_eeg = mne.pick_types(fwd['info'], meg=False, eeg=True,
+                                   exclude=[])
+        lead_field = lead_field[picks_eeg, :]
+    elif signal_type == 'meg':
+        picks_meg = mne.pick_types(fwd['info'], meg=True, eeg=False,
+                                   exclude=[])
+        lead_field = lead_field[picks_meg, :]
+    elif signal_type == 'mag' or signal_type == 'grad':
+        picks_meg = mne.pick_types(fwd['info'], meg=signal_type,
+                                   eeg=False, exclude=[])
+        lead_field = lead_field[picks_meg, :]
+
+    # FIND VERTICES FOR lead field
+    # now we make a vector of size n_vertices for each surface of cortex
+    # hemisphere and put a int for each vertex that says it which label
+    # it belongs to.
+    parcel_indices_lh = np.zeros(len(fwd['src'][0]['inuse']), dtype=int)
+    parcel_indices_rh = np.zeros(len(fwd['src'][1]['inuse']), dtype=int)
+    for label_name, label_idx in parcel_vertices.items():
+        label_id = int(label_name[:-3])
+        if '-lh' in label_name:
+            parcel_indices_lh[label_idx] = label_id
+        else:
+            parcel_indices_rh[label_idx] = label_id
+
+    # Make sure label numbers different for each hemisphere
+    parcel_indices = np.concatenate((parcel_indices_lh,
+                                    parcel_indices_rh), axis=0)
+
+    # Now pick vertices that are actually used in the forward
+    inuse = np.concatenate((fwd['src'][0]['inuse'],
+                            fwd['src'][1]['inuse']), axis=0)
+    parcel_indices_l = parcel_indices[np.where(inuse)[0]]
+    assert len(parcel_indices_l) == lead_field.shape[1]
+
+    src = fwd['src']
+    src_coords = np.concatenate([src[0]['rr'][src[0]['inuse'] != 0],
+                                 src[1]['rr'][src[1]['inuse'] != 0]], axis=0)
+
+    # CLEAN UP
+    # Remove from parcel_indices and from the leadfield all the indices == 0
+    # (not used by our brain)
+    lead_field = lead_field[:, parcel_indices_l != 0]
+    src_coords = src_coords[parcel_indices_l != 0]
+    parcel_indices_l = parcel_indices_l[parcel_indices_l != 0]
+
+    assert len(parcel_indices_l) == lead_field.shape[1]
+    assert len(np.unique(parcel_indices_l)) == len(parcel_vertices)
+    return lead_field, parcel_indices_l, src_coords
+
+
+def save_leadfield(leadfield_dir, lead_field, parcel_indices, src_coords,
+                   subject, signal_type, parcellation):
+    """ saves the lead field as an uncompressed float32 .npy file which can
+    be memory mapped, next to parcel_indices.npy, src_coords.npy and a
+    info.json describing for which subject, signal type and parcellation it
+    was computed """
+    if not os.path.isdir(leadfield_dir):
+        os.makedirs(leadfield_dir)
+    np.save(os.path.join(leadfield_dir, 'lead_field.npy'),
+            np.asarray(lead_field, dtype=np.float32))
+    np.save(os.path.join(leadfield_dir, 'parcel_indices.npy'), parcel_indices)
+    np.save(os.path.join(leadfield_dir, 'src_coords.npy'), src_coords)
+    # info.json is written last: the lead field is complete only if it exists
+    with open(os.path.join(leadfield_dir, 'info.json'), 'w') as f:
+        json.dump(dict(subject=subject, signal_type=signal_type,
+                       parcellation=parcellation), f)
+
+
+def read_leadfield(leadfield_dir, mmap_mode='r'):
+    """ reads a lead field saved with save_leadfield
+
+    Parameters
+    ----------
+    leadfield_dir : string, directory of the lead field
+    mmap_mode : None | 'r' | 'r+' | 'c', see numpy.load. By default the lead
+        field is memory mapped read only, so that the processes using it share
+        the same pages
+
+    Returns
+    -------
+    leadfield : dict, with lead_field (float32, shape (n_electrodes,
+        n_sources)), parcel_indices, src_coords, subject, signal_type and
+        parcellation
+    """
+    with open(os.path.join(leadfield_dir, 'info.json'), 'r') as f:
+        leadfield = json.load(f)
+    leadfield['lead_field'] = np.load(
+        os.path.join(leadfield_dir, 'lead_field.npy'), mmap_mode=mmap_mode)
+    leadfield['parcel_indices'] = np.load(
+        os.path.join(leadfield_dir, 'parcel_indices.npy'))
+    leadfield['src_coords'] = np.load(
+        os.path.join(leadfield_dir, 'src_coords.npy'))
+    return leadfield
+
+
+def get_leadfield(leadfield_dir, fwd_fname, parcel_vertices, subject,
+                  signal_type, parcellation, mmap_mode='r'):
+    """ reads the lead field from leadfield_dir, computing and saving it
+    first if it was not yet computed for this subject, signal type and
+    parcellation """
+    info_fname = os.path.join(leadfield_dir, 'info.json')
+    key = dict(subject=subject, signal_type=signal_type,
+               parcellation=parcellation)
+    if os.path.exists(info_fname):
+        with open(info_fname, 'r') as f:
+            if json.load(f) == key:
+                return read_leadfield(leadfield_dir, mmap_mode=mmap_mode)
+        os.remove(info_fname)
+
+    lead_field, parcel_indices, src_coords = compute_leadfield(
+        fwd_fname, parcel_vertices, signal_type)
+    save_leadfield(leadfield_dir, lead_field, parcel_indices, src_coords,
+                   **key)
+    return read_leadfield(leadfield_dir, mmap_mode=mmap_mode)
+
+
+def compress_leadfield(lead_field, parcel_indices, explained_variance=.95,
+                       max_rank=None):
+    """ replaces the columns of each parcel by its leading left singular
+    vectors, scaled by their singular values
+
+    Only the activity of the parcels is predicted, and the columns of a
+    parcel are strongly correlated: a few atoms per parcel explain most of
+    the variance of its lead field, which shrinks the problems of the
+    solvers by the ratio of the number of sources to the number of atoms.
+
+    Parameters
+    ----------
+    lead_field : array, shape (n_electrodes, n_sources)
+    parcel_indices : array of int, shape (n_sources,), parcel of each
+        source, the sources of parcel 0 are left out
+    explained_variance : float, in (0, 1], the rank of each parcel is the
+        smallest one explaining this fraction of the squared Frobenius norm
+        of its columns
+    max_rank : int, optional, upper bound of the rank of each parcel
+
+    Returns
+    -------
+    atoms : array, shape (n_electrodes, n_atoms)
+    atom_parcels : array of int, shape (n_atoms,), parcel of each atom,
+        used in place of parcel_indices with the atoms
+    """
+    lead_field = np.asarray(lead_field, dtype=np.float64)
+    parcel_indices = np.asarray(parcel_indices)
+    atoms, atom_parcels = [], []
+    for parcel in np.unique(parcel_indices[parcel_indices > 0]):
+        u, s, _ = linalg.svd(lead_field[:, parcel_indices == parcel],
+                             full_matrices=False)
+        ratio = np.cumsum(s ** 2) / np.sum(s ** 2)
+        rank = min(np.searchsorted(ratio, explained_variance - 1e-12) + 1,
+                   len(s))
+        if max_rank is not None:
+            rank = min(rank, max_rank)
+        atoms.append(u[:, :rank] * s[:rank])
+        atom_parcels.append(np.full(rank, parcel))
+    return np.hstack(atoms), np.concatenate(atom_parcels)
+
+
+class LeadfieldOperator(object):
+    """ Lead field of a subject prepared for the solvers: columns normalized
+    to unit norm, the norms to scale the estimates back and the Gram matrix
+    of the normalized lead field.
+
+    The Gram matrix is computed only when first used, it takes
+    n_sources ** 2 floats.
+
+    Parameters
+    ----------
+    lead_field : array, shape (n_electrodes, n_sources)
+    """
+    def __init__(self, lead_field):
+        lead_field = np.asarray(lead_field, dtype=np.float64)
+        self.norms = np.linalg.norm(lead_field, axis=0)
+        # Fortran ordered: the coordinate descent solver reads by columns
+        self.lead_field = np.asfortranarray(lead_field / self.norms[None, :])
+        self._gram = None
+
+    @property
+    def shape(self):
+        return self.lead_field.shape
+
+    @property
+    def gram(self):
+        """ L.T @ L of the normalized lead field """
+        if self._gram is None:
+            self._gram = self.lead_field.T @ self.lead_field
+        return self._gram
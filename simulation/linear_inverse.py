@@ -0,0 +1,143 @@
+import numpy as np
+from scipy import linalg
+
+from simulation.lead_correlate import LeadCorrelate
+from simulation.parcel_index import ParcelIndex
+
+
+def compute_whitener(noise_cov, rank_tol=1e-10):
+    """ inverse square root of the noise covariance, the eigenvalues below
+    rank_tol times the largest one are left out
+
+    Parameters
+    ----------
+    noise_cov : array, shape (n_electrodes, n_electrodes)
+
+    Returns
+    -------
+    whitener : array, shape (n_electrodes, n_electrodes)
+    """
+    eigvals, eigvecs = linalg.eigh(noise_cov)
+    keep = eigvals > rank_tol * eigvals.max()
+    inv_sqrt = np.zeros_like(eigvals)
+    inv_sqrt[keep] = 1. / np.sqrt(eigvals[keep])
+    return (eigvecs * inv_sqrt) @ eigvecs.T
+
+
+def compute_inverse_kernel(lead_field, snr=3., depth=.8, method='MNE',
+                           whitener=None):
+    """ regularized minimum norm inverse operator of a lead field
+
+    The source covariance is the depth weighting (||l_j|| ** 2) ** -depth
+    of each source, scaled so that the whitened data have a unit average
+    variance, and the regularization is lambda2 = 1 / snr ** 2 as in MNE.
+
+    Parameters
+    ----------
+    lead_field : array, shape (n_electrodes, n_sources)
+    snr : float, assumed signal to noise ratio of the data
+    depth : float | None, exponent of the depth weighting, None or 0 for no
+        depth weighting
+    method : 'MNE' | 'dSPM', with dSPM each source is normalized by its
+        noise level
+    whitener : array, shape (n_electrodes, n_electrodes), optional, see
+        compute_whitener
+
+    Returns
+    -------
+    kernel : array, shape (n_electrodes, n_sources), the estimates of the
+        sources of the samples X (n_samples, n_electrodes) are X @ kernel
+    """
+    if method not in ('MNE', 'dSPM'):
+        raise ValueError("method must be 'MNE' or 'dSPM', got %r"
+                         % (method,))
+    gain = np.asarray(lead_field, dtype=np.float64)
+    if whitener is not None:
+        gain = whitener @ gain
+    n_electrodes = gain.shape[0]
+
+    if depth:
+        source_cov = np.sum(gain ** 2, axis=0) ** -depth
+    else:
+        source_cov = np.ones(gain.shape[1])
+    gain_cov = (gain * source_cov) @ gain.T
+    source_cov /= np.trace(gain_cov) / n_electrodes
+    gain_cov *= n_electrodes / np.trace(gain_cov)
+    gain_cov.flat[::n_electrodes + 1] += 1. / snr ** 2
+
+    # kernel of the whitened data, R G^T (G R G^T + lambda2 I)^-1
+    kernel = linalg.solve(gain_cov, gain, assume_a='pos') * source_cov
+    if method == 'dSPM':
+        # the whitened noise is white, its variance on each source is the
+        # squared norm of the source kernel
+        kernel /= linalg.norm(kernel, axis=0)
+    if whitener is not None:
+        kernel = whitener.T @ kernel
+    return kernel
+
+
+class LinearInverse(LeadCorrelate):
+    """ Minimum norm (MNE or dSPM) estimate of the sources, with one
+    precomputed linear kernel per subject.
+
+    The kernels are computed at fit, the decision function of a block of
+    samples is then one matrix product per subject followed by the max of
+    the absolute estimates over the sources of each parcel. The thresholds
+    of predict are fitted as in LeadCorrelate.
+
+    Parameters
+    ----------
+    lead_field : list of arrays, shape (n_electrodes, n_sources), lead
+        field of each subject
+    parcel_indices_leadfield : list of arrays of int, shape (n_sources,),
+        parcel of each source of each subject
+    method : 'MNE' | 'dSPM'
+    snr : float, assumed signal to noise ratio, the regularization is
+        1 / snr ** 2
+    depth : float | None, exponent of the depth weighting
+    noise_cov : array, shape (n_electrodes, n_electrodes), or list of such
+        arrays, one per subject, optional, covariance of the sensor noise
+        used to whiten the data. By default the noise is white
+    chunk_size : int, number of samples processed at once by
+        decision_function and predict
+    cache : DecisionCache, optional, see LeadCorrelate
+    """
+    def __init__(self, lead_field, parcel_indices_leadfield, method='dSPM',
+                 snr=3., depth=.8, noise_cov=None, chunk_size=1000,
+                 cache=None):
+        self.lead_field = lead_field
+        self.parcel_indices_leadfield = parcel_indices_leadfield
+        self.method = method
+        self.snr = snr
+        self.depth = depth
+        self.noise_cov = noise_cov
+        self.chunk_size = chunk_size
+        self.cache = cache
+
+    def _decision_block(self, X):
+        self._prepare()
+        subject_ids = X['subject_id'].values
+        # remove 'subject' and 'subject_id'
+        data = np.asarray(X.iloc[:, :-2].values, dtype=np.float64)
+
+        decision = np.empty((len(X), self.n_parcels_))
+        for subj_idx in np.unique(subject_ids):
+            rows = np.flatnonzero(subject_ids == subj_idx)
+            estimates = np.abs(data[rows] @ self.kernels_[subj_idx])
+            decision[rows] = self.parcel_indexes_[subj_idx].reduce(estimates)
+        return decision
+
+    def _build_state(self):
+        # the kernels, computed at fit or at the first decision_function
+        noise_cov = self.noise_cov
+        if noise_cov is None or np.ndim(noise_cov) == 2:
+            noise_cov = [noise_cov] * len(self.lead_field)
+        self.kernels_ = []
+        for lead_field, cov in zip(self.lead_field, noise_cov):
+            whitener = None if cov is None else compute_whitener(cov)
+            self.kernels_.append(compute_inverse_kernel(
+                lead_field, snr=self.snr, depth=self.depth,
+                method=self.method, whitener=whitener))
+        self.n_parcels_ = max(max(s) for s in self.parcel_indices_leadfield)
+        self.parcel_indexes_ = [ParcelIndex(s, self.n_parcels_)
+                                for s in self.parcel_indices_leadfield]
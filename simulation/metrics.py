@@ -54,11 +54,9 @@ def calc_froc(y_true, y_score):
         false positive: False positive rate divided by length of
         y_true
     thresholds : array, shape = [>2]
-        Thresholds on y_score used to compute ts and tfp.
-        *Note*: Since the thresholds are sorted from low to high values,
-        they are reversed upon returning them to ensure they
-        correspond to both fpr and tpr, which are sorted in reversed order
-        during their calculation.
+        Distinct values of y_score, from the highest to the lowest, used
+        as thresholds to compute ts and tfp: all the samples with a score
+        above or equal to a threshold are positive.
 
     References
     ----------
@@ -69,41 +67,36 @@ def calc_froc(y_true, y_score):
     n_samples, n_sources = y_true.shape
     classes = np.unique(y_true)
 
-    n_pos = float(np.sum(y_true == classes[1]))  # nb of true positive
-
-    y_true = np.ravel(y_true)
-    y_score = np.ravel(y_score)
-
     # FROC only for binary classification
     if classes.shape[0] != 2:
         raise ValueError("FROC is defined for binary classification only")
 
-    thresholds, indicesList = np.unique(y_score, return_index=True)
+    y_true = np.ravel(y_true) == classes[1]
+    n_pos = float(np.sum(y_true))  # nb of true positive
+
+    tps, fps, thresholds = _froc_counts(y_true, np.ravel(y_score))
 
     # sensitivity: true positive normalized by sum of all true
     # positives
-    ts = np.zeros(thresholds.size, dtype=np.float)
+    ts = tps / n_pos
     # false positive: False positives rate divided by length of y_true
-    tfp = np.zeros(thresholds.size, dtype=np.float)
-
-    idx = 0
-
-    signal = np.c_[y_score, y_true]
-    # take only those values which are unique at y_score
-    sorted_signal = signal[indicesList, :][::-1]
-    for score, value in sorted_signal:
-        t_est = sorted_signal[:, 0] >= score
+    tfp = fps / n_samples
+    return ts, tfp, thresholds
 
-        tps, _, fps, _ = get_true_false(sorted_signal[:, 1], t_est)
 
-        ts[idx] = tps
-        tfp[idx] = fps
+def _froc_counts(y_true, y_score):
+    # numbers of true and false positives of each distinct threshold, from
+    # the highest to the lowest, with one sort and a cumulative sum: the
+    # samples are sorted by decreasing score, and the threshold of a score
+    # is counted after its last tied sample
+    order = np.argsort(y_score, kind='mergesort')[::-1]
+    y_score = y_score[order]
+    y_true = y_true[order]
 
-        idx += 1
-
-    tfp = tfp / n_samples
-    ts = ts / n_pos
-    return ts, tfp, thresholds[::-1]
+    threshold_idx = np.r_[np.flatnonzero(np.diff(y_score)), y_score.size - 1]
+    tps = np.cumsum(y_true, dtype=np.int64)[threshold_idx]
+    fps = threshold_idx + 1 - tps
+    return tps, fps, y_score[threshold_idx]
 
 
 def emd_score_subjects(subjects, y_true, y_pred, data_dir):
@@ -173,11 +166,9 @@ def calc_afroc(y_true, y_score):
     fpf : array
         false positive fraction
     thresholds : array, shape = [>2]
-        Thresholds on y_score used to compute ts and tfp.
-        *Note*: Since the thresholds are sorted from low to high values,
-        they are reversed upon returning them to ensure they
-        correspond to both fpr and tpr, which are sorted in reversed order
-        during their calculation.
+        Distinct values of y_score, from the highest to the lowest, used
+        as thresholds to compute ts and tfp: all the samples with a score
+        above or equal to a threshold are positive.
 
     References
     ----------
@@ -221,6 +212,149 @@ def afroc_score(y_true, y_score):
     area = np.trapz(y=ts, x=fpf)
     return area
 
+
+class FROCAccumulator(object):
+    """ FROC and AFROC curves of scores given batch by batch, e.g. by the
+    chunks of decision_function or by parallel workers, without keeping all
+    the scores in memory.
+
+    In exact mode (n_bins=None) the state is a sorted run of the distinct
+    scores with their numbers of positive and negative samples. The batches
+    and the states of other accumulators are merged into it, and the curves
+    and areas are those of calc_froc, froc_score, calc_afroc and
+    afroc_score on all the scores at once.
+
+    In binned mode the state is a fixed size histogram of the positive and
+    of the negative scores. Each point of the curve is then the exact point
+    of the lower edge of a bin, and the error on the areas is at most
+    error_bound().
+
+    Parameters
+    ----------
+    n_bins : int, optional, number of bins of the histograms, None for the
+        exact mode
+    score_range : (float, float), range of the bins. The scores outside of
+        it fall in the first or the last bin. Required with n_bins
+
+    Attributes
+    ----------
+    scores_ : array, distinct scores (exact mode), or lower edges of the
+        bins, in increasing order
+    positives_, negatives_ : array of int, number of positive and negative
+        samples of each score or bin
+    n_samples_ : int, number of samples, i.e. of rows of y_true
+    """
+    def __init__(self, n_bins=None, score_range=None):
+        if n_bins is not None and score_range is None:
+            raise ValueError('score_range is required with n_bins')
+        self.n_bins = n_bins
+        self.score_range = score_range
+        self.n_samples_ = 0
+        if n_bins is None:
+            self.scores_ = np.empty(0)
+            self.positives_ = np.empty(0, dtype=np.int64)
+            self.negatives_ = np.empty(0, dtype=np.int64)
+        else:
+            self._edges = np.linspace(score_range[0], score_range[1],
+                                      n_bins + 1)
+            self.scores_ = self._edges[:-1]
+            self.positives_ = np.zeros(n_bins, dtype=np.int64)
+            self.negatives_ = np.zeros(n_bins, dtype=np.int64)
+
+    def update(self, y_true, y_score):
+        """ adds a batch of samples
+
+        Parameters
+        ----------
+        y_true : array, shape = [n_samples x n_classes], binary labels, 0 or 1
+        y_score : array, shape = [n_samples x n_classes]
+        """
+        n_samples = len(y_true)
+        y_true = np.ravel(y_true) == 1
+        y_score = np.ravel(y_score)
+        if self.n_bins is None:
+            scores, bins = np.unique(y_score, return_inverse=True)
+        else:
+            scores = self.scores_
+            bins = np.clip(np.searchsorted(self._edges, y_score,
+                                           side='right') - 1,
+                           0, self.n_bins - 1)
+        positives = np.bincount(bins[y_true], minlength=len(scores))
+        negatives = np.bincount(bins[~y_true], minlength=len(scores))
+        self._add(scores, positives, negatives, n_samples)
+        return self
+
+    def merge(self, other):
+        """ adds the samples of another accumulator, with the same bins """
+        if (other.n_bins != self.n_bins or
+                (self.n_bins is not None and
+                 tuple(other.score_range) != tuple(self.score_range))):
+            raise ValueError('Only accumulators with the same bins can be '
+                             'merged')
+        self._add(other.scores_, other.positives_, other.negatives_,
+                  other.n_samples_)
+        return self
+
+    def _add(self, scores, positives, negatives, n_samples):
+        self.n_samples_ += n_samples
+        if self.n_bins is not None:
+            self.positives_ = self.positives_ + positives
+            self.negatives_ = self.negatives_ + negatives
+            return
+        # merge of the two sorted runs
+        scores, runs = np.unique(np.r_[self.scores_, scores],
+                                 return_inverse=True)
+        self.positives_ = np.bincount(
+            runs, np.r_[self.positives_, positives],
+            minlength=len(scores)).astype(np.int64)
+        self.negatives_ = np.bincount(
+            runs, np.r_[self.negatives_, negatives],
+            minlength=len(scores)).astype(np.int64)
+        self.scores_ = scores
+
+    def _counts(self):
+        # numbers of true and false positives of each threshold, from the
+        # highest to the lowest, as in _froc_counts
+        if not self.positives_.sum() or not self.negatives_.sum():
+            raise ValueError("FROC is defined for binary classification only")
+        keep = (self.positives_ + self.negatives_)[::-1] > 0
+        tps = np.cumsum(self.positives_[::-1])[keep]
+        fps = np.cumsum(self.negatives_[::-1])[keep]
+        return tps, fps, self.scores_[::-1][keep]
+
+    def calc_froc(self):
+        """ ts, tfp, thresholds, see calc_froc """
+        tps, fps, thresholds = self._counts()
+        return tps / float(tps[-1]), fps / self.n_samples_, thresholds
+
+    def calc_afroc(self):
+        """ ts, fpf, thresholds, see calc_afroc """
+        ts, tfp, thresholds = self.calc_froc()
+        return ts, 1 - np.e**(-tfp), thresholds
+
+    def froc_score(self):
+        ts, tfp, _ = self.calc_froc()
+        return np.trapz(y=ts, x=tfp)
+
+    def afroc_score(self):
+        ts, fpf, _ = self.calc_afroc()
+        return np.trapz(y=ts, x=fpf)
+
+    def error_bound(self, afroc=False):
+        """ bound on the error of froc_score (or afroc_score if afroc is
+        True) with respect to the exact area, 0 in exact mode
+
+        Between two points of the binned curve the exact curve is monotone,
+        its area differs from the trapezoid by at most half the rectangle of
+        the two points. Before the first point, its area is at most the
+        rectangle of the first point and of the origin.
+        """
+        if self.n_bins is None:
+            return 0.
+        ts, x, _ = self.calc_afroc() if afroc else self.calc_froc()
+        return x[0] * ts[0] + np.sum(np.diff(x) * np.diff(ts)) / 2.
+
+
 # def plot_froc():
 #     """Plots the FROC curve (Free response receiver operating
 #        characteristic curve)
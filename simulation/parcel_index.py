@@ -0,0 +1,95 @@
+import numpy as np
+from scipy import sparse
+
+
+class ParcelIndex(object):
+    """ Sources of each parcel of a subject, to aggregate scores given per
+    source into scores per parcel.
+
+    The sources are sorted by parcel once, so that each parcel is a
+    contiguous segment of the sorted sources and a whole block of samples is
+    reduced with one ``ufunc.reduceat``.
+
+    Parameters
+    ----------
+    parcel_indices : array of int, shape (n_sources,)
+        parcel of each source, from 1 to n_parcels. The sources with 0 do
+        not belong to any parcel and are left out
+    n_parcels : int, optional
+        number of parcels of the output, by default the largest parcel index
+    """
+    _reductions = {'max': np.maximum, 'sum': np.add, 'mean': np.add}
+
+    def __init__(self, parcel_indices, n_parcels=None):
+        parcel_indices = np.asarray(parcel_indices)
+        if n_parcels is None:
+            n_parcels = int(parcel_indices.max())
+        self.n_sources = len(parcel_indices)
+        self.n_parcels = n_parcels
+
+        used = np.flatnonzero(parcel_indices > 0)
+        self.order = used[np.argsort(parcel_indices[used], kind='stable')]
+        # no copy of the scores when the sources are already sorted
+        self._sorted = np.array_equal(self.order, np.arange(self.n_sources))
+        self.parcels, self.offsets, self.counts = np.unique(
+            parcel_indices[self.order], return_index=True, return_counts=True)
+        self.parcel_indices = parcel_indices
+
+    def reduce(self, scores, how='max', out=None):
+        """ aggregates the scores of the sources of each parcel
+
+        Parameters
+        ----------
+        scores : array, shape (..., n_sources), or sparse matrix of shape
+            (n_samples, n_sources), whose implicit zeros are scores of 0.
+            The sparse scores are reduced from their nonzero entries only
+            and must be nonnegative for how='max'
+        how : 'max' | 'sum' | 'mean'
+        out : array, shape (..., n_parcels), optional, where to write the
+            result
+
+        Returns
+        -------
+        out : array, shape (..., n_parcels). The parcels without any source
+            in this subject are 0
+        """
+        if how not in self._reductions:
+            raise ValueError("how must be 'max', 'sum' or 'mean', got %r"
+                             % (how,))
+        if not sparse.issparse(scores):
+            scores = np.asarray(scores)
+        if scores.shape[-1] != self.n_sources:
+            raise ValueError('scores have {} sources, expected {}'.format(
+                             scores.shape[-1], self.n_sources))
+        if out is None:
+            out = np.zeros(scores.shape[:-1] + (self.n_parcels,),
+                           dtype=np.result_type(scores, np.float64))
+        elif len(self.parcels) < self.n_parcels:
+            out[...] = 0
+        if not len(self.order):
+            return out
+        if sparse.issparse(scores):
+            return self._reduce_sparse(scores.tocsr(), how, out)
+        if not self._sorted:
+            scores = scores[..., self.order]
+        reduced = self._reductions[how].reduceat(scores, self.offsets,
+                                                 axis=-1)
+        if how == 'mean':
+            reduced /= self.counts
+        out[..., self.parcels - 1] = reduced
+        return out
+
+    def _reduce_sparse(self, scores, how, out):
+        # one scatter of the nonzero scores, without densifying the rows
+        out[...] = 0
+        rows = np.repeat(np.arange(scores.shape[0]), np.diff(scores.indptr))
+        parcels = self.parcel_indices[scores.indices]
+        used = parcels > 0
+        rows, parcels = rows[used], parcels[used] - 1
+        if how == 'max':
+            np.maximum.at(out, (rows, parcels), scores.data[used])
+        else:
+            np.add.at(out, (rows, parcels), scores.data[used])
+        if how == 'mean':
+            out[:, self.parcels - 1] /= self.counts
+        return out
@@ -1,11 +1,14 @@
+from functools import lru_cache
+
 import numpy as np
 import mne
 
 
-def generate_signal(raw_fname, fwd_fname, subject, parcels, n_events=30,
-                    signal_type='eeg', random_state=None):
-    signal_len = 0.01  # in sec
-    # Generate the signal
+@lru_cache(maxsize=2)
+def read_signal_context(raw_fname, fwd_fname, signal_type='eeg'):
+    """ reads the info and the fixed orientation forward used to simulate
+    the signal. The result is cached, so that each worker process reads the
+    files of a subject only once, however many samples it simulates. """
     info = mne.io.read_info(raw_fname)
     if signal_type == 'eeg':
         sel = mne.pick_types(info, meg=False, eeg=True, stim=False, exclude=[])
@@ -18,7 +21,6 @@ def generate_signal(raw_fname, fwd_fname, subject, parcels, n_events=30,
                               exclude=[])
     info_data = mne.pick_info(info, sel_data)
     info = mne.pick_info(info, sel)
-    tstep = 1. / info['sfreq']
 
     # To simulate sources, we also need a source space. It can be obtained from
     # the forward solution of the sample subject.
@@ -28,6 +30,17 @@ def generate_signal(raw_fname, fwd_fname, subject, parcels, n_events=30,
     fwd = mne.convert_forward_solution(fwd, force_fixed=True)
     fwd = mne.pick_channels_forward(fwd, include=info_data['ch_names'],
                                     ordered=True)
+    return info, src, fwd
+
+
+def generate_signal(raw_fname, fwd_fname, subject, parcels, n_events=30,
+                    signal_type='eeg', random_state=None):
+    signal_len = 0.01  # in sec
+    # Generate the signal
+    info, src, fwd = read_signal_context(raw_fname, fwd_fname, signal_type)
+    info = info.copy()  # the cached info must not be modified by the raw
+    tstep = 1. / info['sfreq']
+
     # Define the time course of the activity for each source of the region to
     # activate. Here we use just a step of ones, the amplitude will be added at
     # later stage
@@ -0,0 +1,117 @@
+import glob
+import os
+import shutil
+import zlib
+
+import numpy as np
+
+from simulation.writer import SimulationWriter, load_stores, save_samples
+
+
+def sample_random_state(random_state, subject, idx):
+    """ random state of a single simulated sample.
+
+    Each (subject, sample) pair gets its own independent stream, spawned
+    from random_state with numpy's SeedSequence. The stream depends only on
+    the subject name and the index of the sample, so that the samples are
+    the same however the simulation is split across processes or nodes.
+    """
+    subject_key = zlib.crc32(subject.encode())
+    seed_seq = np.random.SeedSequence(random_state,
+                                      spawn_key=(subject_key, int(idx)))
+    return np.random.RandomState(np.random.MT19937(seed_seq))
+
+
+def shard_indices(subject_names, n_samples, shard=0, num_shards=1):
+    """ splits the (subject, sample) work items into num_shards disjoint
+    slices. The items are dealt round robin, so that each shard gets about
+    the same number of samples of every subject.
+
+    Returns
+    -------
+    indices : dict, subject -> array of the sample indices of the shard
+    """
+    if not 0 <= shard < num_shards:
+        raise ValueError('shard must be in [0, {}), got {}'.format(
+                         num_shards, shard))
+    indices = {}
+    for subj_idx, subject in enumerate(subject_names):
+        positions = subj_idx * n_samples + np.arange(n_samples)
+        indices[subject] = np.where(positions % num_shards == shard)[0]
+    return indices
+
+
+def shard_dir(data_dir, shard, num_shards):
+    return os.path.join(data_dir, 'shards',
+                        'shard_{}_of_{}'.format(shard, num_shards))
+
+
+def merge_shards(data_dir, num_shards):
+    """ assembles the shards of a simulation into data_dir, with the same
+    layout as a simulation run on a single node: one data_<case> directory
+    per subject with X.csv, target.npz, lead_field.npz and the labels.
+
+    Parameters
+    ----------
+    data_dir : string, directory given to the sharded simulation
+    num_shards : int, number of shards the simulation was split into
+
+    Returns
+    -------
+    data_dirs : list of string, paths to the merged data of each subject
+    """
+    shard_dirs = [shard_dir(data_dir, shard, num_shards)
+                  for shard in range(num_shards)]
+    for path in shard_dirs:
+        if not os.path.isdir(path):
+            raise ValueError('{} does not exist, all the shards need to be '
+                             'run before merging'.format(path))
+
+    cases = sorted(set(os.path.basename(path) for shard_path in shard_dirs
+                       for path in glob.glob(os.path.join(shard_path,
+                                                          'data_*'))))
+    data_dirs = []
+    for case in cases:
+        # a shard might not have got any sample of the subject
+        case_dirs = [os.path.join(path, case) for path in shard_dirs
+                     if os.path.isdir(os.path.join(path, case, 'chunks'))]
+        writers = []
+        for case_dir in case_dirs:
+            writers.append(SimulationWriter.open(os.path.join(case_dir,
+                                                              'chunks')))
+
+        indices, X, targets = load_stores(writers)
+        n_samples = writers[0].n_samples
+        if not np.array_equal(indices, np.arange(n_samples)):
+            raise ValueError('the shards of {} do not cover the {} samples '
+                             'exactly once'.format(case, n_samples))
+
+        data_dir_specific = os.path.join(data_dir, case)
+        if not os.path.isdir(data_dir_specific):
+            os.mkdir(data_dir_specific)
+
+        # lead field and labels are the same in all the shards
+        for case_dir in case_dirs:
+            for fname in os.listdir(case_dir):
+                shard_fname = os.path.join(case_dir, fname)
+                merged_fname = os.path.join(data_dir_specific, fname)
+                if fname == 'chunks' or os.path.exists(merged_fname):
+                    continue
+                elif os.path.isdir(shard_fname):
+                    shutil.copytree(shard_fname, merged_fname)
+                else:
+                    shutil.copyfile(shard_fname, merged_fname)
+
+        labels_fname = glob.glob(os.path.join(data_dir_specific,
+                                              '*_labels.npz'))[0]
+        n_saved = save_samples(data_dir_specific, X, targets,
+                               _read_parcel_names(labels_fname))
+        print('{} samples from {} shards were saved in {}'.format(
+              n_saved, len(writers), data_dir_specific))
+        data_dirs.append(data_dir_specific)
+    return data_dirs
+
+
+def _read_parcel_names(labels_fname):
+    labels = np.load(labels_fname, allow_pickle=True)['arr_0']
+    return np.array([label.name for label in labels])
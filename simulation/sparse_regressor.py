@@ -1,22 +1,274 @@
 import warnings
 
 import numpy as np
-import pandas as pd
+
+from joblib import Parallel, delayed, effective_n_jobs
+from numba import jit
+from scipy import sparse
 
 from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.base import RegressorMixin, ClassifierMixin
+from sklearn.base import clone
 from sklearn.exceptions import ConvergenceWarning
-from sklearn.multioutput import MultiOutputRegressor
 from sklearn import linear_model
 
 from sklearn.metrics import hamming_loss
+
+from simulation.chunking import iter_row_chunks, stream_rows
+from simulation.leadfield import LeadfieldOperator, compress_leadfield
+from simulation.parcel_index import ParcelIndex
 # from simulation.emd import emd_score
 
 
 def solver_lasso(Xw, y, alpha, max_iter):
+    # also returns the alpha where the LARS path stopped, larger than alpha
+    # if it was cut by max_iter
     model = linear_model.LassoLars(max_iter=max_iter, normalize=False,
                                    fit_intercept=False, alpha=alpha)
-    return model.fit(Xw, y).coef_.copy()
+    model.fit(Xw, y)
+    return model.coef_.copy(), model.alphas_[-1]
+
+
+def solver_lasso_gram(Xyw, Gramw, n_samples, alpha, max_iter):
+    # same as solver_lasso, only from Xw.T @ y and Xw.T @ Xw. Both are
+    # temporary arrays which LARS is allowed to overwrite
+    alphas, _, coefs = linear_model.lars_path_gram(
+        Xyw, Gramw, n_samples=n_samples, alpha_min=alpha, method='lasso',
+        max_iter=max_iter, copy_Gram=False)
+    return coefs[:, -1], alphas[-1]
+
+
+@jit(nogil=True, cache=True, nopython=True)
+def _cd_sweeps(X, r, coef, ws, thresholds, norms2, max_sweeps, tol):
+    # cyclic coordinate descent over the columns ws of the Fortran ordered
+    # X, with soft thresholding at thresholds[j]. coef and the residual
+    # r = y - X coef are updated in place. Returns the number of sweeps
+    n_samples = X.shape[0]
+    for sweep in range(max_sweeps):
+        max_update = 0.
+        max_coef = 0.
+        for j in ws:
+            if norms2[j] == 0.:
+                continue
+            old = coef[j]
+            tmp = 0.
+            for i in range(n_samples):
+                tmp += X[i, j] * r[i]
+            tmp = old + tmp / norms2[j]
+            new = max(abs(tmp) - thresholds[j], 0.)
+            if tmp < 0:
+                new = -new
+            if new != old:
+                diff = new - old
+                for i in range(n_samples):
+                    r[i] -= diff * X[i, j]
+                coef[j] = new
+                max_update = max(max_update, abs(diff))
+            max_coef = max(max_coef, abs(new))
+        if max_update <= tol * max_coef:
+            return sweep + 1
+    return max_sweeps
+
+
+def gap_safe_screening(Xtr, r_norm2, yr, penalty, lmbda, col_norms,
+                       weights=None):
+    """ gap safe screening rule of the weighted Lasso::
+
+        0.5 * ||y - X coef||^2 + lmbda * sum_j |coef_j| / w_j
+
+    From a primal point coef with residual r = y - X coef, r rescaled to be
+    dual feasible gives a duality gap, and the optimal dual point is in the
+    ball of radius sqrt(2 * gap) around it. The columns whose constraint
+    cannot be saturated anywhere in this ball are zero at the optimum and
+    can be removed from the problem.
+
+    Parameters
+    ----------
+    Xtr : array, shape (n_features,), X.T @ r
+    r_norm2 : float, ||r||^2
+    yr : float, y @ r
+    penalty : float, sum_j |coef_j| / w_j
+    lmbda : float
+    col_norms : array, shape (n_features,), norms of the columns of X
+    weights : array, shape (n_features,), optional, default ones
+
+    Returns
+    -------
+    keep : array of bool, shape (n_features,), the columns which can be
+        nonzero at the optimum
+    gap : float, duality gap
+    """
+    if weights is None:
+        weights = np.ones_like(col_norms)
+    Xtr = abs(Xtr)
+    dual_scale = max(1., (Xtr * weights).max() / lmbda if len(Xtr) else 0.)
+    primal = 0.5 * r_norm2 + lmbda * penalty
+    dual = yr / dual_scale - 0.5 * r_norm2 / dual_scale ** 2
+    gap = max(primal - dual, 0.)
+    radius = (2 * gap) ** 0.5
+    # the active columns are exactly at lmbda at the optimum, the margin
+    # keeps them when the gap is down to rounding errors
+    keep = ((Xtr / dual_scale + col_norms * radius) * weights >=
+            lmbda * (1 - 1e-9))
+    return keep, gap
+
+
+def solver_lasso_cd(X, y, alpha, weights, coef_init=None, max_iter=2000,
+                    tol=1e-4, columns=None, col_norms=None, screening=True):
+    """ coordinate descent for the Lasso with column weights::
+
+        (1 / (2 * n_samples)) * ||y - X coef||^2 + alpha * sum_j |coef_j| / w_j
+
+    which is the Lasso on X diag(w) with coef = w * b. The sweeps are run
+    on a working set made of the support and of the columns violating the
+    most the optimality conditions, which grows until the duality gap of the
+    whole problem is below tol * ||y||^2 / n_samples.
+
+    Parameters
+    ----------
+    X : array, shape (n_samples, n_features), Fortran ordered
+    y : array, shape (n_samples,)
+    alpha : float
+    weights : array, shape (n_features,)
+    coef_init : array, shape (n_features,), optional, warm start
+    max_iter : int, maximum number of sweeps over the working set
+    tol : float
+    columns : array of int, optional, the only columns which can be
+        nonzero. All the others are kept at 0
+    col_norms : array, shape (n_features,), optional, norms of the columns
+    screening : bool, whether to drop the columns certified to be zero by
+        the gap safe rule, from the warm start and then at each duality gap
+        evaluation
+
+    Returns
+    -------
+    coef : array, shape (n_features,)
+    residual : array, shape (n_samples,), y - X coef
+    n_iter : int, number of sweeps
+    gaps : list of float, duality gap at each working set iteration
+    n_screened : int, number of columns left out of the solve
+    """
+    n_samples, n_features = X.shape
+    y = np.asarray(y, dtype=np.float64)
+    if col_norms is None:
+        col_norms = np.linalg.norm(X, axis=0)
+    if columns is None:
+        columns = np.arange(n_features)
+
+    coef = np.zeros(n_features)
+    if coef_init is not None:
+        coef[columns] = coef_init[columns]
+    residual = y - X[:, columns] @ coef[columns]
+    lmbda = n_samples * alpha
+    norms2 = col_norms ** 2
+    thresholds = np.full(n_features, np.inf)
+    thresholds[columns] = lmbda / (weights[columns] * norms2[columns])
+    y_norm2 = y @ y
+    inner_tol = min(tol, 1e-4)
+
+    gaps = []
+    n_iter = 0
+    ws_size = 10
+    while len(columns):
+        # duality gap of the problem restricted to the columns, which has
+        # the same solution as the whole problem
+        Xtr = X[:, columns].T @ residual
+        keep, gap = gap_safe_screening(
+            Xtr, residual @ residual, y @ residual,
+            (abs(coef[columns]) / weights[columns]).sum(), lmbda,
+            col_norms[columns], weights[columns])
+        gaps.append(gap / n_samples)
+        if gaps[-1] <= tol * y_norm2 / n_samples or n_iter >= max_iter:
+            break
+
+        if screening and not keep.all():
+            dropped = columns[~keep]
+            dropped = dropped[coef[dropped] != 0]
+            residual += X[:, dropped] @ coef[dropped]
+            coef[dropped] = 0.
+            columns, Xtr = columns[keep], Xtr[keep]
+        scores = abs(Xtr) * weights[columns]
+
+        support = np.flatnonzero(coef[columns])
+        ws_size = max(ws_size, 2 * len(support))
+        ws = np.union1d(support, np.argsort(-scores)[:ws_size])
+        n_iter += _cd_sweeps(X, residual, coef, columns[ws], thresholds,
+                             norms2, max_iter - n_iter, inner_tol)
+        ws_size *= 2
+    return coef, residual, n_iter, gaps, n_features - len(columns)
+
+
+def _interpolate_path(path_alphas, path_coefs, alphas):
+    # the Lasso coefficients are linear in alpha between the kinks of the
+    # path. The alphas below the end of a path cut by max_iter get its last
+    # point, as a LARS stopped at the same iteration
+    n_points = len(path_alphas)
+    if n_points == 1:
+        return np.repeat(path_coefs.T, len(alphas), axis=0)
+    kink = np.searchsorted(-path_alphas, -alphas)
+    kink = np.clip(kink, 1, n_points - 1)
+    alpha_start, alpha_end = path_alphas[kink - 1], path_alphas[kink]
+    step = np.where(alpha_start > alpha_end, alpha_start - alpha_end, 1.)
+    ratio = np.clip((alpha_start - alphas) / step, 0., 1.)
+    return (path_coefs[:, kink - 1] * (1 - ratio) +
+            path_coefs[:, kink] * ratio).T
+
+
+def solver_lasso_path(X, y, alphas, max_iter):
+    # Lasso solutions at all the alphas from a single LARS path, shape
+    # (n_alphas, n_features)
+    path_alphas, _, path_coefs = linear_model.lars_path(
+        X, y, alpha_min=np.min(alphas), method='lasso', max_iter=max_iter)
+    return _interpolate_path(path_alphas, path_coefs, alphas)
+
+
+def solver_lasso_gram_path(Xy, Gram, n_samples, alphas, max_iter):
+    # same as solver_lasso_path, from X.T @ y and X.T @ X
+    path_alphas, _, path_coefs = linear_model.lars_path_gram(
+        Xy, Gram, n_samples=n_samples, alpha_min=np.min(alphas),
+        method='lasso', max_iter=max_iter)
+    return _interpolate_path(path_alphas, path_coefs, alphas)
+
+
+def _screen_columns(X, y, Xy, Gram, columns, coef, weights, col_norms,
+                    lmbda):
+    # static gap safe screening of the columns of a reweighting step, from
+    # the solution of the previous step
+    support = columns[np.flatnonzero(coef[columns])]
+    coef_s = coef[support]
+    if Gram is None:
+        residual = y - X[:, support] @ coef_s
+        Xtr = X[:, columns].T @ residual
+        yr, r_norm2 = y @ residual, residual @ residual
+    else:
+        Xtr = Xy[columns] - Gram[np.ix_(columns, support)] @ coef_s
+        yr = y @ y - coef_s @ Xy[support]
+        r_norm2 = (yr - coef_s @ Xy[support] +
+                   coef_s @ Gram[np.ix_(support, support)] @ coef_s)
+    keep, _ = gap_safe_screening(
+        Xtr, r_norm2, yr, (abs(coef_s) / weights[support]).sum(), lmbda,
+        col_norms[columns], weights[columns])
+    return columns[keep]
+
+
+def _solve_lars_step(X, y, Xy, Gram, columns, weights, alpha, max_iter):
+    # LARS solve of a reweighting step on the columns which can be nonzero.
+    # Also returns the alpha where the path stopped
+    n_samples, n_features = X.shape
+    coef_ = np.zeros(n_features)
+    if not len(columns):
+        return coef_, alpha
+    w = weights[columns]
+    if Gram is None or len(columns) > n_samples:
+        Xw = X[:, columns] * w
+        coef_[columns], path_alpha = solver_lasso(Xw, y, alpha, max_iter)
+    else:
+        # fewer columns than samples: solve in the Gram space
+        Gramw = w[:, None] * Gram[np.ix_(columns, columns)] * w
+        coef_[columns], path_alpha = solver_lasso_gram(
+            Xy[columns] * w, Gramw, n_samples, alpha, max_iter)
+    coef_[columns] *= w
+    return coef_, path_alpha
 
 
 class ReweightedLasso(BaseEstimator, RegressorMixin):
@@ -30,9 +282,12 @@ class ReweightedLasso(BaseEstimator, RegressorMixin):
 
     Parameters
     ----------
-    alpha : (float or array-like), shape (n_tasks)
-        Optional, default ones(n_tasks)
-        Constant that multiplies the L0.5 term. Defaults to 1.0
+    alpha_fraction : float or array-like, shape (n_alphas,)
+        Constant that multiplies the L0.5 term, as a fraction of the
+        smallest alpha for which all the coefficients are zero. With an
+        array, the model is fitted for each of the values: the first
+        reweighting step of all of them comes from a single Lasso path and
+        coef_ has shape (n_alphas, n_features).
     max_iter : int, optional
         The maximum number of inner loop iterations
     max_iter_reweighting : int, optional
@@ -42,42 +297,196 @@ class ReweightedLasso(BaseEstimator, RegressorMixin):
         smaller than ``tol``, the optimization code checks the
         dual gap for optimality and continues until it is smaller
         than ``tol``.
+    precompute : bool or array-like, shape (n_features, n_features)
+        Whether to use a precomputed Gram matrix ``X.T @ X``, it can be
+        passed as argument. The reweighting steps with fewer columns which
+        can still be active than samples are then solved from
+        ``diag(w) G diag(w)`` restricted to these columns, without going
+        back to X.
+    solver : 'lars' | 'cd'
+        Solver of the reweighting steps. 'lars' computes the LARS path of
+        each step from scratch. 'cd' runs coordinate descent on a working
+        set, warm started from the solution of the previous step and
+        stopped when the duality gap is below ``tol * ||y||^2 / n_samples``.
+        With 'cd' max_iter is the maximum number of sweeps and the Gram
+        matrix is only used for the norms of the columns.
+    screening : bool
+        Whether to discard with the gap safe rule the columns which are
+        certified to be zero, before each step from the solution of the
+        previous step (static) and, with solver 'cd', also along the solve
+        (dynamic). This does not change the solution.
 
     Attributes
     ----------
-    coef_ : array, shape (n_features,)
+    coef_ : array, shape (n_features,) or (n_alphas, n_features)
         Parameter vector (W in the cost function formula).
+    loss_ : list of float
+        Objective after each reweighting step.
+    n_iter_ : list of int
+        Number of coordinate descent sweeps of each reweighting step (solver
+        'cd' only).
+    dual_gaps_ : list of list of float
+        Duality gaps along the solve of each reweighting step (solver 'cd'
+        only).
+    n_screened_ : list of int
+        Number of columns discarded by the safe rules at each reweighting
+        step.
+
+    With an array of alpha_fraction, loss_, n_iter_, dual_gaps_ and
+    n_screened_ hold one such list per alpha.
     """
     def __init__(self, alpha_fraction=.01, max_iter=2000,
-                 max_iter_reweighting=100, tol=1e-4):
+                 max_iter_reweighting=100, tol=1e-4, precompute=False,
+                 solver='lars', screening=True):
         self.alpha_fraction = alpha_fraction
         self.max_iter = max_iter
         self.max_iter_reweighting = max_iter_reweighting
         self.tol = tol
+        self.precompute = precompute
+        self.solver = solver
+        self.screening = screening
 
     def fit(self, X, y):
-        n_samples, n_features = X.shape
-
-        self.coef_ = np.zeros(n_features)
-        weights = np.ones_like(self.coef_)
-        coef_old = self.coef_.copy()
+        if self.solver not in ('lars', 'cd'):
+            raise ValueError("solver must be 'lars' or 'cd', got %r"
+                             % (self.solver,))
+
+        Xy = X.T.dot(y)
+        alpha_max = abs(Xy).max() / len(X)
+
+        Gram = self.precompute
+        if isinstance(Gram, bool):
+            Gram = X.T @ X if Gram else None
+        if Gram is None:
+            col_norms = np.linalg.norm(X, axis=0)
+        else:
+            col_norms = np.sqrt(np.diag(Gram))
+        X_cd = None
+        if self.solver == 'cd':
+            X_cd = np.asfortranarray(X, dtype=np.float64)
+        problem = (X, y, Xy, Gram, col_norms, X_cd)
+
+        alpha_fraction = np.asarray(self.alpha_fraction, dtype=np.float64)
+        if alpha_fraction.ndim == 0:
+            (self.coef_, self.loss_, self.n_iter_, self.dual_gaps_,
+             self.n_screened_) = self._reweight(problem,
+                                                alpha_fraction * alpha_max)
+            return self
+
+        # with a grid of alphas, the first step (unit weights) of all of
+        # them is solved at once along the Lasso path
+        alphas = alpha_fraction * alpha_max
+        results = [self._reweight(problem, alpha, first_step)
+                   for alpha, first_step in
+                   zip(alphas, self._first_steps(problem, alphas))]
+        self.coef_ = np.array([result[0] for result in results])
+        (self.loss_, self.n_iter_, self.dual_gaps_,
+         self.n_screened_) = [[result[k] for result in results]
+                              for k in range(1, 5)]
+        return self
 
-        self.loss_ = []
+    def _first_steps(self, problem, alphas):
+        # first reweighting step for all the alphas, as (coef, residual,
+        # n_iter, gaps, n_screened) for each alpha
+        X, y, Xy, Gram, col_norms, X_cd = problem
+        n_samples, n_features = X.shape
+        weights = np.ones(n_features)
+        # the prefilter of _reweight at the smallest alpha holds along the
+        # whole path
+        columns = np.where(col_norms * (y @ y) ** 0.5 >=
+                           n_samples * alphas.min())[0]
+        steps = [None] * len(alphas)
+        if self.solver == 'cd':
+            # path of warm started solves, from the largest alpha
+            coef = np.zeros(n_features)
+            for idx in np.argsort(-alphas):
+                coef, residual, n_iter, gaps, n_screened = solver_lasso_cd(
+                    X_cd, y, alphas[idx], weights, coef, self.max_iter,
+                    self.tol, columns, col_norms, self.screening)
+                steps[idx] = (coef, residual, n_iter, gaps, n_screened)
+            return steps
+
+        coefs = np.zeros((len(alphas), n_features))
+        if len(columns) and (Gram is None or len(columns) > n_samples):
+            coefs[:, columns] = solver_lasso_path(X[:, columns], y, alphas,
+                                                  self.max_iter)
+        elif len(columns):
+            coefs[:, columns] = solver_lasso_gram_path(
+                Xy[columns], Gram[np.ix_(columns, columns)], n_samples,
+                alphas, self.max_iter)
+        n_screened = n_features - len(columns)
+        return [(coef, None, None, None, n_screened) for coef in coefs]
+
+    def _reweight(self, problem, alpha, first_step=None):
+        """ reweighting steps at alpha, starting from the solution of the
+        first step if it is given
+
+        Returns
+        -------
+        coef : array, shape (n_features,)
+        loss, n_iter, dual_gaps, n_screened : lists with the objective, the
+            number of sweeps, the duality gaps and the number of screened
+            columns of each step
+        """
+        X, y, Xy, Gram, col_norms, X_cd = problem
+        n_samples, n_features = X.shape
+        y_norm2 = y @ y
 
-        alpha_max = abs(X.T.dot(y)).max() / len(X)
-        alpha = self.alpha_fraction * alpha_max
+        weights = np.ones(n_features)
+        coef_old = np.zeros(n_features)
+        loss, n_iters, dual_gaps, n_screened_steps = [], [], [], []
 
         for i in range(self.max_iter_reweighting):
-            Xw = X * weights
-            coef_ = solver_lasso(Xw, y, alpha, self.max_iter)
-            coef_ = coef_ * weights
+            # the residual of the solution is smaller than y, so the columns
+            # with |Xw_j| |y| < n_samples * alpha cannot reach the
+            # correlation alpha and stay at 0
+            columns = np.where(weights * col_norms * y_norm2 ** 0.5 >=
+                               n_samples * alpha)[0]
+            if i == 0 and first_step is not None:
+                coef_, residual, n_iter, gaps, n_screened = first_step
+            elif self.solver == 'cd':
+                # warm start from the solution of the previous step
+                coef_, residual, n_iter, gaps, n_screened = solver_lasso_cd(
+                    X_cd, y, alpha, weights, coef_old, self.max_iter,
+                    self.tol, columns, col_norms, self.screening)
+            else:
+                residual = n_iter = gaps = None
+                screened = columns
+                if self.screening and len(columns):
+                    screened = _screen_columns(
+                        X, y, Xy, Gram, columns, coef_old, weights,
+                        col_norms, n_samples * alpha)
+                coef_, path_alpha = _solve_lars_step(
+                    X, y, Xy, Gram, screened, weights, alpha, self.max_iter)
+                if path_alpha > alpha and len(screened) < len(columns):
+                    # the safe rule holds only at alpha: when max_iter cuts
+                    # the path before, the screened columns could have been
+                    # active
+                    coef_, _ = _solve_lars_step(X, y, Xy, Gram, columns,
+                                                weights, alpha, self.max_iter)
+                    screened = columns
+                n_screened = n_features - len(screened)
+            if n_iter is not None:
+                n_iters.append(n_iter)
+                dual_gaps.append(gaps)
+            n_screened_steps.append(n_screened)
             err = abs(coef_ - coef_old).max()
             err /= max(abs(coef_).max(), abs(coef_old).max(), 1.)
             coef_old = coef_.copy()
             weights = 2 * (abs(coef_) ** 0.5 + 1e-10)
-            obj = 0.5 * ((X @ coef_ - y) ** 2).sum() / n_samples
+            support = np.flatnonzero(coef_)
+            coef_s = coef_[support]
+            if residual is not None:
+                obj = residual @ residual
+            elif Gram is None:
+                obj = ((X[:, support] @ coef_s - y) ** 2).sum()
+            else:
+                # ||X coef - y||^2 from the Gram, over the support only
+                obj = (coef_s @ Gram[np.ix_(support, support)] @ coef_s -
+                       2 * coef_s @ Xy[support] + y_norm2)
+            obj *= 0.5 / n_samples
             obj += (alpha * abs(coef_) ** 0.5).sum()
-            self.loss_.append(obj)
+            loss.append(obj)
             if err < self.tol and i:
                 break
 
@@ -88,24 +497,216 @@ class ReweightedLasso(BaseEstimator, RegressorMixin):
                           ' Fitting data with very small alpha' +
                           ' may cause precision problems.',
                           ConvergenceWarning)
-        self.coef_ = coef_
+        return coef_, loss, n_iters, dual_gaps, n_screened_steps
 
     def predict(self, X):
         return np.dot(X, self.coef_)
 
 
+def batched_omp(Xy, gram, n_nonzero_coefs, groups=None):
+    """ orthogonal matching pursuit of many samples at once, from the Gram
+    matrix only
+
+    The samples are updated together at each of the n_nonzero_coefs steps:
+    one selection over the correlations of all the samples, one stack of
+    small least squares problems on their active sets and one update of the
+    correlations with the rows of the Gram matrix of the new atoms.
+
+    Parameters
+    ----------
+    Xy : array, shape (n_features, n_samples), X.T @ y of each sample
+    gram : array, shape (n_features, n_features), X.T @ X
+    n_nonzero_coefs : int, number of atoms selected per sample
+    groups : array of int, shape (n_features,), optional
+        group of each atom, from 1 to n_groups (the atoms of group 0 are
+        never selected). Each step then selects a group not selected yet,
+        the one of the atom the most correlated with the residual, so that
+        the atoms of a sample are in n_nonzero_coefs different groups
+
+    Returns
+    -------
+    coef : array, shape (n_samples, n_features)
+    """
+    Xy = np.asarray(Xy, dtype=np.float64).T
+    n_samples, n_features = Xy.shape
+    rows = np.arange(n_samples)[:, None]
+    if groups is not None:
+        groups = np.asarray(groups)
+
+    active = np.zeros((n_samples, 0), dtype=int)
+    coef_active = np.zeros((n_samples, 0))
+    corr = Xy.copy()
+    for _ in range(n_nonzero_coefs):
+        scores = np.abs(corr)
+        scores[rows, active] = -1.
+        if groups is not None:
+            # the atoms of the selected groups are out
+            selected = np.zeros((n_samples, groups.max() + 1), dtype=bool)
+            selected[:, 0] = True
+            selected[rows, groups[active]] = True
+            scores[selected[:, groups]] = -1.
+        active = np.hstack([active, np.argmax(scores, axis=1)[:, None]])
+
+        # least squares on the active atoms, then correlations of the
+        # residual Xy - G[:, active] @ coef_active
+        gram_active = gram[active[:, :, None], active[:, None, :]]
+        coef_active = np.linalg.solve(
+            gram_active, Xy[rows, active][:, :, None])[:, :, 0]
+        corr = Xy.copy()
+        for col in range(active.shape[1]):
+            corr -= coef_active[:, col:col + 1] * gram[active[:, col]]
+
+    coef = np.zeros((n_samples, n_features))
+    coef[rows, active] = coef_active
+    return coef
+
+
 def _get_coef(est):
     if hasattr(est, 'steps'):
         return est.steps[-1][1].coef_
     return est.coef_
 
 
+class BatchedOMP(BaseEstimator, RegressorMixin):
+    """ Orthogonal matching pursuit of all the columns of a 2d y at once.
+
+    Each sample gets exactly n_nonzero_coefs atoms, selected greedily. With
+    the Gram matrix this takes n_nonzero_coefs vectorized steps for all the
+    samples, see batched_omp.
+
+    Parameters
+    ----------
+    n_nonzero_coefs : int
+        Number of atoms of each sample, e.g. the maximum number of active
+        parcels
+    groups : None | array of int, shape (n_features,) | 'parcels'
+        Group of each atom, from 1 to n_groups, to select the atoms of each
+        sample in different groups. With 'parcels', SparseRegressor uses
+        the parcels of the subject, each sample then gets n_nonzero_coefs
+        active parcels
+    precompute : bool or array-like, shape (n_features, n_features)
+        Whether to use a precomputed Gram matrix ``X.T @ X``, it can be
+        passed as argument. Otherwise it is computed at each fit
+
+    Attributes
+    ----------
+    coef_ : array, shape (n_features,) or (n_targets, n_features)
+    """
+    def __init__(self, n_nonzero_coefs=3, groups=None, precompute=False):
+        self.n_nonzero_coefs = n_nonzero_coefs
+        self.groups = groups
+        self.precompute = precompute
+
+    def fit(self, X, y):
+        if isinstance(self.groups, str):
+            raise ValueError("groups='parcels' is only supported within "
+                             "SparseRegressor")
+        X = np.asarray(X, dtype=np.float64)
+        if isinstance(self.precompute, np.ndarray):
+            gram = self.precompute
+        else:
+            gram = X.T @ X
+        coef = batched_omp(X.T @ np.asarray(y, dtype=np.float64), gram,
+                           self.n_nonzero_coefs, groups=self.groups)
+        self.coef_ = coef[0] if np.ndim(y) == 1 else coef
+        return self
+
+    def predict(self, X):
+        return np.dot(X, self.coef_.T)
+
+
+# estimators which fit each column of a 2d y independently, exactly as if
+# they were fitted on each column one after the other
+_MULTI_TARGET_MODELS = (linear_model.Lasso, linear_model.ElasticNet,
+                        linear_model.LassoLars, linear_model.Lars,
+                        linear_model.OrthogonalMatchingPursuit, BatchedOMP)
+
+
+def _is_alpha_grid(model):
+    # whether the model is fitted for a grid of alphas, the decision
+    # function and the predictions then have one row per alpha
+    return np.ndim(getattr(model, 'alpha_fraction', 0)) > 0
+
+
+def _fit_rows(model, L, X, sparse_coefs=False):
+    # fits the model on each row of X, returns the coefficients of each row
+    # (n_samples, n_sources), or (n_samples, n_alphas, n_sources) for a grid
+    # of alphas, and, for the models reporting it, the number of columns
+    # screened at the last step of each fit. With sparse_coefs, the
+    # coefficients are a CSR matrix with one row per sample (and alpha)
+    est_coefs = n_screened = None
+    rows = []
+    for idx, x in enumerate(X):
+        model.fit(L, x)
+        coef = _get_coef(model)
+        if n_screened is None:
+            n_screened = np.zeros((len(X),) + coef.shape[:-1], dtype=int)
+            if not sparse_coefs:
+                est_coefs = np.empty((len(X),) + coef.shape)
+        if sparse_coefs:
+            rows.append(sparse.csr_matrix(np.atleast_2d(coef)))
+        else:
+            est_coefs[idx] = coef
+        screened = getattr(model, 'n_screened_', None)
+        if screened and coef.ndim == 2:
+            n_screened[idx] = [steps[-1] for steps in screened]
+        elif screened:
+            n_screened[idx] = screened[-1]
+    if sparse_coefs:
+        est_coefs = sparse.vstack(rows, format='csr')
+    return est_coefs, n_screened
+
+
 class SparseRegressor(BaseEstimator, ClassifierMixin, TransformerMixin):
-    def __init__(self, lead_field, parcel_indices, model, n_jobs=1):
+    """ Source localisation by fitting a sparse regression model of each
+    sample on the normalized lead field of its subject
+
+    Parameters
+    ----------
+    lead_field : list of arrays, shape (n_electrodes, n_sources), lead
+        field of each subject
+    parcel_indices : list of arrays of int, shape (n_sources,), parcel of
+        each source of each subject
+    model : estimator with a coef_ attribute after fit
+    n_jobs : int, number of processes used for the models which cannot fit
+        all the samples at once
+    precompute : bool, if True and the model has a ``precompute``
+        parameter, it is given the Gram matrix of the normalized lead field,
+        computed only once per subject (n_sources ** 2 floats per subject)
+    chunk_size : int, number of samples processed at once by
+        decision_function and predict, which bounds their memory use to
+        chunk_size * n_sources floats whatever the number of samples
+    sparse_coefs : bool, if True the estimates of the sources are kept as
+        CSR matrices, built from the fits without a dense
+        (n_samples, n_sources) array, and reduced per parcel in this form
+    compression : float, optional, if given the model is fitted on the
+        lead field compressed to a few atoms per parcel explaining this
+        fraction of its variance, see simulation.leadfield.
+        compress_leadfield. The sources are then the atoms
+    cache : DecisionCache, optional, where the betas (and numbers of
+        screened sources) of each sample are kept, to fit the model only
+        once per sample across the copies of the estimator made by an
+        evaluation
+
+    Attributes
+    ----------
+    n_screened_ : array of int, shape ([n_alphas,] n_samples)
+        number of sources discarded by the screening rules of the model at
+        the last step of the fit of each sample, in the last call to
+        decision_function
+    """
+    def __init__(self, lead_field, parcel_indices, model, n_jobs=1,
+                 precompute=False, chunk_size=1000, sparse_coefs=False,
+                 compression=None, cache=None):
         self.lead_field = lead_field
         self.parcel_indices = parcel_indices
         self.model = model
         self.n_jobs = n_jobs
+        self.precompute = precompute
+        self.chunk_size = chunk_size
+        self.sparse_coefs = sparse_coefs
+        self.compression = compression
+        self.cache = cache
         # self.data_dir = data_dir # this is required only if EMD score would
         # be used
 
@@ -114,6 +715,9 @@ class SparseRegressor(BaseEstimator, ClassifierMixin, TransformerMixin):
 
     def score(self, X, y):
         # overwites given score with the EMD score (based on the distance)
+        if _is_alpha_grid(self.model):
+            raise ValueError('the model is fitted for a grid of alphas, '
+                             'score each of them with score_alphas')
 
         y_pred = self.predict(X)
 
@@ -137,39 +741,231 @@ class SparseRegressor(BaseEstimator, ClassifierMixin, TransformerMixin):
         '''
         return score
 
-    def predict(self, X):
-        return (self.decision_function(X) > 0).astype(int)
+    def score_alphas(self, X, y):
+        """ hamming loss of the predictions of each alpha of the grid
+        (ReweightedLasso with an array of alpha_fraction)
 
-    def _run_model(self, model, L, X, fraction_alpha=0.2):
-        norms = np.linalg.norm(L, axis=0)
-        L = L / norms[None, :]
+        Returns
+        -------
+        scores : array, shape (n_alphas,)
+        """
+        if not _is_alpha_grid(self.model):
+            raise ValueError('the model is not fitted for a grid of alphas, '
+                             'use score')
+        return np.array([hamming_loss(y, y_pred)
+                         for y_pred in self.predict(X)])
 
-        est_coefs = np.empty((X.shape[0], L.shape[1]))
-        for idx, idx_used in enumerate(X.index.values):
-            x = X.iloc[idx].values
-            model.fit(L, x)
-            est_coef = np.abs(_get_coef(model))
-            est_coef /= norms
-            est_coefs[idx] = est_coef
+    def predict(self, X):
+        def predict_block(X_block):
+            return (self._cached_decision_block(X_block)[0] > 0).astype(int)
+
+        return stream_rows(predict_block, X, self.chunk_size)
+
+    def _per_subject(self, name, subj_idx, build, params=()):
+        # build() computed once per subject, and again when the lead field
+        # or the parcels of the subject, the compression or params changed,
+        # e.g. with set_params
+        values = self.__dict__.setdefault(name, {})
+        arrays = (self.lead_field[subj_idx], self.parcel_indices[subj_idx])
+        params = (self.compression,) + tuple(params)
+        if subj_idx in values:
+            cached_arrays, cached_params, value = values[subj_idx]
+            if (all(a is b for a, b in zip(cached_arrays, arrays)) and
+                    cached_params == params):
+                return value
+        value = build()
+        values[subj_idx] = arrays, params, value
+        return value
+
+    def _dictionary(self, subj_idx):
+        # lead field and parcel of each column the model is fitted on, the
+        # lead field compressed per parcel is computed only once
+        if self.compression is None:
+            return self.lead_field[subj_idx], self.parcel_indices[subj_idx]
+        return self._per_subject('_compressed', subj_idx, lambda: (
+            compress_leadfield(self.lead_field[subj_idx],
+                               self.parcel_indices[subj_idx],
+                               explained_variance=self.compression)))
+
+    def _operator(self, subj_idx):
+        # the normalized lead field (and Gram) of each subject is computed
+        # only once
+        return self._per_subject('_operators', subj_idx, lambda: (
+            LeadfieldOperator(self._dictionary(subj_idx)[0])))
+
+    def _parcel_index(self, subj_idx):
+        n_parcels = max(max(s) for s in self.parcel_indices)
+        return self._per_subject('_parcel_indexes', subj_idx, lambda: (
+            ParcelIndex(self._dictionary(subj_idx)[1], n_parcels)),
+            params=(n_parcels,))
+
+    def _run_model(self, model, subj_idx, X, sparse_coefs=None):
+        """ fits the model on each sample (row) of X
+
+        The samples are solved all together when the model supports a
+        multi-target y, and otherwise split between n_jobs processes which
+        share the normalized lead field.
+
+        Returns
+        -------
+        est_coefs : array, shape (n_samples, n_sources), or (n_samples,
+            n_alphas, n_sources) for a grid of alphas
+            absolute value of the coefficients of each source. With
+            sparse_coefs (by default self.sparse_coefs), a CSR matrix of
+            shape (n_samples * n_alphas, n_sources) with the rows of each
+            sample next to each other
+        n_screened : array of int, shape (n_samples, [n_alphas])
+            number of sources discarded by the screening rules of the model
+            (0 for the models without screening)
+        """
+        if sparse_coefs is None:
+            sparse_coefs = self.sparse_coefs
+        operator = self._operator(subj_idx)
+        L, norms = operator.lead_field, operator.norms
+        params, overrides = model.get_params(), {}
+        if self.precompute and 'precompute' in params:
+            overrides['precompute'] = operator.gram
+        if isinstance(params.get('groups'), str):
+            overrides['groups'] = self._dictionary(subj_idx)[1]
+        if overrides:
+            model = clone(model).set_params(**overrides)
+
+        if isinstance(model, _MULTI_TARGET_MODELS):
+            model.fit(L, X.T)
+            est_coefs = _get_coef(model).reshape(len(X), -1)
+            if sparse_coefs:
+                est_coefs = sparse.csr_matrix(est_coefs)
+            n_screened = np.zeros(len(X), dtype=int)
+        elif self.n_jobs == 1 or len(X) == 1:
+            est_coefs, n_screened = _fit_rows(model, L, X, sparse_coefs)
+        else:
+            n_jobs = min(effective_n_jobs(self.n_jobs), len(X))
+            blocks = np.array_split(np.arange(len(X)), n_jobs)
+            results = Parallel(n_jobs=n_jobs)(
+                delayed(_fit_rows)(clone(model), L, X[block], sparse_coefs)
+                for block in blocks)
+            if sparse_coefs:
+                est_coefs = sparse.vstack([r[0] for r in results],
+                                          format='csr')
+            else:
+                est_coefs = np.concatenate([r[0] for r in results], axis=0)
+            n_screened = np.concatenate([r[1] for r in results])
+
+        if sparse_coefs:
+            est_coefs.data = np.abs(est_coefs.data) / norms[est_coefs.indices]
+        else:
+            est_coefs = np.abs(est_coefs)
+            est_coefs /= norms
+        return est_coefs, n_screened
+
+    def decision_function(self, X, out=None):
+        """ maximum over the sources of each parcel of the estimated
+        activations
+
+        Parameters
+        ----------
+        X : DataFrame, or iterable of DataFrames (see
+            simulation.chunking.iter_row_chunks), processed by blocks of
+            chunk_size samples
+        out : array, optional, e.g. a numpy.memmap, where to write betas
+
+        Returns
+        -------
+        betas : array, shape (n_samples, n_parcels), or (n_alphas,
+            n_samples, n_parcels) when the model is fitted for a grid of
+            alphas (ReweightedLasso with an array of alpha_fraction)
+        """
+        n_screened = []
+
+        def decision_block(X_block):
+            betas, n_screened_block = self._cached_decision_block(X_block)
+            n_screened.append(n_screened_block)
+            return betas
+
+        betas = stream_rows(decision_block, X, self.chunk_size, out)
+        self.n_screened_ = np.concatenate(n_screened, axis=-1)
+        return betas
 
-        return est_coefs.T
+    def _cached_decision_block(self, X):
+        if self.cache is None:
+            return self._decision_block(X)
+        return self.cache.wrap(self, self._decision_block,
+                               sample_axes=(-2, -1))(X)
 
-    def decision_function(self, X):
+    def _decision_block(self, X):
+        # betas and numbers of screened sources of a block of samples
         X = X.reset_index(drop=True)
 
         n_parcels = max(max(s) for s in self.parcel_indices)
-        betas = np.empty((len(X), n_parcels))
+        betas = n_screened_all = None
         for subj_idx in np.unique(X['subject_id']):
-            l_used = self.lead_field[subj_idx]
-
-            X_used = X[X['subject_id'] == subj_idx]
-            X_used = X_used.iloc[:, :-2]
-
-            est_coef = self._run_model(self.model, l_used, X_used)
-
-            beta = pd.DataFrame(
-                       np.abs(est_coef)
-                   ).groupby(
-                   self.parcel_indices[subj_idx]).max().transpose()
-            betas[X['subject_id'] == subj_idx] = np.array(beta)
-        return betas
+            mask = (X['subject_id'] == subj_idx).values
+            X_used = X[mask]
+            X_used = X_used.iloc[:, :-2].values
+
+            est_coef, n_screened = self._run_model(self.model, subj_idx,
+                                                   X_used)
+            grid_shape = n_screened.shape[1:]
+            if betas is None:
+                betas = np.empty(grid_shape + (len(X), n_parcels))
+                n_screened_all = np.zeros(grid_shape + (len(X),), dtype=int)
+            n_screened_all[..., mask] = np.moveaxis(n_screened, 0, -1)
+
+            # (n_samples, [n_alphas,] n_parcels)
+            beta = self._parcel_index(subj_idx).reduce(est_coef).reshape(
+                (len(X_used),) + grid_shape + (n_parcels,))
+            betas[..., mask, :] = np.moveaxis(beta, 0, -2)
+        return betas, n_screened_all
+
+    def source_estimates(self, X, fname=None):
+        """ absolute value of the estimated activation of each source, as
+        sparse matrices
+
+        Parameters
+        ----------
+        X : DataFrame, or iterable of DataFrames (see
+            simulation.chunking.iter_row_chunks), processed by blocks of
+            chunk_size samples
+        fname : string, optional, .npz file where the estimates are saved
+            with scipy.sparse.save_npz (not for a grid of alphas)
+
+        Returns
+        -------
+        estimates : CSR matrix, shape (n_samples, n_sources), one row per
+            sample whose columns are the sources (or the atoms, with
+            compression) of the subject of the sample (n_sources is the
+            largest number of them among the subjects). For a grid of
+            alphas, a list of such matrices, one per alpha
+        """
+        n_sources = max(len(self._dictionary(subj_idx)[1])
+                        for subj_idx in range(len(self.lead_field)))
+        blocks = []
+        for X_block in iter_row_chunks(X, self.chunk_size):
+            X_block = X_block.reset_index(drop=True)
+            parts, rows = [], []
+            for subj_idx in np.unique(X_block['subject_id']):
+                subj_rows = np.flatnonzero(
+                    (X_block['subject_id'] == subj_idx).values)
+                est_coef, n_screened = self._run_model(
+                    self.model, subj_idx,
+                    X_block.iloc[subj_rows, :-2].values, sparse_coefs=True)
+                parts.append(sparse.csr_matrix(
+                    (est_coef.data, est_coef.indices, est_coef.indptr),
+                    shape=(est_coef.shape[0], n_sources)))
+                rows.append(subj_rows)
+            # back to the order of the samples, the rows of each sample
+            # (one per alpha) are next to each other
+            n_alphas = int(np.prod(n_screened.shape[1:]))
+            order = np.argsort(np.concatenate(rows))
+            order = (order[:, None] * n_alphas + np.arange(n_alphas)).ravel()
+            blocks.append(sparse.vstack(parts, format='csr')[order])
+        estimates = sparse.vstack(blocks, format='csr')
+
+        if _is_alpha_grid(self.model):
+            if fname is not None:
+                raise ValueError('the estimates of a grid of alphas cannot '
+                                 'be saved in a single file')
+            return [estimates[idx::n_alphas] for idx in range(n_alphas)]
+        if fname is not None:
+            sparse.save_npz(fname, estimates)
+        return estimates
@@ -0,0 +1,54 @@
+""" helpers shared by the tests of the simulation, to run it without the MRI
+and MEG data. They are in an importable module so that the worker
+processes of the simulation can unpickle them """
+import mne
+import numpy as np
+
+N_ELECTRODES = 4
+
+
+def random_signal(parcels, raw_fname, fwd_fname, subject, n_sources_max=3,
+                  random_state=None, signal_type='eeg'):
+    # stands for init_signal, without the mne simulation
+    n_active = random_state.randint(n_sources_max) + 1
+    active = random_state.permutation(len(parcels))[:n_active]
+    data = random_state.randn(N_ELECTRODES)
+    return data, [parcels[idx].name for idx in active], None
+
+
+def make_parcels(n_parcels=5):
+    return [mne.Label([0], hemi='lh', name='%d-lh' % idx)
+            for idx in range(1, n_parcels + 1)]
+
+
+def make_labels(fname, n_parcels=5):
+    np.savez(fname, make_parcels(n_parcels))
+
+
+def _random_leadfield(leadfield_dir, fwd_fname, parcel_vertices, *args):
+    rng = np.random.RandomState(0)
+    return dict(lead_field=rng.randn(N_ELECTRODES, 10),
+                parcel_indices=np.arange(10) % 5 + 1,
+                src_coords=rng.randn(10, 3))
+
+
+def simulate_stubs(simulate, subjects_dir):
+    """ (object, name, value) of the attributes of the simulate script
+    replaced to run it without the data: the labels are not morphed and the
+    lead field is random """
+    return [(simulate.config, 'get_subjects_dir_subj',
+             lambda subject: subjects_dir),
+            (simulate.mne, 'morph_labels',
+             lambda labels, *args: [label.copy() for label in labels]),
+            (simulate, '_get_fnames', lambda *args: (None, None)),
+            (simulate, 'get_leadfield', _random_leadfield)]
+
+
+def run_simulate_subjects(simulate, subjects, n_samples, data_dir, shard=0,
+                          num_shards=1, n_jobs=2):
+    """ simulate_subjects on 5 parcels, with random_signal """
+    return simulate.simulate_subjects(
+        subjects, None, make_parcels(), data_dir, n_samples=n_samples,
+        signal_type='grad', chunk_size=3, n_jobs=n_jobs, shard=shard,
+        num_shards=num_shards, parcellation='random5',
+        signal_func=random_signal)
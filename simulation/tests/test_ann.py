@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pytest
+from sklearn.base import clone
+
+from simulation.ann import LeadfieldIndex, get_leadfield_index
+from simulation.lead_correlate import LeadCorrelate
+from simulation.leadfield import save_leadfield
+from simulation.tests.test_sparse_regressor import make_dataset
+
+
+def test_leadfield_index():
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=2, n_samples_per_subj=10, n_parcels=10, n_sources=200,
+        n_sensors=50, max_true_sources=2
+    )
+    flat = LeadCorrelate(L, parcel_indices).fit(X, y).decision_function(X)
+
+    # searching all the lists is the exact search
+    lc = LeadCorrelate(L, parcel_indices, n_probe=14).fit(X, y)
+    assert [index.n_lists for index in lc.indexes_] == [14, 14]
+    np.testing.assert_allclose(lc.decision_function(X), flat)
+
+    lc.set_params(n_probe=3).fit(X, y)
+    decision = lc.decision_function(X)
+    # max over a part of the sources of the parcels only
+    assert np.all(decision <= flat + 1e-12)
+    assert np.any(decision < flat - 1e-12)
+    assert lc.predict(X).shape == y.shape
+
+    # the copies share the indexes given, which are not built again
+    indexes = lc.indexes_
+    lc = clone(LeadCorrelate(L, parcel_indices, n_probe=3, indexes=indexes))
+    assert lc.fit(X, y).indexes_[0] is indexes[0]
+    np.testing.assert_allclose(lc.decision_function(X), decision)
+
+    # the indexes are of the lead fields which are not compressed
+    lc.set_params(compression=.9)
+    with pytest.raises(ValueError, match='compress'):
+        lc.fit(X, y)
+
+
+def test_get_leadfield_index(tmpdir):
+    rng = np.random.RandomState(42)
+    lead_field = rng.randn(20, 100)
+    parcel_indices = rng.randint(1, 6, size=100)
+    leadfield_dir = os.path.join(str(tmpdir), 'lead_field')
+    save_leadfield(leadfield_dir, lead_field, parcel_indices,
+                   rng.randn(100, 3), 'sample', 'grad', 'aparc_sub')
+
+    index = get_leadfield_index(leadfield_dir, n_lists=5)
+    assert os.path.exists(os.path.join(leadfield_dir, 'ivf_index.npz'))
+    loaded = get_leadfield_index(leadfield_dir, n_lists=5)
+    np.testing.assert_array_equal(loaded.centroids, index.centroids)
+    data = rng.randn(3, 20)
+    data /= np.linalg.norm(data, axis=1)[:, None]
+    np.testing.assert_array_equal(loaded.score_parcels(data, 2),
+                                  index.score_parcels(data, 2))
+
+    # other parameters, the index is built again
+    assert get_leadfield_index(leadfield_dir, n_lists=7).n_lists == 7
+    assert get_leadfield_index(leadfield_dir, n_lists=7,
+                               n_iter=2).n_iter == 2
+    with np.load(os.path.join(leadfield_dir, 'ivf_index.npz')) as saved:
+        assert int(saved['n_iter']) == 2
+
+    # and also when the lead field is saved again
+    lead_field = rng.randn(20, 100)
+    save_leadfield(leadfield_dir, lead_field, parcel_indices,
+                   rng.randn(100, 3), 'sample', 'grad', 'aparc_sub')
+    index = get_leadfield_index(leadfield_dir, n_lists=7, n_iter=2)
+    expected = LeadfieldIndex(lead_field.astype(np.float32), parcel_indices,
+                              n_lists=7, n_iter=2)
+    np.testing.assert_allclose(index.centroids, expected.centroids)
@@ -0,0 +1,119 @@
+import pickle
+
+import numpy as np
+from joblib import hash as joblib_hash
+
+from sklearn.base import clone
+
+import simulation.cache as cache_module
+from simulation.cache import DecisionCache
+from simulation.lead_correlate import LeadCorrelate
+from simulation.sparse_regressor import SparseRegressor, ReweightedLasso
+from simulation.tests.test_sparse_regressor import make_dataset
+
+
+def test_decision_cache():
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=2, n_samples_per_subj=10, n_parcels=10, n_sources=200,
+        n_sensors=50, max_true_sources=2
+    )
+    expected = LeadCorrelate(L, parcel_indices).decision_function(X)
+
+    cache = DecisionCache()
+    lc = LeadCorrelate(L, parcel_indices, cache=cache, chunk_size=7)
+    np.testing.assert_allclose(lc.decision_function(X.iloc[:12]),
+                               expected[:12])
+    assert (cache.hits, cache.misses) == (0, 12)
+
+    # the copies share the cache, the first 12 samples are not computed
+    # again
+    lc = clone(lc)
+    assert lc.cache is cache
+    np.testing.assert_allclose(lc.fit(X, y).decision_function(X),
+                               expected)
+    assert (cache.hits, cache.misses) == (12 + 20, 20)
+    assert len(cache) == 20
+    np.testing.assert_array_equal(lc.predict(X),
+                                  LeadCorrelate(L, parcel_indices).fit(
+                                      X, y).predict(X))
+
+    # other parameters, other values, computed with these parameters
+    compressed = LeadCorrelate(L, parcel_indices, compression=.5).fit(
+        X, y).decision_function(X)
+    assert not np.allclose(compressed, expected)
+    np.testing.assert_allclose(
+        lc.set_params(compression=.5).decision_function(X), compressed)
+    assert len(cache) == 40
+    lc = clone(lc).fit(X, y)
+    np.testing.assert_allclose(lc.decision_function(X), compressed)
+    assert len(cache) == 40
+
+    # the least recently used samples are evicted beyond the budget
+    cache = DecisionCache(max_bytes=5 * (10 * 8 + 200))
+    lc = LeadCorrelate(L, parcel_indices, cache=cache)
+    np.testing.assert_allclose(lc.decision_function(X), expected)
+    assert len(cache) == 5
+    lc.decision_function(X.iloc[-5:])
+    assert cache.hits == 5
+
+
+def test_decision_cache_sparse_regressor():
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=2, n_samples_per_subj=5, n_parcels=10, n_sources=200,
+        n_sensors=50, max_true_sources=2
+    )
+    model = ReweightedLasso(alpha_fraction=[.3, .1])
+    sparse_regressor = SparseRegressor(L, parcel_indices, model)
+    expected = sparse_regressor.decision_function(X)
+    n_screened = sparse_regressor.n_screened_
+
+    sparse_regressor.set_params(cache=DecisionCache())
+    sparse_regressor.decision_function(X.iloc[:4])
+    np.testing.assert_allclose(sparse_regressor.decision_function(X),
+                               expected, rtol=1e-6)
+    np.testing.assert_array_equal(sparse_regressor.n_screened_, n_screened)
+    assert sparse_regressor.cache.hits == 4
+
+
+def test_decision_cache_params_key(monkeypatch):
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=2, n_samples_per_subj=10, n_parcels=10, n_sources=200,
+        n_sensors=50, max_true_sources=2
+    )
+    hashed = []
+
+    def count_hash(params):
+        hashed.append(params)
+        return joblib_hash(params)
+
+    monkeypatch.setattr(cache_module, 'joblib_hash', count_hash)
+    lc = LeadCorrelate(L, parcel_indices, cache=DecisionCache(),
+                       chunk_size=3)
+    # the parameters (and the lead fields) are hashed once, not for each
+    # block of samples
+    lc.fit(X, y).decision_function(X)
+    assert len(hashed) == 1
+    # and again once they changed
+    lc.set_params(compression=.5).decision_function(X)
+    lc.decision_function(X)
+    assert len(hashed) == 2
+    lc.set_params(chunk_size=5).decision_function(X)
+    assert len(hashed) == 2
+
+
+def test_decision_cache_pickle():
+    X, y, L, parcel_indices = make_dataset(n_subjects=1,
+                                           n_samples_per_subj=5)
+    cache = DecisionCache(max_bytes=int(1e6))
+    lc = LeadCorrelate(L, parcel_indices, cache=cache)
+    lc.decision_function(X)
+    # as in the tasks received by a worker: the copies start empty, and all
+    # the copies of a cache unpickled in a process are the same cache
+    copies = [pickle.loads(pickle.dumps(lc)) for _ in range(2)]
+    assert copies[0].cache is copies[1].cache
+    assert copies[0].cache is not cache
+    assert len(copies[0].cache) == 0
+    assert copies[0].cache.max_bytes == int(1e6)
+    copies[0].decision_function(X)
+    copies[1].decision_function(X)
+    assert copies[1].cache.hits == len(X)
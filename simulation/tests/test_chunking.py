@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+import pytest
+
+from simulation.chunking import stream_rows
+from simulation.lead_correlate import LeadCorrelate
+from simulation.sparse_regressor import ReweightedLasso, SparseRegressor
+from simulation.tests.test_sparse_regressor import make_dataset
+
+
+def _split(X, sizes):
+    start = 0
+    for size in sizes:
+        yield X.iloc[start:start + size]
+        start += size
+
+
+@pytest.mark.parametrize('estimator', ['sparse_regressor', 'lead_correlate'])
+def test_chunked_decision_function(tmpdir, estimator):
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=2, n_samples_per_subj=10, n_parcels=10, n_sources=200,
+        n_sensors=50, max_true_sources=2
+    )
+    if estimator == 'sparse_regressor':
+        model = ReweightedLasso(alpha_fraction=[.1, .5], max_iter=20,
+                                max_iter_reweighting=1)
+        est = SparseRegressor(L, parcel_indices, model)
+    else:
+        est = LeadCorrelate(L, parcel_indices).fit(X, y)
+    betas = est.decision_function(X)
+    y_pred = est.predict(X)
+
+    est.set_params(chunk_size=3)
+    np.testing.assert_allclose(est.decision_function(X), betas)
+    np.testing.assert_array_equal(est.predict(X), y_pred)
+
+    # from an iterator of DataFrames, e.g. pd.read_csv(..., chunksize=...)
+    np.testing.assert_allclose(
+        est.decision_function(_split(X, [7, 1, 12])), betas)
+    np.testing.assert_array_equal(est.predict(_split(X, [12, 8])), y_pred)
+
+    # into a memmap
+    out = np.lib.format.open_memmap(os.path.join(str(tmpdir), 'betas.npy'),
+                                    mode='w+', shape=betas.shape)
+    assert est.decision_function(_split(X, [5, 15]), out=out) is out
+    out.flush()
+    np.testing.assert_allclose(
+        np.load(os.path.join(str(tmpdir), 'betas.npy')), betas)
+
+
+def test_stream_rows_wrong_out():
+    X, y, L, parcel_indices = make_dataset(n_samples_per_subj=5)
+    with pytest.raises(ValueError, match='samples'):
+        stream_rows(lambda block: block.values[:, :2], _split(X, [2, 2]),
+                    2, out=np.empty((5, 2)))
+
+
+def test_stream_rows_empty():
+    X, y, L, parcel_indices = make_dataset(n_samples_per_subj=5)
+    for X_empty in [X.iloc[:0], _split(X, []), _split(X, [0, 0])]:
+        with pytest.raises(ValueError, match='no samples'):
+            stream_rows(lambda block: block.values[:, :2], X_empty, 2)
+    # the shape of the results is known from out
+    out = np.empty((3, 0, 2))
+    assert stream_rows(lambda block: block.values[:, :2], X.iloc[:0], 2,
+                       out=out) is out
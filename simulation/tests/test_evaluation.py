@@ -0,0 +1,46 @@
+import numpy as np
+
+from sklearn.model_selection import train_test_split
+
+from simulation.cache import DecisionCache
+from simulation.evaluation import run_learning_curves, run_predictions
+from simulation.lead_correlate import LeadCorrelate
+from simulation.tests.test_sparse_regressor import make_dataset
+
+
+def test_run_learning_curves():
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=2, n_samples_per_subj=20, n_parcels=10, n_sources=200,
+        n_sensors=50, max_true_sources=2
+    )
+    models = {'lead correlate': LeadCorrelate(L, parcel_indices),
+              'cached': LeadCorrelate(L, parcel_indices,
+                                      cache=DecisionCache())}
+    folds = [train_test_split(np.arange(40), test_size=.2, random_state=0)
+             for _ in range(2)]
+    scores = run_learning_curves(X, y, models, [10, 30], folds=folds,
+                                 n_jobs=2)
+    assert len(scores) == 2 * 2 * 2
+    assert np.all(scores['wall_time'] > 0)
+    assert set(scores['model_name']) == set(models)
+    # the 4 tasks of the model with a cache run on 2 processes, the tasks
+    # run by the same process share its copy of the cache: the samples of
+    # the previous points are not computed again
+    cached = scores[scores['model_name'] == 'cached']
+    assert cached['cache_hits'].sum() > 0
+    assert np.all(scores['cache_hits'][scores['model_name'] !=
+                                       'cached'] == 0)
+
+    # same scores as fitting in the main process
+    train, test = folds[0]
+    model = LeadCorrelate(L, parcel_indices).fit(X.iloc[train[:10]],
+                                                 y[train[:10]])
+    expected = np.mean(model.predict(X.iloc[test]) != y[test])
+    score = scores.query("model_name == 'cached' and fold == 0 and "
+                         "n_samples_train == 10")['score_test']
+    np.testing.assert_allclose(score, expected)
+
+    y_pred = run_predictions(X, y, models, train, test, n_jobs=2)
+    np.testing.assert_array_equal(y_pred['lead correlate'],
+                                  y_pred['cached'])
+    assert y_pred['cached'].shape == (len(test), 10)
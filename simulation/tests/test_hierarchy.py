@@ -0,0 +1,38 @@
+import numpy as np
+
+from simulation.hierarchy import CoarseToFine, coarse_parcels
+from simulation.lead_correlate import LeadCorrelate
+from simulation.tests.test_sparse_regressor import make_dataset
+
+
+def test_coarse_parcels():
+    parents, parent_names = coarse_parcels(
+        ['precuneus_2-rh', 'bankssts_1-lh', 'precuneus_1-rh', 'insula-lh',
+         'bankssts_2-lh'])
+    np.testing.assert_array_equal(parent_names,
+                                  ['bankssts-lh', 'insula-lh',
+                                   'precuneus-rh'])
+    np.testing.assert_array_equal(parents, [3, 1, 3, 2, 1])
+
+
+def test_coarse_to_fine():
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=2, n_samples_per_subj=10, n_parcels=12, n_sources=300,
+        n_sensors=50, max_true_sources=2
+    )
+    # 12 parcels in 6 regions, in 2 lobes
+    parents = [np.repeat(np.arange(1, 7), 2), np.repeat([1, 2], 3)]
+    flat = LeadCorrelate(L, parcel_indices).fit(X, y).decision_function(X)
+
+    # refining all the regions is the flat search
+    model = CoarseToFine(L, parcel_indices, parents, n_candidates=6)
+    np.testing.assert_allclose(model.fit(X, y).decision_function(X), flat)
+
+    model = CoarseToFine(L, parcel_indices, parents, n_candidates=1)
+    decision = model.fit(X, y).decision_function(X)
+    assert decision.shape == y.shape
+    # only the 2 parcels of a single region are scored
+    assert np.all((decision > 0).sum(axis=1) <= 2)
+    refined = decision > 0
+    np.testing.assert_allclose(decision[refined], flat[refined])
+    assert model.predict(X).shape == y.shape
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from sklearn.multioutput import MultiOutputClassifier
+from sklearn.neighbors import KNeighborsClassifier
+
+from simulation.knn import MultilabelKNN
+from simulation.tests.test_sparse_regressor import make_dataset
+
+
+@pytest.mark.parametrize('n_neighbors', [3, 4])
+def test_multilabel_knn(n_neighbors):
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=2, n_samples_per_subj=50, n_parcels=10, n_sources=100,
+        n_sensors=20, max_true_sources=3
+    )
+    X_train, X_test, y_train = X.iloc[:70], X.iloc[70:], y[:70]
+
+    knn = MultilabelKNN(n_neighbors=n_neighbors, chunk_size=7)
+    y_pred = knn.fit(X_train, y_train).predict(X_test)
+    # subject_id is one of the features
+    features = X.columns != 'subject'
+    expected = MultiOutputClassifier(KNeighborsClassifier(n_neighbors)).fit(
+        X_train.loc[:, features], y_train).predict(X_test.loc[:, features])
+    np.testing.assert_array_equal(y_pred, expected)
+
+    decision = knn.decision_function(X_test)
+    np.testing.assert_array_equal(decision > .5, y_pred)
+
+
+def test_multilabel_knn_pca():
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=1, n_samples_per_subj=50, n_parcels=10, n_sources=100,
+        n_sensors=20, max_true_sources=3
+    )
+    # all the components: the same neighbours as in the sensor space
+    knn = MultilabelKNN(normalize=True).fit(X, y)
+    knn_pca = MultilabelKNN(normalize=True, n_components=20).fit(X, y)
+    np.testing.assert_array_equal(knn_pca.predict(X), knn.predict(X))
+    knn_pca.set_params(n_components=5).fit(X, y)
+    assert knn_pca.pca_.n_components_ == 5
+    assert knn_pca.predict(X).shape == y.shape
@@ -0,0 +1,62 @@
+import numpy as np
+
+from simulation.lead_correlate import LeadCorrelate
+from simulation.tests.test_sparse_regressor import make_dataset
+
+
+def test_lead_correlate_decision_function():
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=2, n_samples_per_subj=10, n_parcels=10, n_sources=200,
+        n_sensors=50, max_true_sources=2
+    )
+    # interleave the samples of the subjects
+    X = X.iloc[np.argsort(np.arange(len(X)) % 10, kind='stable')]
+    y = y[np.argsort(np.arange(len(y)) % 10, kind='stable')]
+
+    lc = LeadCorrelate(L, parcel_indices).fit(X, y)
+    correlation = lc.decision_function(X)
+    assert correlation.shape == (20, 10)
+
+    for idx in range(len(X)):
+        subj_idx = X['subject_id'].iloc[idx]
+        x = X.iloc[idx, :-2].values.astype(float)
+        lead_field = L[subj_idx] / np.linalg.norm(L[subj_idx], axis=0)
+        corr = np.abs(lead_field.T @ x) / np.linalg.norm(x)
+        expected = [corr[parcel_indices[subj_idx] == parcel].max()
+                    for parcel in range(1, 11)]
+        np.testing.assert_allclose(correlation[idx], expected)
+
+    y_pred = lc.predict(X)
+    assert y_pred.shape == y.shape
+    assert np.all(y_pred.sum(axis=1) >= 1)
+    assert np.all(y_pred.sum(axis=1) <= lc.max_active_sources_)
+
+
+def test_lead_correlate_predict():
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=2, n_samples_per_subj=10, n_parcels=10, n_sources=200,
+        n_sensors=50, max_true_sources=3
+    )
+    lc = LeadCorrelate(L, parcel_indices, chunk_size=3).fit(X, y)
+    corr = lc.decision_function(X)
+    for threshold in [0., np.median(corr), 1.]:
+        lc.threshold_ = threshold
+        y_pred = lc.predict(X)
+        for idx, corr_row in enumerate(corr):
+            above = np.flatnonzero(corr_row >= threshold)
+            if len(above) > lc.max_active_sources_:
+                above = np.argsort(corr_row)[-lc.max_active_sources_:]
+            elif not len(above):
+                above = [np.argmax(corr_row)]
+            assert set(np.flatnonzero(y_pred[idx])) == set(above)
+
+
+def test_lead_correlate_compression():
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=2, n_samples_per_subj=10, n_parcels=10, n_sources=200,
+        n_sensors=50, max_true_sources=2
+    )
+    lc = LeadCorrelate(L, parcel_indices, compression=.9).fit(X, y)
+    assert lc.decision_function(X).shape == y.shape
+    assert all(lead_field.shape[1] < 200
+               for lead_field in lc.lead_field_normalized_)
@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+
+from simulation.leadfield import compress_leadfield, read_leadfield
+from simulation.leadfield import save_leadfield
+
+
+def test_save_read_leadfield(tmpdir):
+    rng = np.random.RandomState(42)
+    lead_field = rng.randn(20, 50)
+    parcel_indices = rng.randint(1, 6, size=50)
+    src_coords = rng.randn(50, 3)
+    leadfield_dir = os.path.join(str(tmpdir), 'lead_field')
+
+    save_leadfield(leadfield_dir, lead_field, parcel_indices, src_coords,
+                   'sample', 'grad', 'aparc_sub')
+    leadfield = read_leadfield(leadfield_dir)
+
+    assert isinstance(leadfield['lead_field'], np.memmap)
+    assert leadfield['lead_field'].dtype == np.float32
+    np.testing.assert_allclose(leadfield['lead_field'], lead_field,
+                               rtol=1e-6)
+    np.testing.assert_array_equal(leadfield['parcel_indices'],
+                                  parcel_indices)
+    np.testing.assert_array_equal(leadfield['src_coords'], src_coords)
+    assert leadfield['subject'] == 'sample'
+    assert leadfield['signal_type'] == 'grad'
+    assert leadfield['parcellation'] == 'aparc_sub'
+
+    leadfield = read_leadfield(leadfield_dir, mmap_mode=None)
+    assert not isinstance(leadfield['lead_field'], np.memmap)
+
+
+def test_compress_leadfield():
+    rng = np.random.RandomState(42)
+    parcel_indices = np.repeat([1, 0, 3, 2], 30)
+    # parcel 1 is of rank 2, parcel 2 of rank 5
+    lead_field = rng.randn(20, 120)
+    lead_field[:, :30] = rng.randn(20, 2) @ rng.randn(2, 30)
+    lead_field[:, 90:] = rng.randn(20, 5) @ rng.randn(5, 30)
+
+    atoms, atom_parcels = compress_leadfield(lead_field, parcel_indices,
+                                             explained_variance=1.)
+    np.testing.assert_array_equal(np.bincount(atom_parcels), [0, 2, 5, 20])
+    for parcel in [1, 2, 3]:
+        # the atoms span the columns of their parcel
+        columns = lead_field[:, parcel_indices == parcel]
+        parcel_atoms = atoms[:, atom_parcels == parcel]
+        projection = parcel_atoms @ np.linalg.lstsq(parcel_atoms, columns,
+                                                    rcond=None)[0]
+        np.testing.assert_allclose(projection, columns, atol=1e-10)
+        np.testing.assert_allclose(np.linalg.norm(parcel_atoms),
+                                   np.linalg.norm(columns))
+
+    atoms, atom_parcels = compress_leadfield(lead_field, parcel_indices,
+                                             explained_variance=.9,
+                                             max_rank=4)
+    assert np.bincount(atom_parcels)[1] == 2
+    assert np.all(np.bincount(atom_parcels)[2:] <= 4)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from simulation.linear_inverse import LinearInverse, compute_inverse_kernel
+from simulation.tests.test_sparse_regressor import make_dataset
+
+
+@pytest.mark.parametrize('method', ['MNE', 'dSPM'])
+def test_linear_inverse(method):
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=2, n_samples_per_subj=10, n_parcels=10, n_sources=200,
+        n_sensors=50, max_true_sources=2
+    )
+    model = LinearInverse(L, parcel_indices, method=method, depth=None,
+                          chunk_size=7).fit(X, y)
+    decision = model.decision_function(X)
+    assert decision.shape == (20, 10)
+
+    for idx in range(len(X)):
+        subj_idx = X['subject_id'].iloc[idx]
+        x = X.iloc[idx, :-2].values.astype(float)
+        gain = L[subj_idx]
+        scale = np.trace(gain @ gain.T) / len(gain)
+        kernel = gain.T @ np.linalg.inv(gain @ gain.T + scale / 9 *
+                                        np.eye(len(gain)))
+        if method == 'dSPM':
+            kernel /= np.linalg.norm(kernel, axis=1)[:, None]
+        estimates = np.abs(kernel @ x)
+        expected = [estimates[parcel_indices[subj_idx] == parcel].max()
+                    for parcel in range(1, 11)]
+        np.testing.assert_allclose(decision[idx], expected, rtol=1e-6)
+
+    y_pred = model.predict(X)
+    assert y_pred.shape == y.shape
+    assert np.all(y_pred.sum(axis=1) >= 1)
+
+
+def test_inverse_kernel_whitening():
+    rng = np.random.RandomState(42)
+    lead_field = rng.randn(20, 60)
+    kernel = compute_inverse_kernel(lead_field)
+    # a white noise of any variance leaves the MNE estimates unchanged
+    whitened = compute_inverse_kernel(lead_field, whitener=np.eye(20) / 3.)
+    np.testing.assert_allclose(whitened, kernel)
+    with pytest.raises(ValueError, match='method'):
+        compute_inverse_kernel(lead_field, method='eLORETA')
@@ -0,0 +1,114 @@
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+import pytest
+
+from simulation.metrics import (FROCAccumulator, afroc_score, calc_afroc,
+                                calc_froc, froc_score)
+
+
+def _froc_brute_force(y_true, y_score):
+    # positives above or equal to each distinct score, from the highest
+    thresholds = np.unique(y_score)[::-1]
+    positive = y_score.ravel()[None, :] >= thresholds[:, None]
+    tps = np.sum(positive & (y_true.ravel() == 1), axis=1)
+    fps = np.sum(positive & (y_true.ravel() == 0), axis=1)
+    return tps / y_true.sum(), fps / len(y_true), thresholds
+
+
+@pytest.mark.parametrize('n_levels', [None, 5])
+def test_calc_froc(n_levels):
+    rng = np.random.RandomState(0)
+    y_true = (rng.rand(40, 10) < .2).astype(int)
+    y_score = y_true + rng.randn(40, 10)
+    if n_levels is not None:
+        # many ties, between positives and negatives
+        y_score = np.round(y_score * n_levels) / n_levels
+
+    ts, tfp, thresholds = calc_froc(y_true, y_score)
+    ts_expected, tfp_expected, thresholds_expected = \
+        _froc_brute_force(y_true, y_score)
+    assert_array_equal(thresholds, thresholds_expected)
+    assert_allclose(ts, ts_expected)
+    assert_allclose(tfp, tfp_expected)
+    assert ts[-1] == 1.
+    assert tfp[-1] == (1 - y_true).sum() / len(y_true)
+
+    _, fpf, _ = calc_afroc(y_true, y_score)
+    assert_allclose(fpf, 1 - np.exp(-tfp_expected))
+    assert_allclose(froc_score(y_true, y_score),
+                    np.trapz(ts_expected, tfp_expected))
+    assert_allclose(afroc_score(y_true, y_score),
+                    np.trapz(ts_expected, 1 - np.exp(-tfp_expected)))
+
+
+def test_calc_froc_ties():
+    # the samples tied with the first occurrence of a score are counted too
+    y_true = np.array([[1, 0], [1, 0], [0, 1]])
+    y_score = np.array([[.9, .9], [.5, .1], [.5, .5]])
+    ts, tfp, thresholds = calc_froc(y_true, y_score)
+    assert_array_equal(thresholds, [.9, .5, .1])
+    assert_allclose(ts, [1 / 3., 1., 1.])
+    assert_allclose(tfp, [1 / 3., 2 / 3., 1.])
+
+
+def test_calc_froc_not_binary():
+    with pytest.raises(ValueError, match='binary'):
+        calc_froc(np.ones((3, 2)), np.zeros((3, 2)))
+
+
+def _scores(seed=0, n_samples=60, n_levels=None):
+    rng = np.random.RandomState(seed)
+    y_true = (rng.rand(n_samples, 10) < .2).astype(int)
+    y_score = y_true + rng.randn(n_samples, 10)
+    if n_levels is not None:
+        y_score = np.round(y_score * n_levels) / n_levels
+    return y_true, y_score
+
+
+@pytest.mark.parametrize('n_levels', [None, 5])
+def test_froc_accumulator_exact(n_levels):
+    y_true, y_score = _scores(n_levels=n_levels)
+    # two workers, each with its own batches
+    workers = [FROCAccumulator(), FROCAccumulator()]
+    for idx, batch in enumerate(np.array_split(np.arange(60), 5)):
+        workers[idx % 2].update(y_true[batch], y_score[batch])
+    accumulator = workers[0].merge(workers[1])
+    assert accumulator.n_samples_ == 60
+
+    for result, expected in zip(accumulator.calc_froc(),
+                                calc_froc(y_true, y_score)):
+        assert_array_equal(result, expected)
+    for result, expected in zip(accumulator.calc_afroc(),
+                                calc_afroc(y_true, y_score)):
+        assert_array_equal(result, expected)
+    assert accumulator.froc_score() == froc_score(y_true, y_score)
+    assert accumulator.afroc_score() == afroc_score(y_true, y_score)
+    assert accumulator.error_bound() == 0.
+
+
+def test_froc_accumulator_binned():
+    y_true, y_score = _scores(n_samples=500)
+    accumulator = FROCAccumulator(n_bins=200, score_range=(-2, 3))
+    other = FROCAccumulator(n_bins=200, score_range=(-2, 3))
+    accumulator.update(y_true[:200], y_score[:200])
+    other.update(y_true[200:], y_score[200:])
+    accumulator.merge(other)
+
+    # the points of the binned curve are points of the exact curve
+    ts, tfp, thresholds = calc_froc(y_true, y_score)
+    ts_binned, tfp_binned, _ = accumulator.calc_froc()
+    points = set(zip(ts, tfp))
+    assert all(point in points for point in zip(ts_binned, tfp_binned))
+    assert len(ts_binned) < len(ts)
+
+    for afroc, score in [(False, froc_score), (True, afroc_score)]:
+        area = (accumulator.afroc_score() if afroc else
+                accumulator.froc_score())
+        bound = accumulator.error_bound(afroc=afroc)
+        assert abs(area - score(y_true, y_score)) <= bound
+        assert bound < .05
+
+    with pytest.raises(ValueError, match='same bins'):
+        accumulator.merge(FROCAccumulator(n_bins=10, score_range=(-2, 3)))
+    with pytest.raises(ValueError, match='score_range'):
+        FROCAccumulator(n_bins=10)
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import pytest
+
+from simulation.parcel_index import ParcelIndex
+
+
+@pytest.mark.parametrize('how', ['max', 'sum', 'mean'])
+def test_parcel_index(how):
+    rng = np.random.RandomState(42)
+    parcel_indices = rng.randint(0, 6, size=100)
+    parcel_indices[parcel_indices == 4] = 5  # parcel 4 has no source
+    scores = np.abs(rng.randn(7, 100))
+
+    parcel_index = ParcelIndex(parcel_indices, n_parcels=6)
+    reduced = parcel_index.reduce(scores, how=how)
+    assert reduced.shape == (7, 6)
+
+    expected = (pd.DataFrame(scores.T).groupby(parcel_indices).agg(how)
+                .drop(index=0).transpose())
+    np.testing.assert_allclose(reduced[:, expected.columns - 1], expected)
+    np.testing.assert_array_equal(reduced[:, 3], 0)
+
+    # also for a grid of alphas, and in a given output
+    out = np.full((2, 7, 6), np.nan)
+    parcel_index.reduce(np.stack([scores, 2 * scores]), how=how, out=out)
+    np.testing.assert_allclose(out[1], 2 * reduced)
+
+
+def test_parcel_index_sorted():
+    parcel_indices = np.repeat(np.arange(1, 4), 3)
+    parcel_index = ParcelIndex(parcel_indices)
+    scores = np.arange(9.)
+    np.testing.assert_array_equal(parcel_index.reduce(scores), [2, 5, 8])
+    with pytest.raises(ValueError, match='sources'):
+        parcel_index.reduce(np.arange(8.))
+
+
+@pytest.mark.parametrize('how', ['max', 'sum', 'mean'])
+def test_parcel_index_sparse(how):
+    rng = np.random.RandomState(0)
+    parcel_indices = rng.randint(0, 6, size=100)
+    scores = np.abs(rng.randn(7, 100)) * (rng.rand(7, 100) < .1)
+
+    parcel_index = ParcelIndex(parcel_indices, n_parcels=7)
+    np.testing.assert_allclose(
+        parcel_index.reduce(sparse.csr_matrix(scores), how=how),
+        parcel_index.reduce(scores, how=how))
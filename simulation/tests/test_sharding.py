@@ -0,0 +1,97 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from scipy import sparse
+
+from simulation.sharding import merge_shards, sample_random_state
+from simulation.sharding import shard_indices
+from simulation.tests.helpers import run_simulate_subjects, simulate_stubs
+
+import simulate
+
+SUBJECTS = ['CC120008', 'CC110033', 'sample']
+N_SAMPLES = 11
+
+# simulates the shard given on the command line with simulate_subjects, in
+# its own interpreter
+SHARD_SCRIPT = """
+import sys
+
+import simulate
+from simulation.tests.helpers import run_simulate_subjects, simulate_stubs
+
+data_dir, shard, num_shards = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+for obj, name, value in simulate_stubs(simulate, sys.argv[4]):
+    setattr(obj, name, value)
+run_simulate_subjects(simulate, {subjects!r}, {n_samples}, data_dir, shard,
+                      num_shards)
+"""
+
+
+@pytest.fixture
+def stub_simulate(monkeypatch, tmpdir):
+    for obj, name, value in simulate_stubs(simulate, str(tmpdir)):
+        monkeypatch.setattr(obj, name, value)
+
+
+def _run_shards(data_dir, num_shards, subjects_dir):
+    # each shard in a separate process, all at the same time
+    script = SHARD_SCRIPT.format(subjects=SUBJECTS, n_samples=N_SAMPLES)
+    root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    processes = [subprocess.Popen([sys.executable, '-c', script, data_dir,
+                                   str(shard), str(num_shards),
+                                   subjects_dir], env=env, cwd=subjects_dir)
+                 for shard in range(num_shards)]
+    assert all(process.wait() == 0 for process in processes)
+    return merge_shards(data_dir, num_shards)
+
+
+def test_shard_indices():
+    n_shards = 4
+    shards = [shard_indices(SUBJECTS, N_SAMPLES, shard, n_shards)
+              for shard in range(n_shards)]
+    for subject in SUBJECTS:
+        all_indices = np.concatenate([s[subject] for s in shards])
+        assert np.array_equal(np.sort(all_indices), np.arange(N_SAMPLES))
+    with pytest.raises(ValueError, match='shard'):
+        shard_indices(SUBJECTS, N_SAMPLES, 4, n_shards)
+
+
+def test_sample_random_state():
+    rand = sample_random_state(42, 'sample', 3).randint(1000, size=5)
+    assert np.array_equal(
+        rand, sample_random_state(42, 'sample', 3).randint(1000, size=5))
+    assert not np.array_equal(
+        rand, sample_random_state(42, 'sample', 4).randint(1000, size=5))
+    assert not np.array_equal(
+        rand, sample_random_state(42, 'CC120008', 3).randint(1000, size=5))
+
+
+def test_merge_shards(tmpdir, stub_simulate):
+    single_dir = os.path.join(str(tmpdir), 'single')
+    sharded_dir = os.path.join(str(tmpdir), 'sharded')
+    # unsharded simulation, saved by simulate_subjects itself
+    single_dirs = sorted(run_simulate_subjects(simulate, SUBJECTS, N_SAMPLES,
+                                               single_dir))
+    sharded_dirs = _run_shards(sharded_dir, 3, str(tmpdir))
+
+    assert len(single_dirs) == len(sharded_dirs) == len(SUBJECTS)
+    for single, sharded in zip(single_dirs, sharded_dirs):
+        assert os.path.basename(single) == os.path.basename(sharded)
+        X_single = pd.read_csv(os.path.join(single, 'X.csv'))
+        X_sharded = pd.read_csv(os.path.join(sharded, 'X.csv'))
+        assert X_sharded.shape == (N_SAMPLES, 4)
+        pd.testing.assert_frame_equal(X_single, X_sharded)
+
+        y_single = sparse.load_npz(os.path.join(single, 'target.npz'))
+        y_sharded = sparse.load_npz(os.path.join(sharded, 'target.npz'))
+        assert (y_single != y_sharded).nnz == 0
+        assert set(y_sharded.sum(axis=1).A1) <= {1, 2, 3}
+        # the lead field is exported by one of the shards
+        assert os.path.exists(os.path.join(sharded, 'lead_field.npz'))
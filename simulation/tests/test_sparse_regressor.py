@@ -6,11 +6,16 @@ from mne import read_labels_from_annot
 import numpy as np
 import os
 import pandas as pd
+from scipy import sparse
 
 from sklearn import linear_model
+from sklearn.base import clone
 from sklearn.metrics import hamming_loss
 
 from simulation.sparse_regressor import SparseRegressor, ReweightedLasso
+from simulation.sparse_regressor import gap_safe_screening
+from simulation.sparse_regressor import BatchedOMP, batched_omp
+from simulation.leadfield import LeadfieldOperator
 
 SEED = 42
 
@@ -216,12 +221,14 @@ rwl1 = ReweightedLasso(alpha_fraction=.01, max_iter=20,
                        max_iter_reweighting=1, tol=1e-4)
 rwl10 = ReweightedLasso(alpha_fraction=.01, max_iter=20,
                         max_iter_reweighting=10, tol=1e-4)
+omp = BatchedOMP(n_nonzero_coefs=2)
 
 
 @pytest.mark.parametrize('model, hl_max',
                          [(lasso, 0.02),
                           (rwl1, 0),
-                          (rwl10, 0.002)
+                          (rwl10, 0.002),
+                          (omp, 0.002)
                           ])
 def test_sparse_regressor(model, hl_max):
     n_subjects = 1
@@ -282,3 +289,260 @@ def test_sparse_regressor_on_sample(make_dataset_from_sample, model, hl_max,
     hl = hamming_loss(y_pred, y)
     assert np.sum(y_pred) > 0
     assert hl <= hl_max
+
+
+@pytest.mark.parametrize('model', [lasso, rwl10])
+def test_sparse_regressor_batched(model):
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=2, n_samples_per_subj=10, n_parcels=10, n_sources=200,
+        n_sensors=50, max_true_sources=2
+    )
+    sparse_regressor = SparseRegressor(L, parcel_indices, model)
+    est_coefs, _ = sparse_regressor._run_model(model, 0,
+                                               X.iloc[:10, :-2].values)
+    assert est_coefs.shape == (10, 200)
+
+    # same as fitting the samples one by one
+    operator = sparse_regressor._operator(0)
+    L_normalized, norms = operator.lead_field, operator.norms
+    for idx in range(10):
+        model.fit(L_normalized, X.iloc[idx, :-2].values)
+        np.testing.assert_allclose(est_coefs[idx],
+                                   np.abs(model.coef_) / norms)
+
+    # splitting the samples between processes does not change the results
+    betas = sparse_regressor.decision_function(X)
+    sparse_regressor.set_params(n_jobs=2)
+    np.testing.assert_allclose(sparse_regressor.decision_function(X), betas)
+
+
+@pytest.mark.parametrize('model', [lasso, rwl1, rwl10])
+def test_sparse_regressor_precompute(model):
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=2, n_samples_per_subj=10, n_parcels=10, n_sources=200,
+        n_sensors=50, max_true_sources=2
+    )
+    betas = SparseRegressor(L, parcel_indices, model).decision_function(X)
+    sparse_regressor = SparseRegressor(L, parcel_indices, model,
+                                       precompute=True)
+    np.testing.assert_allclose(sparse_regressor.decision_function(X), betas,
+                               atol=1e-12)
+    operator = sparse_regressor._operator(1)
+    np.testing.assert_allclose(np.diag(operator.gram), 1.)
+
+
+def test_reweighted_lasso_cd():
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=1, n_samples_per_subj=5, n_parcels=10, n_sources=300,
+        n_sensors=50, max_true_sources=2
+    )
+    L_normalized = L[0] / np.linalg.norm(L[0], axis=0)
+    lars = ReweightedLasso(max_iter_reweighting=10, tol=1e-8)
+    cd = ReweightedLasso(max_iter_reweighting=10, tol=1e-8, solver='cd')
+    for idx in range(5):
+        x = X.iloc[idx, :-2].values
+        lars.fit(L_normalized, x)
+        cd.fit(L_normalized, x)
+        np.testing.assert_allclose(cd.coef_, lars.coef_, atol=1e-5)
+        np.testing.assert_allclose(cd.loss_[-1], lars.loss_[-1], rtol=1e-6)
+        assert len(cd.n_iter_) == len(cd.dual_gaps_) == len(cd.loss_)
+        # warm started steps need fewer sweeps than the first one
+        assert cd.n_iter_[-1] <= cd.n_iter_[0]
+        for gaps in cd.dual_gaps_:
+            assert gaps[-1] <= 1e-8 * (x @ x) / len(x)
+
+
+def test_gap_safe_screening():
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=1, n_samples_per_subj=1, n_parcels=10, n_sources=300,
+        n_sensors=50, max_true_sources=2
+    )
+    L_normalized = L[0] / np.linalg.norm(L[0], axis=0)
+    x = X.iloc[0, :-2].values.astype(float)
+    alpha = 0.3 * abs(L_normalized.T @ x).max() / len(x)
+    coef = linear_model.Lasso(alpha=alpha, fit_intercept=False,
+                              tol=1e-12).fit(L_normalized, x).coef_
+
+    # from a rough solution, none of the discarded sources is active
+    rough = np.where(abs(coef) > 1e-2 * abs(coef).max(), coef, 0) * 0.9
+    residual = x - L_normalized @ rough
+    keep, gap = gap_safe_screening(
+        L_normalized.T @ residual, residual @ residual, x @ residual,
+        abs(rough).sum(), len(x) * alpha, np.ones(300))
+    assert gap > 0
+    assert 0 < keep.sum() < 300
+    assert not coef[~keep].any()
+
+
+@pytest.mark.parametrize('solver', ['lars', 'cd'])
+def test_reweighted_lasso_screening(solver):
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=1, n_samples_per_subj=5, n_parcels=10, n_sources=300,
+        n_sensors=50, max_true_sources=2
+    )
+    model = ReweightedLasso(max_iter=20, max_iter_reweighting=10,
+                            solver=solver)
+    sparse_regressor = SparseRegressor(L, parcel_indices, model)
+    betas = sparse_regressor.decision_function(X)
+    assert sparse_regressor.n_screened_.shape == (5,)
+    assert np.all(sparse_regressor.n_screened_ > 250)
+
+    model.set_params(screening=False)
+    np.testing.assert_allclose(sparse_regressor.decision_function(X), betas,
+                               rtol=1e-6, atol=1e-12)
+
+
+def test_reweighted_lasso_cd_screening_at_optimum():
+    # the active sources must not be screened when the duality gap is down
+    # to rounding errors
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=1, n_samples_per_subj=3, n_parcels=50, n_sources=3000,
+        n_sensors=200, max_true_sources=3
+    )
+    L_normalized = LeadfieldOperator(L[0]).lead_field
+    x = X.iloc[0, :-2].values.astype(float)
+    model = ReweightedLasso(alpha_fraction=.3, max_iter=5000,
+                            max_iter_reweighting=1, tol=1e-8, solver='cd')
+    model.fit(L_normalized, x)
+    alpha = .3 * abs(L_normalized.T @ x).max() / len(x)
+    lasso = linear_model.Lasso(alpha=alpha, fit_intercept=False, tol=1e-12,
+                               max_iter=10000).fit(L_normalized, x)
+    np.testing.assert_allclose(model.coef_, lasso.coef_, atol=1e-6)
+
+
+@pytest.mark.parametrize('solver, max_iter, max_iter_reweighting',
+                         [('lars', 3, 1), ('lars', 20, 10),
+                          ('cd', 5000, 1), ('cd', 5000, 10)])
+def test_sparse_regressor_alpha_grid(solver, max_iter, max_iter_reweighting):
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=2, n_samples_per_subj=5, n_parcels=10, n_sources=300,
+        n_sensors=50, max_true_sources=2
+    )
+    alpha_fractions = [.8, .01, .3, .1]
+    model = ReweightedLasso(alpha_fraction=alpha_fractions, max_iter=max_iter,
+                            max_iter_reweighting=max_iter_reweighting,
+                            tol=1e-8, solver=solver)
+    sparse_regressor = SparseRegressor(L, parcel_indices, model)
+    betas = sparse_regressor.decision_function(X)
+    assert betas.shape == (4, 10, 10)
+    assert sparse_regressor.n_screened_.shape == (4, 10)
+    assert sparse_regressor.predict(X).shape == (4, 10, 10)
+    with pytest.raises(ValueError, match='score_alphas'):
+        sparse_regressor.score(X, y)
+    scores = sparse_regressor.score_alphas(X, y)
+
+    # same as fitting each alpha on its own
+    for betas_alpha, score, alpha_fraction in zip(betas, scores,
+                                                  alpha_fractions):
+        model_alpha = clone(model).set_params(alpha_fraction=alpha_fraction)
+        sparse_regressor = SparseRegressor(L, parcel_indices, model_alpha)
+        np.testing.assert_allclose(sparse_regressor.decision_function(X),
+                                   betas_alpha, rtol=1e-6, atol=1e-10)
+        assert score == sparse_regressor.score(X, y)
+
+
+@pytest.mark.parametrize('alpha_fraction', [.1, [.3, .1]])
+def test_sparse_regressor_sparse_coefs(tmpdir, alpha_fraction):
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=2, n_samples_per_subj=5, n_parcels=10, n_sources=300,
+        n_sensors=50, max_true_sources=2
+    )
+    X = X.sample(frac=1, random_state=0)  # subjects mixed up
+    model = ReweightedLasso(alpha_fraction=alpha_fraction)
+    dense_regressor = SparseRegressor(L, parcel_indices, model)
+    sparse_regressor = SparseRegressor(L, parcel_indices, model,
+                                       sparse_coefs=True, chunk_size=4)
+    np.testing.assert_allclose(sparse_regressor.decision_function(X),
+                               dense_regressor.decision_function(X))
+
+    estimates = sparse_regressor.source_estimates(X)
+    if np.ndim(alpha_fraction):
+        assert len(estimates) == 2
+        estimates = estimates[-1]
+        with pytest.raises(ValueError, match='grid'):
+            sparse_regressor.source_estimates(X, str(tmpdir.join('e.npz')))
+    assert estimates.shape == (10, 300)
+
+    # the sources of each sample as fitted on their own
+    dense_regressor.set_params(model=clone(model).set_params(
+        alpha_fraction=.1))
+    subj_idx = X['subject_id'].values[0]
+    expected, _ = dense_regressor._run_model(
+        dense_regressor.model, subj_idx, X.iloc[:1, :-2].values)
+    np.testing.assert_allclose(estimates[0].toarray(), expected)
+
+    if not np.ndim(alpha_fraction):
+        fname = str(tmpdir.join('estimates.npz'))
+        sparse_regressor.source_estimates(X, fname)
+        saved = sparse.load_npz(fname)
+        np.testing.assert_array_equal(saved.toarray(), estimates.toarray())
+
+
+def test_batched_omp():
+    rng = np.random.RandomState(42)
+    X = rng.randn(50, 300)
+    Y = rng.randn(50, 20)
+    coef = batched_omp(X.T @ Y, X.T @ X, 4)
+    expected = linear_model.OrthogonalMatchingPursuit(
+        n_nonzero_coefs=4, fit_intercept=False, normalize=False).fit(X, Y)
+    np.testing.assert_allclose(coef, expected.coef_, atol=1e-10)
+
+    # with groups, the atoms of each sample are in different groups
+    groups = rng.randint(0, 10, size=300)
+    coef = BatchedOMP(n_nonzero_coefs=4, groups=groups).fit(X, Y).coef_
+    for coef_sample in coef:
+        active_groups = groups[coef_sample != 0]
+        assert len(active_groups) == len(np.unique(active_groups)) == 4
+        assert np.all(active_groups > 0)
+
+
+def test_sparse_regressor_group_omp():
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=2, n_samples_per_subj=10, n_parcels=10, n_sources=300,
+        n_sensors=50, max_true_sources=2
+    )
+    model = BatchedOMP(n_nonzero_coefs=2, groups='parcels')
+    sparse_regressor = SparseRegressor(L, parcel_indices, model,
+                                       precompute=True)
+    assert np.all(sparse_regressor.predict(X).sum(axis=1) == 2)
+    with pytest.raises(ValueError, match='parcels'):
+        model.fit(L[0], X.iloc[:, :-2].values.T)
+
+
+def test_sparse_regressor_compression():
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=2, n_samples_per_subj=10, n_parcels=10, n_sources=300,
+        n_sensors=50, max_true_sources=2
+    )
+    sparse_regressor = SparseRegressor(L, parcel_indices, BatchedOMP(2),
+                                       compression=.9)
+    assert sparse_regressor.predict(X).shape == y.shape
+    n_atoms = max(len(sparse_regressor._dictionary(subj_idx)[1])
+                  for subj_idx in range(2))
+    assert n_atoms < 300
+    assert sparse_regressor.source_estimates(X).shape == (20, n_atoms)
+
+
+def test_sparse_regressor_set_params():
+    X, y, L, parcel_indices = make_dataset(
+        n_subjects=2, n_samples_per_subj=10, n_parcels=10, n_sources=300,
+        n_sensors=50, max_true_sources=2
+    )
+    sparse_regressor = SparseRegressor(L, parcel_indices, BatchedOMP(2))
+    betas = sparse_regressor.decision_function(X)
+
+    # the lead fields computed for the previous parameters are not reused
+    sparse_regressor.set_params(compression=.5)
+    expected = SparseRegressor(L, parcel_indices, BatchedOMP(2),
+                               compression=.5).decision_function(X)
+    assert not np.allclose(betas, expected)
+    np.testing.assert_allclose(sparse_regressor.decision_function(X),
+                               expected)
+
+    L_other = [-lead_field[::-1] for lead_field in L]
+    sparse_regressor.set_params(lead_field=L_other, compression=None)
+    expected = SparseRegressor(L_other, parcel_indices,
+                               BatchedOMP(2)).decision_function(X)
+    assert not np.allclose(betas, expected)
+    np.testing.assert_allclose(sparse_regressor.decision_function(X),
+                               expected)
@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+
+from simulation.tests.helpers import make_labels, random_signal
+from simulation.writer import SimulationWriter
+from simulation.work_queue import run_queue
+
+
+def _make_jobs(data_dir, subjects, n_samples):
+    jobs = []
+    for subject in subjects:
+        subject_dir = os.path.join(data_dir, subject)
+        os.makedirs(subject_dir)
+        labels_fname = os.path.join(subject_dir, subject + '_labels.npz')
+        make_labels(labels_fname)
+        writer = SimulationWriter(os.path.join(subject_dir, 'chunks'),
+                                  n_samples, 42, chunk_size=3)
+        jobs.append(dict(subject=subject, labels_fname=labels_fname,
+                         raw_fname=None, fwd_fname=None, random_state=42,
+                         writer=writer, todo=list(range(n_samples))))
+    return jobs
+
+
+def test_run_queue(tmpdir):
+    subjects = ['CC120008', 'sample']
+    results = []
+    for n_jobs in [1, 2]:
+        jobs = _make_jobs(os.path.join(str(tmpdir), str(n_jobs)), subjects,
+                          n_samples=7)
+        done = []
+        run_queue(jobs, 3, 'grad', n_jobs=n_jobs, blas_threads=1,
+                  on_subject_done=lambda job: done.append(job['subject']),
+                  signal_func=random_signal)
+        assert sorted(done) == subjects
+        results.append([job['writer'].load() for job in jobs])
+
+    for (idx_1, X_1, targets_1), (idx_2, X_2, targets_2) in zip(*results):
+        np.testing.assert_array_equal(idx_1, np.arange(7))
+        np.testing.assert_array_equal(idx_1, idx_2)
+        np.testing.assert_array_equal(X_1, X_2)
+        assert targets_1 == targets_2
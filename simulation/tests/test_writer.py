@@ -0,0 +1,100 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from scipy import sparse
+
+from simulation.writer import SimulationWriter, SparseTargetBuilder
+from simulation.writer import targets_to_sparse
+
+
+def _make_sample(idx, n_electrodes=5):
+    rng = np.random.RandomState(idx)
+    target = ['%d-lh' % (idx % 4 + 1)]
+    if idx % 3 == 0:
+        target.append('%d-rh' % (idx % 2 + 5))
+    return rng.randn(n_electrodes), target
+
+
+def test_writer_resume(tmpdir):
+    n_samples = 23
+    parcel_names = np.array(['1-lh', '2-lh', '3-lh', '4-lh', '5-rh', '6-rh'])
+    store_dir = os.path.join(str(tmpdir), 'chunks')
+
+    # simulate an interrupted run: only the flushed chunks are kept
+    writer = SimulationWriter(store_dir, n_samples, 42, chunk_size=5)
+    for idx in range(12):
+        writer.append(idx, *_make_sample(idx))
+    assert writer.done_indices == set(range(10))
+    del writer
+
+    writer = SimulationWriter(store_dir, n_samples, 42, chunk_size=5)
+    assert not writer.is_complete
+    # samples might come back in any order
+    for idx in sorted(set(range(n_samples)) - writer.done_indices)[::-1]:
+        writer.append(idx, *_make_sample(idx))
+    writer.flush()
+    assert writer.is_complete
+
+    n_saved = writer.save(str(tmpdir), parcel_names)
+    assert n_saved == n_samples
+
+    X = pd.read_csv(os.path.join(str(tmpdir), 'X.csv'))
+    y = sparse.load_npz(os.path.join(str(tmpdir), 'target.npz')).toarray()
+    for idx in range(n_samples):
+        data, target = _make_sample(idx)
+        np.testing.assert_allclose(X.iloc[idx].values, data)
+        assert list(parcel_names[y[idx] == 1]) == sorted(target)
+
+
+def test_writer_wrong_random_state(tmpdir):
+    SimulationWriter(str(tmpdir), 10, 42)
+    with pytest.raises(ValueError, match='random_state'):
+        SimulationWriter(str(tmpdir), 10, 0)
+
+
+def test_writer_wrong_indices(tmpdir):
+    SimulationWriter(str(tmpdir), 10, 42, indices=range(0, 10, 2))
+    SimulationWriter(str(tmpdir), 10, 42, indices=range(0, 10, 2))
+    with pytest.raises(ValueError, match='indices'):
+        SimulationWriter(str(tmpdir), 10, 42, indices=range(1, 10, 2))
+    with pytest.raises(ValueError, match='indices'):
+        SimulationWriter(str(tmpdir), 10, 42)
+
+
+def test_sparse_target_builder():
+    parcel_names = np.array(['1-lh', '2-lh', '3-rh', '4-rh'])
+    targets = [['2-lh'], ['4-rh', '1-lh'], ['3-rh', '2-lh', '4-rh']]
+    expected = np.array([[0, 1, 0, 0],
+                         [1, 0, 0, 1],
+                         [0, 1, 1, 1]])
+
+    target = targets_to_sparse(targets, parcel_names)
+    assert sparse.isspmatrix_csr(target)
+    assert target.nnz == 6
+    np.testing.assert_array_equal(target.toarray(), expected)
+
+    # rows of already built targets, e.g. of several subjects
+    builder = SparseTargetBuilder(parcel_names)
+    builder.append_rows(target)
+    builder.append(['3-rh'])
+    builder.append_rows(sparse.csr_matrix(expected[:1]))
+    assert len(builder) == 5
+    np.testing.assert_array_equal(
+        builder.tocsr().toarray(),
+        np.concatenate([expected, [[0, 0, 1, 0]], expected[:1]]))
+
+    with pytest.raises(ValueError, match='columns'):
+        builder.append_rows(sparse.csr_matrix(np.ones((1, 3))))
+
+    # the target given is left as it is, even when it is not canonical
+    duplicated = sparse.csr_matrix(([1., 0., 1.], [1, 2, 0], [0, 2, 3]),
+                                   shape=(2, 4))
+    builder.append_rows(duplicated)
+    assert duplicated.nnz == 3
+    np.testing.assert_array_equal(builder.tocsr().toarray()[-2:],
+                                  [[0, 1, 0, 0], [1, 0, 0, 0]])
+    with pytest.raises(ValueError, match='binary'):
+        builder.append_rows(sparse.csr_matrix([[0, 2, 0, 0]]))
@@ -0,0 +1,125 @@
+from functools import lru_cache
+
+import numpy as np
+import mne
+from mne.utils import check_random_state
+
+from joblib import Parallel, delayed, parallel_config
+from tqdm import tqdm
+
+from simulation.raw_signal import generate_signal
+from simulation.sharding import sample_random_state
+
+
+def init_signal(parcels, raw_fname, fwd_fname, subject,
+                n_sources_max=3, random_state=None, signal_type='eeg'
+                ):
+    '''
+    '''
+    # randomly choose how many parcels will be activated between 1 and
+    # n_sources_max and which index at the parcel
+    rng = check_random_state(random_state)
+
+    n_parcels = rng.randint(n_sources_max, size=1)[0] + 1
+    to_activate = []
+    parcels_selected = []
+
+    # do this so that the same label is not selected twice
+    deck = list(rng.permutation(len(parcels)))
+    # deck_rh = list(rng.permutation(len(parcels_rh)))
+    for idx in range(n_parcels):
+        parcel_selected = deck.pop()
+        parcel_used = parcels[parcel_selected]
+        l1_source = parcels[parcel_selected].copy()
+        l1_source.vertices = [rng.choice(parcel_used.vertices)]
+
+        to_activate.append(l1_source)
+        parcels_selected.append(parcel_used)
+
+    # activate selected parcels
+    events, _, raw = generate_signal(raw_fname, fwd_fname, subject,
+                                     parcels=to_activate,
+                                     signal_type=signal_type,
+                                     random_state=rng)
+
+    evoked = mne.Epochs(raw, events, tmax=0.3).average()
+    data = evoked.data[:, np.argmax((evoked.data ** 2).sum(axis=0))]
+
+    names_parcels_selected = [parcel.name for parcel in parcels_selected]
+    return data, names_parcels_selected, to_activate
+
+
+@lru_cache(maxsize=2)
+def _read_parcels(labels_fname):
+    # cached in each worker, so that the labels do not need to be sent with
+    # every sample
+    return list(np.load(labels_fname, allow_pickle=True)['arr_0'])
+
+
+def _simulate_sample(subject, idx, random_state, labels_fname, raw_fname,
+                     fwd_fname, n_sources_max, signal_type, signal_func):
+    parcels = _read_parcels(labels_fname)
+    rng = sample_random_state(random_state, subject, idx)
+    # the activated labels are not needed by the writer, do not send them
+    # back from the worker
+    data, names_parcels_selected, _ = signal_func(
+        parcels, raw_fname, fwd_fname, subject, n_sources_max, rng,
+        signal_type)
+    return subject, idx, data, names_parcels_selected
+
+
+def _iter_tasks(jobs, n_sources_max, signal_type, signal_func):
+    # jobs are consumed lazily: the next subject is only waited for once
+    # all the samples of the previous ones are queued
+    for job in jobs:
+        for idx in job['todo']:
+            yield job, delayed(_simulate_sample)(
+                job['subject'], idx, job['random_state'], job['labels_fname'],
+                job['raw_fname'], job['fwd_fname'], n_sources_max,
+                signal_type, signal_func)
+
+
+def run_queue(jobs, n_sources_max, signal_type, n_jobs, blas_threads,
+              on_subject_done, signal_func=None):
+    """ simulates the samples of all the jobs using a single pool of
+    n_jobs workers, each of them limited to blas_threads BLAS threads
+
+    The workers run the functions of this module, which they import, so
+    they do not depend on the script which started the simulation.
+
+    Parameters
+    ----------
+    jobs : iterable of dict, the work of each subject (see
+        simulate._prepare_subject). The samples of job['todo'] are appended
+        to job['writer']
+    n_sources_max : int, maximum number of parcels activated in a sample
+    signal_type : string, 'eeg', 'meg', 'mag' or 'grad'
+    n_jobs : int, number of worker processes
+    blas_threads : int, number of BLAS threads allowed in each worker
+    on_subject_done : callable, called with the job of each subject once all
+        its samples were appended
+    signal_func : callable, optional, simulates a sample, with the
+        signature and the outputs of init_signal (the default). It must be
+        importable by the workers
+    """
+    if signal_func is None:
+        signal_func = init_signal
+    remaining = {}
+
+    def tasks():
+        for job, task in _iter_tasks(jobs, n_sources_max, signal_type,
+                                     signal_func):
+            if job['subject'] not in remaining:
+                remaining[job['subject']] = [job, len(job['todo'])]
+            yield task
+
+    with parallel_config(backend='loky', inner_max_num_threads=blas_threads):
+        results = Parallel(n_jobs=n_jobs, return_as='generator_unordered')(
+            tasks())
+        for subject, idx, data, target in tqdm(results):
+            assert 1 <= len(target) <= n_sources_max
+            job = remaining[subject][0]
+            job['writer'].append(idx, data, target)
+            remaining[subject][1] -= 1
+            if not remaining[subject][1]:
+                on_subject_done(remaining.pop(subject)[0])
@@ -0,0 +1,244 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from scipy.sparse import csr_matrix
+from scipy.sparse import save_npz
+
+
+MANIFEST_FNAME = 'manifest.json'
+
+
+class SimulationWriter(object):
+    """ Appends simulated samples to an on-disk chunk store.
+
+    Every ``chunk_size`` samples the buffered signals and target parcel
+    names are written to ``chunk_<n>.npz`` inside ``store_dir`` and the
+    progress manifest is updated, so that a crash only loses the current
+    buffer. Reopening the store with the same ``random_state`` and
+    ``n_samples`` resumes from the samples already written.
+
+    Parameters
+    ----------
+    store_dir : string, directory where the chunks and the manifest are kept
+    n_samples : int, total number of samples to be simulated
+    random_state : int, random state used to draw the seeds of the samples
+    chunk_size : int, number of samples buffered before writing a chunk
+    indices : array of int | None, indices of the samples which this store is
+        responsible for, e.g. when the simulation is split into shards.
+        Defaults to all the n_samples samples.
+    """
+    def __init__(self, store_dir, n_samples, random_state, chunk_size=100,
+                 indices=None):
+        self.store_dir = store_dir
+        self.n_samples = n_samples
+        self.random_state = random_state
+        self.chunk_size = chunk_size
+        if indices is None:
+            indices = range(n_samples)
+        self.indices = set(int(idx) for idx in indices)
+
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+
+        manifest_fname = os.path.join(store_dir, MANIFEST_FNAME)
+        if os.path.exists(manifest_fname):
+            with open(manifest_fname, 'r') as f:
+                self.manifest = json.load(f)
+            for key in ['n_samples', 'random_state']:
+                if self.manifest[key] != getattr(self, key):
+                    raise ValueError(
+                        '{} was written with {}={}, got {}. Remove the '
+                        'directory to start a new simulation.'.format(
+                            store_dir, key, self.manifest[key],
+                            getattr(self, key)))
+            # the stores written before the indices were recorded hold all
+            # the samples
+            indices = set(self.manifest.get('indices', range(n_samples)))
+            if indices != self.indices:
+                raise ValueError(
+                    '{} was written for other sample indices (e.g. by '
+                    'another shard). Remove the directory to start a new '
+                    'simulation.'.format(store_dir))
+        else:
+            self.manifest = {'n_samples': n_samples,
+                             'random_state': random_state,
+                             'indices': sorted(self.indices),
+                             'chunks': []}
+            self._write_manifest()
+
+        self._buffer = []
+
+    @classmethod
+    def open(cls, store_dir, chunk_size=100):
+        """ opens an existing store with the parameters it was written with
+        """
+        with open(os.path.join(store_dir, MANIFEST_FNAME), 'r') as f:
+            manifest = json.load(f)
+        return cls(store_dir, manifest['n_samples'], manifest['random_state'],
+                   chunk_size=chunk_size, indices=manifest.get('indices'))
+
+    @property
+    def done_indices(self):
+        """ indices of the samples which are already stored on disk """
+        done = set()
+        for chunk in self.manifest['chunks']:
+            done.update(chunk['indices'])
+        return done
+
+    @property
+    def is_complete(self):
+        return self.indices <= self.done_indices
+
+    def append(self, index, data, target):
+        """ buffers a single sample, flushing to disk when the buffer is full
+
+        Parameters
+        ----------
+        index : int, position of the sample in the simulation
+        data : array, shape (n_electrodes,)
+        target : list of string, names of the activated parcels
+        """
+        self._buffer.append((index, data, target))
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        indices, signals, targets = zip(*self._buffer)
+        chunk_fname = 'chunk_%05d.npz' % len(self.manifest['chunks'])
+
+        target_indptr = np.cumsum([0] + [len(t) for t in targets])
+        target_names = np.array([t for tar in targets for t in tar])
+        np.savez(os.path.join(self.store_dir, chunk_fname),
+                 indices=np.array(indices), X=np.array(signals),
+                 target_indptr=target_indptr, target_names=target_names)
+
+        # the manifest is updated only once the chunk is safely on disk
+        self.manifest['chunks'].append({'fname': chunk_fname,
+                                        'indices': [int(i) for i in indices]})
+        self._write_manifest()
+        self._buffer = []
+
+    def _write_manifest(self):
+        manifest_fname = os.path.join(self.store_dir, MANIFEST_FNAME)
+        tmp_fname = manifest_fname + '.tmp'
+        with open(tmp_fname, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_fname, manifest_fname)
+
+    def iter_chunks(self):
+        """ yields (indices, X, targets) for each chunk stored on disk """
+        for chunk in self.manifest['chunks']:
+            with np.load(os.path.join(self.store_dir, chunk['fname'])) as npz:
+                indptr = npz['target_indptr']
+                names = npz['target_names']
+                targets = [list(names[start:stop]) for start, stop
+                           in zip(indptr[:-1], indptr[1:])]
+                yield npz['indices'], npz['X'], targets
+
+    def load(self):
+        """ reads all the stored samples, sorted by their index
+
+        Returns
+        -------
+        indices : array of int, shape (n_samples,)
+        X : array, shape (n_samples, n_electrodes)
+        targets : list of lists of string, names of the activated parcels
+        """
+        self.flush()
+        return load_stores([self])
+
+    def save(self, data_dir, parcel_names):
+        """ writes the stored samples as X.csv and target.npz in data_dir """
+        _, X, targets = self.load()
+        return save_samples(data_dir, X, targets, parcel_names)
+
+
+def load_stores(writers):
+    """ reads the samples of several stores (e.g. of the shards of a
+    simulation), sorted by their index. See SimulationWriter.load """
+    indices, X, targets = [], [], []
+    for writer in writers:
+        for idx_chunk, X_chunk, targets_chunk in writer.iter_chunks():
+            indices.append(idx_chunk)
+            X.append(X_chunk)
+            targets.extend(targets_chunk)
+    indices = np.concatenate(indices)
+    order = np.argsort(indices)
+    X = np.concatenate(X, axis=0)[order]
+    targets = [targets[idx] for idx in order]
+    return indices[order], X, targets
+
+
+def save_samples(data_dir, X, targets, parcel_names):
+    """ writes the samples as X.csv and target.npz in data_dir """
+    target = targets_to_sparse(targets, parcel_names)
+
+    data_labels = ['e%d' % (idx + 1) for idx in range(X.shape[1])]
+    df = pd.DataFrame(X, columns=data_labels)
+    df.to_csv(os.path.join(data_dir, 'X.csv'), index=False)
+    save_npz(os.path.join(data_dir, 'target.npz'), target)
+    return len(df)
+
+
+class SparseTargetBuilder(object):
+    """ Builds the sparse target matrix (n_samples x n_parcels) row by row.
+
+    Parcel names are mapped to their column once, and the CSR indices are
+    filled directly, without any dense row.
+
+    Parameters
+    ----------
+    parcel_names : array of string, names of the parcels in the order of the
+        columns of the target
+    """
+    def __init__(self, parcel_names):
+        self.parcel_names = parcel_names
+        self._columns = {name: idx for idx, name in enumerate(parcel_names)}
+        self._indices = []
+        self._indptr = [0]
+
+    def __len__(self):
+        return len(self._indptr) - 1
+
+    def append(self, target):
+        """ adds a row with ones for the given parcel names """
+        columns = sorted(set(self._columns[name] for name in target))
+        self._indices.extend(columns)
+        self._indptr.append(len(self._indices))
+
+    def extend(self, targets):
+        for target in targets:
+            self.append(target)
+
+    def append_rows(self, target):
+        """ adds the rows of a binary sparse target with the same columns.
+        The target given is not modified """
+        target = csr_matrix(target, copy=True)
+        if target.shape[1] != len(self.parcel_names):
+            raise ValueError('target has {} columns, expected {}'.format(
+                             target.shape[1], len(self.parcel_names)))
+        target.sum_duplicates()
+        target.eliminate_zeros()
+        if np.any(target.data != 1):
+            raise ValueError('target must be binary, got values {}'.format(
+                             np.unique(target.data[target.data != 1])))
+        offset = len(self._indices)
+        self._indices.extend(target.indices)
+        self._indptr.extend(target.indptr[1:] + offset)
+
+    def tocsr(self):
+        indices = np.array(self._indices, dtype=np.int32)
+        data = np.ones(len(indices))
+        return csr_matrix((data, indices, np.array(self._indptr)),
+                          shape=(len(self), len(self.parcel_names)))
+
+
+def targets_to_sparse(target_list, parcel_names):
+    builder = SparseTargetBuilder(parcel_names)
+    builder.extend(target_list)
+    return builder.tocsr()
@@ -1,5 +1,7 @@
+import copy
 import os
 import glob
+import time
 
 import numpy as np
 import pandas as pd
@@ -7,18 +9,24 @@ import pickle
 import matplotlib.pyplot as plt
 
 from scipy import sparse
-from sklearn import linear_model
-from sklearn.multioutput import MultiOutputClassifier
-from sklearn.neighbors import KNeighborsClassifier
+from sklearn.base import clone
 
 from sklearn.metrics import hamming_loss
 from sklearn.metrics import jaccard_score
 from sklearn.metrics import make_scorer
 from sklearn.model_selection import cross_validate, train_test_split
 
+from simulation.ann import get_leadfield_index
+from simulation.cache import DecisionCache
+from simulation.evaluation import run_learning_curves, run_predictions
+from simulation.hierarchy import CoarseToFine, coarse_parcels
+from simulation.knn import MultilabelKNN
 from simulation.lead_correlate import LeadCorrelate
+from simulation.leadfield import read_leadfield
+from simulation.linear_inverse import LinearInverse
 from simulation.parcels import find_shortest_path_between_hemi
 from simulation.sparse_regressor import SparseRegressor, ReweightedLasso
+from simulation.sparse_regressor import BatchedOMP
 import simulation.metrics as met
 
 if os.environ.get('DISPLAY'):  # display exists
@@ -77,10 +85,6 @@ def display_true_pred_parcels(X, y, data_dir, model, model_name='',
                               n_samples='all'):
     # draw a brain with y_pred in red and y_test in green
 
-    if model_name == 'K-neighbours(3)':
-        print('this function does not work with display true pred parcels')
-        return
-
     X_train, X_test, y_train, y_test = \
         train_test_split(X, y, test_size=0.2, random_state=42)
     if n_samples != 'all':
@@ -113,51 +117,40 @@ def display_true_pred_parcels(X, y, data_dir, model, model_name='',
         plot_y_pred_true_parcels(subject, idx_lab_pred, idx_lab_true)
 
 
-def learning_curve(X, y, model=None, model_name='', n_samples_grid='auto'):
-    # runs given model with the data
-    # with different number of max sources and different number of brain
-    # parcels and plots their score depending on number of samples used.
-
-    # number of samples selected at each run
-    if model_name == 'K-neighbours(3)':
-        X = X.loc[:, X.columns != 'subject']
-
-    X_train, X_test, y_train, y_test = \
-        train_test_split(X, y, test_size=0.2, random_state=42)
-
-    if n_samples_grid == 'auto':
-        n_samples_grid = np.logspace(1, np.log10(len(X_train)),
-                                     num=10, base=10, dtype='int')
-    print(n_samples_grid)
-    scores_all = pd.DataFrame(columns=['n_samples_train', 'score_test'])
-
-    for n_samples_train in n_samples_grid:
-        # for test use either all test samples or n_samples_train
-        n_samples_test = min(len(X_test), n_samples_train)
-        print('fitting {} using {} train samples, {} test samples'.format(
-              model_name, n_samples_train, n_samples_test))
+def use_decision_cache(model, cache):
+    # the estimators taking a cache keep the decision values of each sample
+    # in it, the copies made by clone share the same cache. The model given
+    # is left unchanged, a shallow copy of it gets the cache
+    if cache is not None and 'cache' in model.get_params(deep=False):
+        model = copy.copy(model).set_params(cache=cache)
+    return model
 
-        model.fit(X_train.head(n_samples_train), y_train[:n_samples_train])
 
-        # score = model.score(X_test.head(n_samples_test),
-        #                     y_test[:n_samples_test])
-        y_pred = model.predict(X_test.head(n_samples_test))
-        score = hamming_loss(y_test[:n_samples_test], y_pred)
-        scores_all = scores_all.append({'n_samples_train': n_samples_train,
-                                        'score_test': score},
-                                       ignore_index=True)
-    n_parcels = int(y_train.shape[1])
-    max_sources = int(y_train.sum(axis=1).max())
-
-    scores_all['n_parcels'] = n_parcels
-    scores_all['max_sources'] = max_sources
-    scores_all['model_name'] = model_name
-    scores_all['model'] = str(model)
-
-    return scores_all
-
-
-def load_data(data_dir):
+def learning_curve(X, y, model=None, model_name='', n_samples_grid='auto',
+                   cache=None):
+    # runs given model with the data
+    # with different number of max sources and different number of brain
+    # parcels and returns its score depending on number of samples used,
+    # for the split train_test_split(test_size=0.2, random_state=42).
+    # With a DecisionCache, the decision values of the samples shared by
+    # the points of the curve are computed only once
+    model = use_decision_cache(model, cache)
+    return run_learning_curves(X, y, {model_name: model}, n_samples_grid)
+
+
+def load_data(data_dir, mmap_mode=None, chunksize=None):
+    """ loads the data, the targets and the lead fields from data_dir
+
+    If mmap_mode is given (e.g. 'r'), the lead fields are read from the
+    float32 lead_field/ directories saved with the simulation, memory mapped
+    and not rescaled (all the estimators normalize the columns of the lead
+    field). The lead fields are then shared by all the processes using them.
+    A ValueError is raised if one of the directories is missing.
+
+    If chunksize is given, X is not read in memory but returned as an
+    iterator over DataFrames of chunksize samples, which can be passed once
+    to the decision_function and predict of the estimators.
+    """
     # find all the files with lead_field
     # lead_matrix = np.load(os.path.join(data_dir, 'lead_field.npz'))
     lead_field_files = os.path.join(data_dir, '*lead_field.npz')
@@ -169,7 +162,18 @@ def load_data(data_dir):
     parcel_indices_leadfield, L = [], []
     subj_dict = {}
     for idx, lead_file in enumerate(lead_field_files):
-        lead_matrix = np.load(lead_file)
+        leadfield_dir = lead_file[:-len('.npz')]
+        if mmap_mode is None:
+            lead_matrix = np.load(lead_file)
+        elif os.path.isdir(leadfield_dir):
+            lead_matrix = read_leadfield(leadfield_dir, mmap_mode=mmap_mode)
+        else:
+            # the .npz lead fields are float64 and would need the same
+            # scaling as with mmap_mode=None, do not mix both
+            raise ValueError('mmap_mode is given but {} has no lead field '
+                             'directory {}, load the data with '
+                             'mmap_mode=None'.format(lead_file,
+                                                     leadfield_dir))
 
         if subject_name == 'all':
             lead_file = os.path.basename(lead_file)
@@ -184,30 +188,64 @@ def load_data(data_dir):
     assert len(parcel_indices_leadfield) == len(L) == idx + 1
     assert len(subj_dict) >= 1  # at least a single subject
 
-    X = pd.read_csv(os.path.join(data_dir, 'X.csv'))
+    def prepare_X(X):
+        if subject_name == 'all':
+            X['subject_id'] = X['subject'].map(subj_dict)
+        else:
+            X['subject'] = subject_name
+            X['subject_id'] = idx
 
-    if subject_name == 'all':
-        X['subject_id'] = X['subject'].map(subj_dict)
-    else:
-        X['subject'] = subject_name
-        X['subject_id'] = idx
+        X.astype({'subject_id': 'int32'}).dtypes
+        # Scale data to avoid tiny numbers
+        # X.iloc[:, :-2] /= np.max(X.iloc[:, :-2])
+        X.iloc[:, :-2] *= 1e12
+        return X
 
-    X.astype({'subject_id': 'int32'}).dtypes
     y = sparse.load_npz(os.path.join(data_dir, 'target.npz')).toarray()
+    X_fname = os.path.join(data_dir, 'X.csv')
+    if chunksize is None:
+        X = prepare_X(pd.read_csv(X_fname))
+        assert y.shape[0] == X.shape[0]
+    else:
+        X = (prepare_X(X_chunk)
+             for X_chunk in pd.read_csv(X_fname, chunksize=chunksize))
 
-    # Scale data and L to avoid tiny numbers
-    # X.iloc[:, :-2] /= np.max(X.iloc[:, :-2])
-    L = 1e8 * np.array(L)
-    X.iloc[:, :-2] *= 1e12
-    assert y.shape[0] == X.shape[0]
+    # Scale L to avoid tiny numbers
+    if mmap_mode is None:
+        L = 1e8 * np.array(L)
     return X, y, L, parcel_indices_leadfield, signal_type
 
 
-def calc_scores_for_model(X, y, model, n_samples=-1):
+def load_leadfield_indexes(data_dir, n_parcels=None):
+    """ IVF index of the lead field of each subject of data_dir (see
+    simulation.ann.LeadfieldIndex), in the order of the lead fields of
+    load_data. Each index is read from the lead_field/ directory saved with
+    the simulation, or built once and saved there. Returns None if the lead
+    fields were not saved as lead_field/ directories """
+    lead_field_files = sorted(glob.glob(os.path.join(data_dir,
+                                                     '*lead_field.npz')))
+    leadfield_dirs = [lead_file[:-len('.npz')]
+                      for lead_file in lead_field_files]
+    if not all(os.path.isdir(path) for path in leadfield_dirs):
+        return None
+    return [get_leadfield_index(path, n_parcels=n_parcels)
+            for path in leadfield_dirs]
+
+
+def calc_scores_for_model(X, y, model, n_samples=-1, cache=None):
     '''
     TODO: add doc
+
+    The decision values of each sample are computed once for all the folds
+    and scorers, in cache (a new DecisionCache by default)
     '''
     print('calculating various scores for the model')
+    if np.ndim(getattr(getattr(model, 'model', None), 'alpha_fraction', 0)):
+        raise ValueError('the scorers need a single alpha, score a grid of '
+                         'alphas with SparseRegressor.score_alphas')
+    if cache is None:
+        cache = DecisionCache()
+    model = use_decision_cache(model, cache)
     X_train, X_test, y_train, y_test = \
         train_test_split(X, y, test_size=0.2, random_state=42)
 
@@ -245,20 +283,46 @@ def calc_scores_for_model(X, y, model, n_samples=-1):
     return scores
 
 
-def make_learning_curve_for_all(X, y, models, n_samples_grid):
-    # Do learning curve for all models and all datasets
-    # returns data frame with names of the models and the hamming score
-    # calculated on the predictions of this model
-    scores_all = []
-
-    for name, model in models.items():
-        score = learning_curve(X, y, model=model, model_name=name,
-                               n_samples_grid=n_samples_grid)
+def read_parcel_parents(data_dir, subject):
+    """ parent (aparc) region of each parcel (aparc_sub) of the subject, from
+    the names of the parcels saved with the simulation """
+    labels = np.load(os.path.join(data_dir, subject + '_labels.npz'),
+                     allow_pickle=True)
+    return coarse_parcels(labels['original_names'])[0]
+
+
+def compare_coarse_to_fine(X, y, flat_model, coarse_to_fine):
+    """ compares the coarse to fine search with the flat search of all the
+    parcels: time of the decision function, hamming loss of the predictions
+    and fraction of the samples whose best parcel is the same """
+    scores = []
+    for name, model in [('flat', flat_model),
+                        ('coarse to fine', coarse_to_fine)]:
+        model.fit(X, y)
+        start = time.time()
+        decision = model.decision_function(X)
+        scores.append({'model': name, 'time': time.time() - start,
+                       'hamming': hamming_loss(y, model.predict(X)),
+                       'best_parcel': decision.argmax(axis=1)})
+    scores = pd.DataFrame(scores)
+    scores['speedup'] = scores['time'][0] / scores['time']
+    scores['same_best_parcel'] = [
+        np.mean(best == scores['best_parcel'][0])
+        for best in scores['best_parcel']]
+    return scores.drop(columns='best_parcel')
 
-        scores_all.append(score)
 
-    scores_all = pd.concat(scores_all, axis=0)
-    return scores_all
+def make_learning_curve_for_all(X, y, models, n_samples_grid,
+                                max_cache_bytes=int(1e9), n_jobs=1):
+    # Do learning curve for all models and all datasets
+    # returns data frame with names of the models and the hamming score
+    # calculated on the predictions of this model, and the wall time of
+    # each point, run on n_jobs processes. The models taking a cache share
+    # a DecisionCache of at most max_cache_bytes in each process
+    cache = DecisionCache(max_bytes=max_cache_bytes)
+    models = {name: use_decision_cache(model, cache)
+              for name, model in models.items()}
+    return run_learning_curves(X, y, models, n_samples_grid, n_jobs=n_jobs)
 
 
 # plot the results from all the calculated data
@@ -296,6 +360,9 @@ if __name__ == "__main__":
     save_y_pred = False
     score_on_predicted = False
     plot_parcels = False
+    coarse_to_fine = False
+    sweep_lars_alphas = False
+    ivf_index = False
 
     username = os.environ.get('USER')
     data_dir = 'data_grad_sample_450_3'
@@ -318,17 +385,38 @@ if __name__ == "__main__":
     # load data
     print('processing {} ... '.format(data_dir))
 
-    X, y, L, parcel_indices, signal_type_data = load_data(data_dir)
+    # the lead fields are memory mapped, and shared by the workers of the
+    # learning curves
+    X, y, L, parcel_indices, signal_type_data = load_data(data_dir,
+                                                          mmap_mode='r')
 
     assert signal_type == signal_type_data
 
     # define models
-    # Lasso lars
-    model_lars = linear_model.LassoLars(max_iter=3, normalize=False,
-                                        fit_intercept=False)
-
+    # Lasso lars: a single reweighting step is the lasso, solved by LARS
+    # with alpha = alpha_fraction * alpha_max
+    model_lars = ReweightedLasso(alpha_fraction=.01, max_iter=3,
+                                 max_iter_reweighting=1, solver='lars')
+
+    # precompute is left off for the models evaluated by the learning
+    # curves: each of their clones would compute the n_sources ** 2 Gram
+    # matrix of every subject again
     lasso_lars = SparseRegressor(L, parcel_indices, model_lars)  # , data_dir)
 
+    if sweep_lars_alphas:
+        # all the alphas of the sweep come from one LARS path per sample,
+        # the estimator is not cloned so the Gram matrices are computed once
+        alpha_grid = np.logspace(-3, 0, 7)
+        lars_grid = SparseRegressor(
+            L, parcel_indices,
+            clone(model_lars).set_params(alpha_fraction=alpha_grid),
+            precompute=True)
+        n_samples = min(len(X), 500)
+        print(pd.DataFrame({
+            'alpha_fraction': alpha_grid,
+            'hamming': lars_grid.score_alphas(X.head(n_samples),
+                                              y[:n_samples])}))
+
     model_reweighted = ReweightedLasso(alpha_fraction=.8, max_iter=20,
                                        max_iter_reweighting=10, tol=1e-4)
     lasso_reweighted = SparseRegressor(L, parcel_indices, model_reweighted)
@@ -338,12 +426,28 @@ if __name__ == "__main__":
     lasso_reweighted_not = SparseRegressor(L, parcel_indices,
                                            model_reweighted_not)
 
+    # Orthogonal matching pursuit, all the samples of a subject at once
+    model_omp = BatchedOMP(n_nonzero_coefs=int(y.sum(axis=1).max()))
+    omp = SparseRegressor(L, parcel_indices, model_omp)
+    model_group_omp = BatchedOMP(n_nonzero_coefs=int(y.sum(axis=1).max()),
+                                 groups='parcels')
+    group_omp = SparseRegressor(L, parcel_indices, model_group_omp)
+
     # Lead COrrelate
     lc = LeadCorrelate(L, parcel_indices)
 
-    # K-means
-    clf = KNeighborsClassifier(3)
-    kneighbours = MultiOutputClassifier(clf, n_jobs=N_JOBS)
+    # Lead Correlate searching the aparc regions first, then their aparc_sub
+    # parcels
+    if coarse_to_fine:
+        parents = read_parcel_parents(data_dir, subject)
+        lc_coarse = CoarseToFine(L, parcel_indices, [parents])
+        print(compare_coarse_to_fine(X, y, lc, lc_coarse))
+
+    # dSPM, one precomputed kernel per subject
+    dspm = LinearInverse(L, parcel_indices, method='dSPM')
+
+    # K-neighbours, a single neighbour index for all the parcels
+    kneighbours = MultilabelKNN(3, n_jobs=N_JOBS)
 
     if calc_scores_for_lc:
         # calculate various scores for Lead Correlate model
@@ -356,17 +460,31 @@ if __name__ == "__main__":
 
     models = {'K-neighbours(3)': kneighbours,
               'lead correlate': lc,
+              'dSPM': dspm,
               'lasso lars': lasso_lars,
+              'omp': omp,
+              'group omp': group_omp,
               '1 lasso reweighted': lasso_reweighted_not,
               '10 lasso reweighted': lasso_reweighted,
               }
 
+    if ivf_index:
+        # Lead Correlate on the sources of the 4 lists of the IVF index of
+        # each lead field closest to each sample. The indexes are read from
+        # data_dir (built and saved there the first time), instead of being
+        # built at each fit
+        indexes = load_leadfield_indexes(
+            data_dir, n_parcels=max(max(s) for s in parcel_indices))
+        models['lead correlate ivf'] = LeadCorrelate(
+            L, parcel_indices, n_probe=4, indexes=indexes)
+
     scores_save_file = os.path.join(data_dir, "scores_all.pkl")
     if calc_learning_rate:
         # make learning curve for selected models
         # models = {'lasso reweighted': lasso_reweighted}
 
-        scores_all = make_learning_curve_for_all(X, y, models, n_samples_grid)
+        scores_all = make_learning_curve_for_all(X, y, models, n_samples_grid,
+                                                 n_jobs=N_JOBS)
         scores_all.to_pickle(scores_save_file)
 
         print(scores_all.tail(len(models)))
@@ -374,28 +492,14 @@ if __name__ == "__main__":
     models_pred_file = os.path.join(data_dir, "models_pred_all.pkl")
     if save_y_pred:
         # split the data
-        model_pred = {}
-        X_train, X_test, y_train, y_test = \
-            train_test_split(X, y, test_size=0.2, random_state=42)
-        n_samples_train = len(X_train)
-        n_samples_test = len(X_test)
-        for name, model in models.items():
-            print('running predictions on {}'.format(name))
-            if name == 'K-neighbours(3)':
-                model.fit(X_train.loc[:, X_train.columns != 'subject'].head(
-                          n_samples_train), y_train[:n_samples_train])
-                y_pred = model.predict(X_test.loc[:,
-                                       X_test.columns != 'subject'].head(
-                                                            n_samples_test))
-            else:
-                model.fit(X_train.head(n_samples_train),
-                          y_train[:n_samples_train])
-                y_pred = model.predict(X_test.head(n_samples_test))
-            model_pred[name] = y_pred
-
-        model_pred['y_true'] = y_test[:n_samples_test]
-        model_pred['subject'] = X_test.head(
-                                    n_samples_test)['subject'].to_numpy()
+        train, test = train_test_split(np.arange(len(X)), test_size=0.2,
+                                       random_state=42)
+        print('running predictions on {}'.format(', '.join(models)))
+        model_pred = run_predictions(X, y, models, train, test,
+                                     n_jobs=N_JOBS)
+
+        model_pred['y_true'] = y[test]
+        model_pred['subject'] = X['subject'].to_numpy()[test]
         with open(models_pred_file, 'wb') as handle:
             pickle.dump(model_pred, handle)
         print('saved the predictions to {}'.format(models_pred_file))